@@ -1,10 +1,53 @@
 from abc import ABC, abstractmethod
+from collections import Counter
+import hashlib
+import random
+import re
+import time
 import numpy as np
 from openai import OpenAI
 
+# Native output size of text-embedding-3-small. Stores and indexes use it unless configured otherwise
+DEFAULT_EMBEDDING_DIM = 1536
+
+# slogans longer than this (characters) are dropped from variants, banners have room for a short line only
+MAX_SLOGAN_LENGTH = 80
+
+
+def ad_text_prompt(product_name: str, product_description: str, user_keywords: list[str]) -> str:
+    """User message of slogan requests"""
+    return f"""Product name: {product_name}\n
+                    Product description: {product_description}\n
+                    User keywords: {user_keywords}\n
+                    """
+
+
+def rank_slogans(candidates: list[tuple[str, float]], n: int, max_length: int = MAX_SLOGAN_LENGTH) -> list[str]:
+    """
+    Cleans (slogan, score) candidates and returns at most n best distinct ones, best first.
+    Wrapping quotes are stripped, empty and too long slogans are dropped, and slogans differing
+    only in case, spacing or punctuation count as one
+    """
+    ranked = []
+    seen = set()
+    for slogan, score in sorted(candidates, key=lambda candidate: candidate[1], reverse=True):
+        slogan = " ".join(slogan.strip().strip("\"'").split())
+        key = " ".join(re.findall(r"\w+", slogan.casefold()))
+        if not key or len(slogan) > max_length or key in seen:
+            continue
+        seen.add(key)
+        ranked.append(slogan)
+        if len(ranked) == n:
+            break
+    return ranked
+
+
 class AIBox(ABC):
-    def __init__(self) -> None:
-        pass
+    def __init__(self, dimensions: int = DEFAULT_EMBEDDING_DIM) -> None:
+        """
+        :param dimensions: size of embeddings returned by the box
+        """
+        self.dimensions = dimensions
     
     @abstractmethod
     def embedding_from_text(self, text: str) -> np.ndarray:
@@ -13,6 +56,13 @@ class AIBox(ABC):
     @abstractmethod
     def embedding_from_file(self, file_path: str) -> np.ndarray:
         pass
+
+    def embeddings_from_texts(self, texts: list[str]) -> np.ndarray:
+        """
+        Returns embeddings of several texts as a (len(texts), dimensions) matrix.
+        Implementations should override it with a single batched request where the provider allows it
+        """
+        return np.vstack([self.embedding_from_text(text) for text in texts])
     
     @abstractmethod
     def ad_text(self, product_name: str, 
@@ -21,6 +71,21 @@ class AIBox(ABC):
                 instructions: str) -> str:
         "Custom instructions need to be suppied for generating text"
         pass
+
+    def ad_text_variants(self,
+                         product_name: str,
+                         product_description: str,
+                         user_keywords: list[str],
+                         instructions: str,
+                         n: int,
+                         max_length: int = MAX_SLOGAN_LENGTH) -> list[str]:
+        """
+        Returns up to n distinct slogans for the same input, best first. May return fewer than n
+        when the model repeats itself or exceeds max_length characters.
+        Implementations should override it with a single request where the provider allows it
+        """
+        candidates = [(self.ad_text(product_name, product_description, user_keywords, instructions), -i) for i in range(n)]
+        return rank_slogans(candidates, n, max_length)
     
     @abstractmethod
     def keywords(self, text: str, num_keywords: int) -> list[str]:
@@ -30,16 +95,43 @@ class AIBox(ABC):
         NOTE: model might not return exactly num_keywords     
         """
         pass
+
+    def summary(self, text: str, max_words: int) -> str:
+        """
+        Compact version of the text for prompts. The default keeps the leading sentences
+        that fit into max_words, implementations may summarize with a model instead
+        """
+        sentences = re.split(r"(?<=[.!?])\s+", " ".join(text.split()))
+        words = []
+        for sentence in sentences:
+            sentence_words = sentence.split()
+            if words and len(words) + len(sentence_words) > max_words:
+                break
+            words.extend(sentence_words)
+        return " ".join(words[:max_words])
     
 class OpenAIBox(AIBox):
-    def __init__(self, openai_key: str) -> None:
-        self.openai_client = OpenAI(api_key=openai_key)
-        super().__init__()
+    def __init__(self, 
+                 openai_key: str, 
+                 dimensions: int = DEFAULT_EMBEDDING_DIM,
+                 timeout: float = 10.0,
+                 max_retries: int = 2) -> None:
+        """
+        :param dimensions: embedding size. text-embedding-3 models shorten their output natively
+                           (see embedding_recall.py for the quality cost of shortening)
+        :param timeout: seconds a single API request may take, the client default is 10 minutes
+        :param max_retries: retries of failed or timed out requests
+        """
+        self.openai_client = OpenAI(api_key=openai_key, timeout=timeout, max_retries=max_retries)
+        super().__init__(dimensions)
         
     def embedding_from_text(self, text: str, model="text-embedding-3-small") -> np.ndarray:
+        # dimensions is only sent when shortening, older embedding models do not accept it
+        extra_args = {"dimensions": self.dimensions} if self.dimensions != DEFAULT_EMBEDDING_DIM else {}
         response = self.openai_client.embeddings.create(
             input=text,
             model=model,
+            **extra_args,
         )
         
         embedding = response.data[0].embedding
@@ -49,6 +141,20 @@ class OpenAIBox(AIBox):
         with open(file_path, 'r') as file:
             text = file.read()
         return self.embedding_from_text(text, model)
+
+    def embeddings_from_texts(self, texts: list[str], model="text-embedding-3-small") -> np.ndarray:
+        """
+        Embeds all texts with one API request. The API accepts up to 2048 inputs per request
+        """
+        extra_args = {"dimensions": self.dimensions} if self.dimensions != DEFAULT_EMBEDDING_DIM else {}
+        response = self.openai_client.embeddings.create(
+            input=texts,
+            model=model,
+            **extra_args,
+        )
+        # the API does not guarantee order of returned items
+        ordered = sorted(response.data, key=lambda item: item.index)
+        return np.array([item.embedding for item in ordered])
     
     def ad_text(self, 
                 product_name: str,
@@ -56,10 +162,7 @@ class OpenAIBox(AIBox):
                 user_keywords: list[str],
                 instructions: str,
                 model = "gpt-4o-mini") -> str:
-        prompt = f"""Product name: {product_name}\n
-                    Product description: {product_description}\n
-                    User keywords: {user_keywords}\n
-                    """
+        prompt = ad_text_prompt(product_name, product_description, user_keywords)
         response = self.openai_client.chat.completions.create(
             model=model,
             messages=[
@@ -70,6 +173,40 @@ class OpenAIBox(AIBox):
         if response.choices[0].finish_reason != "stop":
             raise Exception("OpenAI did not finish generating the text")
         return response.choices[0].message.content
+
+    def ad_text_variants(self,
+                         product_name: str,
+                         product_description: str,
+                         user_keywords: list[str],
+                         instructions: str,
+                         n: int,
+                         max_length: int = MAX_SLOGAN_LENGTH,
+                         model="gpt-4o-mini") -> list[str]:
+        """
+        Samples n completions of the ad_text prompt in one request, the prompt is billed once.
+        Variants are ranked by the mean log probability of their tokens
+        """
+        prompt = ad_text_prompt(product_name, product_description, user_keywords)
+        response = self.openai_client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": instructions},
+                {"role": "user", "content": prompt}
+            ],
+            n=n,
+            logprobs=True,
+        )
+        candidates = []
+        for choice in response.choices:
+            # truncated variants would be cut mid-sentence
+            if choice.finish_reason != "stop" or not choice.message.content:
+                continue
+            tokens = choice.logprobs.content if choice.logprobs is not None and choice.logprobs.content else []
+            score = sum(token.logprob for token in tokens) / len(tokens) if tokens else float("-inf")
+            candidates.append((choice.message.content, score))
+        if not candidates:
+            raise Exception("OpenAI did not finish generating any variant")
+        return rank_slogans(candidates, n, max_length)
     
     def keywords(self, text: str, num_keywords: int, model="gpt-4o-mini") -> list[str]:
         """
@@ -86,3 +223,154 @@ class OpenAIBox(AIBox):
             raise Exception("OpenAI did not finish generating the text")
         
         return response.choices[0].message.content.split(",")
+
+    def summary(self, text: str, max_words: int, model="gpt-4o-mini") -> str:
+        """
+        :param model: OpenAI completions model to use
+        """
+        response = self.openai_client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": f"Summarize the product description in at most {max_words} words. Keep what the product is and what it is for, drop marketing filler. Output just the summary."},
+                {"role": "user", "content": text}
+            ],
+        )
+        if response.choices[0].finish_reason != "stop":
+            raise Exception("OpenAI did not finish generating the text")
+        return response.choices[0].message.content.strip()
+
+
+class InjectedAIBoxError(RuntimeError):
+    """Raised by LocalAIBox when error injection fires"""
+    pass
+
+
+class LocalAIBox(AIBox):
+    """
+    Network-free AIBox for load testing and benchmarking.
+    Embeddings are deterministic hashed bag-of-words vectors, so texts sharing words end up close
+    to each other. Slogans are built from templates and keywords are picked by word frequency.
+    Latency and failures of a real provider can be simulated with the constructor arguments.
+    """
+    STOPWORDS = frozenset("""
+        a an and are as at be been but by for from has have in is it its of on or that the this
+        to was were will with you your our we it's into than then there these those which who
+        """.split())
+
+    SLOGAN_TEMPLATES = [
+        "{product}: made for {interest} lovers",
+        "Love {interest}? You will love {product}",
+        "{product} - the perfect match for {interest}",
+        "Your {interest} deserves {product}",
+        "From {interest} to {product}, all in one day",
+    ]
+
+    def __init__(self,
+                 dimensions: int = DEFAULT_EMBEDDING_DIM,
+                 embedding_latency: float = 0.0,
+                 completion_latency: float = 0.0,
+                 latency_jitter: float = 0.0,
+                 error_rate: float = 0.0,
+                 seed: int = 0) -> None:
+        """
+        :param dimensions: size of produced embeddings
+        :param embedding_latency: artificial delay of embedding calls, seconds
+        :param completion_latency: artificial delay of ad_text and keywords calls, seconds
+        :param latency_jitter: uniform random jitter added to every delay, seconds
+        :param error_rate: probability in [0, 1] that a call raises InjectedAIBoxError
+        :param seed: seed for hashing, jitter and error injection
+        """
+        if not 0.0 <= error_rate <= 1.0:
+            raise ValueError("error_rate should be between 0 and 1")
+        self.embedding_latency = embedding_latency
+        self.completion_latency = completion_latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.seed = seed
+        self._random = random.Random(seed)
+        super().__init__(dimensions)
+
+    def _simulate_call(self, latency: float) -> None:
+        delay = latency + (self._random.uniform(0, self.latency_jitter) if self.latency_jitter > 0 else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+        if self.error_rate > 0 and self._random.random() < self.error_rate:
+            raise InjectedAIBoxError("LocalAIBox: injected failure")
+
+    def _hash(self, token: str) -> int:
+        digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8, key=str(self.seed).encode("utf-8"))
+        return int.from_bytes(digest.digest(), "little")
+
+    def _tokens(self, text: str) -> list[str]:
+        return re.findall(r"[a-z0-9']+", text.lower())
+
+    def embedding_from_text(self, text: str) -> np.ndarray:
+        self._simulate_call(self.embedding_latency)
+        return self._hashed_embedding(text)
+
+    def embeddings_from_texts(self, texts: list[str]) -> np.ndarray:
+        # one simulated round trip for the whole batch, like a batched provider request
+        self._simulate_call(self.embedding_latency)
+        return np.vstack([self._hashed_embedding(text) for text in texts])
+
+    def _hashed_embedding(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dimensions, dtype=np.float64)
+        tokens = self._tokens(text) or [text]
+        # every token is spread over a few hashed positions with hashed signs
+        for token in tokens:
+            h = self._hash(token)
+            for i in range(4):
+                position = (h >> (i * 16)) % self.dimensions
+                sign = 1.0 if (h >> (i * 16 + 15)) & 1 else -1.0
+                vector[position] += sign
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            vector[self._hash(text) % self.dimensions] = 1.0
+            norm = 1.0
+        return vector / norm
+
+    def embedding_from_file(self, file_path: str) -> np.ndarray:
+        with open(file_path, 'r') as file:
+            text = file.read()
+        return self.embedding_from_text(text)
+
+    def ad_text(self,
+                product_name: str,
+                product_description: str,
+                user_keywords: list[str],
+                instructions: str) -> str:
+        self._simulate_call(self.completion_latency)
+        interest = user_keywords[0].strip() if user_keywords else "everyday life"
+        key = "|".join([product_name, product_description, ",".join(user_keywords), instructions])
+        template = self.SLOGAN_TEMPLATES[self._hash(key) % len(self.SLOGAN_TEMPLATES)]
+        return template.format(product=product_name, interest=interest)
+
+    def ad_text_variants(self,
+                         product_name: str,
+                         product_description: str,
+                         user_keywords: list[str],
+                         instructions: str,
+                         n: int,
+                         max_length: int = MAX_SLOGAN_LENGTH) -> list[str]:
+        """One simulated call, variants combine every template with every keyword and get hashed scores"""
+        self._simulate_call(self.completion_latency)
+        interests = [keyword.strip() for keyword in user_keywords if keyword.strip()] or ["everyday life"]
+        key = "|".join([product_name, product_description, ",".join(user_keywords), instructions])
+        candidates = []
+        for template in self.SLOGAN_TEMPLATES:
+            for interest in interests:
+                slogan = template.format(product=product_name, interest=interest)
+                candidates.append((slogan, self._hash(key + slogan) / 2 ** 64))
+        return rank_slogans(candidates, n, max_length)
+
+    def keywords(self, text: str, num_keywords: int) -> list[str]:
+        self._simulate_call(self.completion_latency)
+        counter = Counter(
+            token for token in self._tokens(text)
+            if token not in self.STOPWORDS and len(token) > 2
+        )
+        return [word for word, _ in counter.most_common(num_keywords)]
+
+    def summary(self, text: str, max_words: int) -> str:
+        self._simulate_call(self.completion_latency)
+        return super().summary(text, max_words)
@@ -0,0 +1,139 @@
+"""
+Cache of fully encoded banners.
+
+A banner is a pure function of template, product, slogan, size and format (the main color is derived
+from the product image), so the digest of these inputs identifies its bytes and doubles as a strong ETag.
+Lookups go to a per-process LRU first and to a shared tier (Redis or local disk) next.
+"""
+import collections
+import hashlib
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from typing import Optional, Tuple
+
+from redis import Redis
+
+from metrics import record_cache
+
+
+def banner_digest(template: str,
+                  product_key: str,
+                  product_name: str,
+                  image_link: str,
+                  slogan: str,
+                  dimensions: Tuple[int, int],
+                  image_format: str,
+                  icon_path: Optional[str] = None) -> str:
+    """
+    Digest of everything the banner bytes depend on.
+    Stored image links are content-addressed, so a changed image changes the digest too
+    """
+    payload = json.dumps([template, product_key, product_name, image_link, slogan, list(dimensions), image_format, icon_path],
+                         ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class BannerTier(ABC):
+    @abstractmethod
+    def get(self, digest: str) -> Optional[bytes]:
+        return None
+
+    @abstractmethod
+    def put(self, digest: str, banner: bytes) -> None:
+        pass
+
+
+class RedisBannerTier(BannerTier):
+    """Banners shared by all workers as banner:<digest> strings expiring after ttl seconds"""
+    def __init__(self, redis_client: Redis, ttl: int = 24 * 3600) -> None:
+        """
+        :param redis_client: client without response decoding, e.g. RedisDataLayer.binary_client
+        """
+        self.redis_client = redis_client
+        self.ttl = ttl
+
+    def get(self, digest: str) -> Optional[bytes]:
+        return self.redis_client.get(f"banner:{digest}")
+
+    def put(self, digest: str, banner: bytes) -> None:
+        self.redis_client.set(f"banner:{digest}", banner, ex=self.ttl)
+
+
+class DiskBannerTier(BannerTier):
+    """Banners shared by workers on one host as <root>/<digest[:2]>/<digest> files"""
+    def __init__(self, root: str = "banner-cache") -> None:
+        self.root = root
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def get(self, digest: str) -> Optional[bytes]:
+        try:
+            with open(self._path(digest), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, digest: str, banner: bytes) -> None:
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(banner)
+        os.replace(tmp_path, path)
+
+
+class BannerCache:
+    def __init__(self, max_memory_bytes: int = 64 * 1024 * 1024, shared: Optional[BannerTier] = None) -> None:
+        """
+        :param max_memory_bytes: size limit of the in-process LRU, least recently used banners are evicted first
+        :param shared: optional tier shared between workers
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.shared = shared
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _remember(self, digest: str, banner: bytes) -> None:
+        if len(banner) > self.max_memory_bytes:
+            return
+        with self._lock:
+            if digest in self._entries:
+                self._entries.move_to_end(digest)
+                return
+            self._entries[digest] = banner
+            self._size += len(banner)
+            while self._size > self.max_memory_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def get(self, digest: str) -> Optional[bytes]:
+        with self._lock:
+            banner = self._entries.get(digest)
+            if banner is not None:
+                self._entries.move_to_end(digest)
+        record_cache("banner_memory", banner is not None)
+        if banner is not None:
+            return banner
+        if self.shared is None:
+            return None
+        try:
+            banner = self.shared.get(digest)
+        except Exception as e:
+            print(f"BannerCache: shared tier failed: {e}")
+            return None
+        record_cache("banner_shared", banner is not None)
+        if banner is not None:
+            self._remember(digest, banner)
+        return banner
+
+    def put(self, digest: str, banner: bytes) -> None:
+        self._remember(digest, banner)
+        if self.shared is not None:
+            try:
+                self.shared.put(digest, banner)
+            except Exception as e:
+                print(f"BannerCache: shared tier failed: {e}")
@@ -0,0 +1,439 @@
+"""
+Offline batch rendering of campaign banners.
+
+Work items are read from a JSON lines file, one banner per line:
+    {"id": "mail-1", "user": "user:1", "product": "product:7", "width": 600, "height": 200, "format": "png"}
+"keywords" may replace "user" and a fixed "slogan" may be given, "id" defaults to the line number.
+Items are processed in batches: products and users are loaded with one round trip per batch, slogans
+are looked up (or generated once per product and segment) on a thread pool, and every item gets the
+banner_digest of its inputs, the same one the banner cache uses. Identical creatives are rendered
+once, on a process pool with one pre-warmed worker per core, and stored under their digest either as
+    <out>/creatives/<digest[:2]>/<digest>.<ext>           with --output dir
+    <out>/creatives-<part>.tar members <digest[:2]>/<digest>.<ext>   with --output tar
+<out>/manifest.jsonl maps every item to its creative (or error), <out>/creatives.index (dbm) maps
+digests to stored creatives across batches and runs. After every batch the outputs are flushed and
+<out>/checkpoint.json records the progress, so a rerun with the same arguments resumes after the last
+finished batch. Memory use is bounded by the batch size, not by the size of the campaign.
+
+Usage: python batchrender.py items.jsonl out [--output dir|tar] [--batch 1024] [--workers N]
+                             [--tar-size 1073741824] [--storage json|hash] [--dim 1536] [--local-aibox] [--icons icons]
+"""
+import argparse
+import concurrent.futures
+import dbm
+import io
+import json
+import os
+import tarfile
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from aibox import AIBox, LocalAIBox, OpenAIBox, DEFAULT_EMBEDDING_DIM
+from bannercache import banner_digest
+from datalayer import RedisDataLayer
+from dbcontrol import Product, RedisProductStore, RedisUserStore, User
+from iconlibrary import IconLibrary, read_icon
+from imagestore import load_image
+from renderservice import render_banner, warm_up
+from slogans import RedisSloganStore, get_slogan, segment_of
+
+
+TEMPLATE = "basicxmltemplate"
+
+# format parameter -> (PIL format, file extension)
+FORMATS = {"png": ("PNG", "png"), "jpeg": ("JPEG", "jpg"), "webp": ("WEBP", "webp")}
+
+
+def read_items(path: str, start: int = 0) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """
+    Yields (line number, item) of non-empty lines from line start on.
+    Lines which are not JSON objects yield {"_invalid": reason} and fail alone
+    """
+    with open(path) as file:
+        for number, line in enumerate(file):
+            if number >= start and line.strip():
+                try:
+                    item = json.loads(line)
+                except ValueError as e:
+                    item = {"_invalid": f"not JSON: {e}"}
+                yield number, item if isinstance(item, dict) else {"_invalid": "not a JSON object"}
+
+
+def _fsync_path(path: str) -> None:
+    """fsync of a file or a directory, a directory has to be synced for new entries in it to survive a crash"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _render_creative(product: Product,
+                     dimensions: Tuple[int, int],
+                     slogan: str,
+                     image_format: str,
+                     icon_path: Optional[str]) -> bytes:
+    """Runs in a worker process, reads the product image variant for the size and renders the banner"""
+    image_path, image_data, main_color = load_image(product.image_link, *dimensions)
+    image_sources = {image_path: image_data}
+    if icon_path is not None:
+        image_sources[icon_path] = read_icon(icon_path)
+    banner, _ = render_banner(TEMPLATE, Product(product.name, product.description, image_path), dimensions, slogan,
+                              main_color, image_sources, image_format, icon_path)
+    return banner
+
+
+class Checkpoint:
+    """
+    Progress of one campaign: lines of the input fully processed, size of the manifest written for them
+    and the number of the next tar archive
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lines_done = 0
+        self.manifest_size = 0
+        self.next_part = 0
+        if os.path.exists(path):
+            with open(path) as file:
+                data = json.load(file)
+            self.lines_done = data["lines_done"]
+            self.manifest_size = data["manifest_size"]
+            self.next_part = data["next_part"]
+
+    def save(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"lines_done": self.lines_done, "manifest_size": self.manifest_size, "next_part": self.next_part}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+        _fsync_path(os.path.dirname(os.path.abspath(self.path)))
+
+
+class CreativeSink(ABC):
+    @abstractmethod
+    def write(self, name: str, data: bytes) -> str:
+        """Stores a creative, returns its location relative to the output directory"""
+        return ""
+
+    @abstractmethod
+    def flush(self) -> None:
+        """Makes creatives written so far durable, the index and the checkpoint only advance after it"""
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+
+class DirectorySink(CreativeSink):
+    """
+    One file per creative. Files are synced on flush rather than on write, so a batch costs
+    one fsync per creative and per directory it touched but never waits for them one by one
+    """
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.pending: List[str] = []
+        self.directories: Set[str] = set()
+
+    def write(self, name: str, data: bytes) -> str:
+        location = os.path.join("creatives", name)
+        path = os.path.join(self.root, location)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+            # the new directory itself is an entry of its parents
+            self.directories.update((os.path.dirname(directory), os.path.dirname(os.path.dirname(directory))))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+        self.pending.append(path)
+        self.directories.add(directory)
+        return location
+
+    def flush(self) -> None:
+        for path in self.pending:
+            _fsync_path(path)
+        for directory in self.directories:
+            _fsync_path(directory)
+        self.pending = []
+        self.directories = set()
+
+
+class TarSink(CreativeSink):
+    """
+    Appends creatives to creatives-<part>.tar archives, starting a new one when max_size bytes are exceeded.
+    A resumed run starts a new archive, archives of earlier runs are never modified
+    """
+    def __init__(self, root: str, first_part: int, max_size: int = 1 << 30) -> None:
+        self.root = root
+        self.max_size = max_size
+        self.part = first_part - 1
+        self.archive: Optional[tarfile.TarFile] = None
+        self.file = None
+
+    def _open_next(self) -> None:
+        self.close()
+        self.part += 1
+        self.file = open(os.path.join(self.root, f"creatives-{self.part:05d}.tar"), "wb")
+        self.archive = tarfile.open(fileobj=self.file, mode="w")
+
+    def write(self, name: str, data: bytes) -> str:
+        if self.archive is None or self.file.tell() > self.max_size:
+            self._open_next()
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.archive.addfile(info, io.BytesIO(data))
+        return f"creatives-{self.part:05d}.tar:{name}"
+
+    def flush(self) -> None:
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            # a new archive is an entry of the output directory
+            _fsync_path(self.root)
+
+    def close(self) -> None:
+        if self.archive is not None:
+            self.archive.close()
+            self.file.close()
+            self.archive = None
+            self.file = None
+
+
+class BatchRenderer:
+    def __init__(self,
+                 product_store: RedisProductStore,
+                 user_store: RedisUserStore,
+                 slogan_store: RedisSloganStore,
+                 aibox: AIBox,
+                 output_dir: str,
+                 output: str = "dir",
+                 batch_size: int = 1024,
+                 workers: Optional[int] = None,
+                 slogan_threads: int = 16,
+                 tar_size: int = 1 << 30,
+                 icons: Optional[IconLibrary] = None) -> None:
+        """
+        :param output: "dir" for a sharded directory of creatives, "tar" for tar archives
+        :param batch_size: items per batch, bounds the memory use and the work redone after an interruption
+        :param workers: render processes, one per CPU by default
+        :param slogan_threads: concurrent slogan lookups and generations
+        :param tar_size: size in bytes after which a new tar archive is started
+        :param icons: icon library matched against user embeddings, banners have no icon without it
+        """
+        if output not in ("dir", "tar"):
+            raise ValueError(f"Unknown output: {output}")
+        self.product_store = product_store
+        self.user_store = user_store
+        self.slogan_store = slogan_store
+        self.aibox = aibox
+        self.output_dir = output_dir
+        self.batch_size = batch_size
+        self.icons = icons
+        os.makedirs(output_dir, exist_ok=True)
+        self.checkpoint = Checkpoint(os.path.join(output_dir, "checkpoint.json"))
+        self.sink = DirectorySink(output_dir) if output == "dir" else TarSink(output_dir, self.checkpoint.next_part, tar_size)
+        self.index = dbm.open(os.path.join(output_dir, "creatives.index"), "c")
+        self.manifest_path = os.path.join(output_dir, "manifest.jsonl")
+        # drops manifest lines of a batch which was interrupted before its checkpoint
+        with open(self.manifest_path, "a") as manifest:
+            manifest.truncate(self.checkpoint.manifest_size)
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                                                           initializer=warm_up, initargs=("fonts", 120))
+        self.slogan_pool = concurrent.futures.ThreadPoolExecutor(max_workers=slogan_threads)
+
+    def _batches(self, items_path: str) -> Iterator[List[Tuple[int, Dict[str, Any]]]]:
+        batch = []
+        for item in read_items(items_path, self.checkpoint.lines_done):
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _resolve(self, batch: List[Tuple[int, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """Loads products, users and slogans of the batch, returns a job per item with error or digest"""
+        product_keys = list({item["product"] for _, item in batch if isinstance(item.get("product"), str)})
+        products = dict(zip(product_keys, self.product_store.get_products(product_keys)))
+        user_keys = list({item["user"] for _, item in batch if isinstance(item.get("user"), str)})
+        users = dict(zip(user_keys, self.user_store.get_users(user_keys)))
+
+        jobs = []
+        slogan_futures: Dict[Tuple[str, str], concurrent.futures.Future] = {}
+        for number, item in batch:
+            job = {"id": item.get("id", number), "line": number}
+            jobs.append(job)
+            try:
+                self._resolve_item(job, item, products, users, slogan_futures)
+            except (KeyError, TypeError, ValueError) as e:
+                # a malformed item fails alone, the error lands in its manifest line
+                job.pop("slogan_future", None)
+                job["error"] = f"Bad item: {type(e).__name__}: {e}"
+
+        for job in jobs:
+            future = job.pop("slogan_future", None)
+            if future is not None:
+                try:
+                    job["slogan"] = future.result()
+                except Exception as e:
+                    job["error"] = f"Slogan failed: {e}"
+            if "error" not in job:
+                job["digest"] = banner_digest(TEMPLATE, job["product_key"], job["product"].name, job["product"].image_link,
+                                              job["slogan"], job["dimensions"], FORMATS[job["format"]][0], job["icon_path"])
+        return jobs
+
+    def _resolve_item(self,
+                      job: Dict[str, Any],
+                      item: Dict[str, Any],
+                      products: Dict[str, Optional[Product]],
+                      users: Dict[str, Optional[User]],
+                      slogan_futures: Dict[Tuple[str, str], concurrent.futures.Future]) -> None:
+        if "_invalid" in item:
+            raise ValueError(item["_invalid"])
+        product = products.get(item.get("product"))
+        user = users.get(item.get("user"))
+        keywords = user.keywords if user is not None else item.get("keywords")
+        if item.get("format", "png") not in FORMATS:
+            job["error"] = f"Unknown format: {item['format']}"
+            return
+        if product is None:
+            job["error"] = f"No such product: {item.get('product')}"
+            return
+        if keywords is None and "slogan" not in item:
+            job["error"] = f"No such user: {item.get('user')}"
+            return
+        dimensions = (int(item["width"]), int(item["height"]))
+        if min(dimensions) <= 0:
+            raise ValueError(f"width and height must be positive, got {dimensions}")
+        job.update(product_key=item["product"],
+                   product=Product(product.name, product.description, product.image_link,
+                                   summary=product.summary, summary_keywords=product.summary_keywords),
+                   dimensions=dimensions,
+                   format=item.get("format", "png"))
+        icon_source = user.embedding if user is not None else None
+        job["icon_path"] = self.icons.icon_for(icon_source, *dimensions) if self.icons is not None else None
+        if "slogan" in item:
+            job["slogan"] = str(item["slogan"])
+            return
+        # slogans are stored per product and keyword segment, generate each one once.
+        # Campaign items are not impressions, they stay out of the request statistics
+        slogan_key = (item["product"], segment_of(keywords))
+        if slogan_key not in slogan_futures:
+            slogan_futures[slogan_key] = self.slogan_pool.submit(
+                get_slogan, self.slogan_store, self.aibox, item["product"], product, keywords, record_stats=False)
+        job["slogan_future"] = slogan_futures[slogan_key]
+
+    def render_batch(self, batch: List[Tuple[int, Dict[str, Any]]]) -> Dict[str, int]:
+        jobs = self._resolve(batch)
+        counts = {"items": len(jobs), "rendered": 0, "reused": 0, "failed": 0}
+        locations: Dict[str, str] = {}
+        futures: Dict[concurrent.futures.Future, Dict[str, Any]] = {}
+        for job in jobs:
+            if "error" in job or job["digest"] in locations:
+                continue
+            stored = self.index.get(job["digest"])
+            if stored is not None:
+                locations[job["digest"]] = stored.decode("utf-8")
+                continue
+            # placeholder, creatives repeated within the batch are submitted once
+            locations[job["digest"]] = ""
+            image_format = FORMATS[job["format"]][0]
+            futures[self.pool.submit(_render_creative, job["product"], job["dimensions"], job["slogan"], image_format,
+                                     job["icon_path"])] = job
+
+        errors: Dict[str, str] = {}
+        for future in concurrent.futures.as_completed(futures):
+            job = futures[future]
+            try:
+                banner = future.result()
+            except Exception as e:
+                errors[job["digest"]] = f"Render failed: {e}"
+                continue
+            name = f"{job['digest'][:2]}/{job['digest']}.{FORMATS[job['format']][1]}"
+            locations[job["digest"]] = self.sink.write(name, banner)
+            counts["rendered"] += 1
+        # the index may only point to durable creatives
+        self.sink.flush()
+        for future, job in futures.items():
+            if job["digest"] not in errors:
+                self.index[job["digest"]] = locations[job["digest"]]
+
+        lines = []
+        for job in jobs:
+            entry = {"id": job["id"], "line": job["line"]}
+            error = job.get("error") or errors.get(job.get("digest"))
+            if error is not None:
+                entry["error"] = error
+                counts["failed"] += 1
+            else:
+                entry.update(digest=job["digest"], location=locations[job["digest"]])
+            lines.append(json.dumps(entry, ensure_ascii=False) + "\n")
+        counts["reused"] = counts["items"] - counts["failed"] - counts["rendered"]
+        with open(self.manifest_path, "a") as manifest:
+            manifest.writelines(lines)
+            manifest.flush()
+            os.fsync(manifest.fileno())
+            self.checkpoint.manifest_size = manifest.tell()
+        return counts
+
+    def run(self, items_path: str) -> Dict[str, int]:
+        totals = {"items": 0, "rendered": 0, "reused": 0, "failed": 0}
+        started = time.monotonic()
+        try:
+            for batch in self._batches(items_path):
+                counts = self.render_batch(batch)
+                for name, count in counts.items():
+                    totals[name] += count
+                self.checkpoint.lines_done = batch[-1][0] + 1
+                if isinstance(self.sink, TarSink):
+                    self.checkpoint.next_part = self.sink.part + 1
+                self.checkpoint.save()
+                rate = totals["items"] / max(time.monotonic() - started, 1e-9)
+                print(f"{self.checkpoint.lines_done} lines processed, {totals['rendered']} rendered, "
+                      f"{totals['reused']} reused, {totals['failed']} failed in this run ({rate:.0f} items/s)")
+        finally:
+            self.sink.close()
+            self.index.close()
+            self.pool.shutdown()
+            self.slogan_pool.shutdown()
+        return totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline batch rendering of campaign banners")
+    parser.add_argument("items", help="JSON lines work items")
+    parser.add_argument("output_dir")
+    parser.add_argument("--output", choices=["dir", "tar"], default="dir")
+    parser.add_argument("--batch", type=int, default=1024)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--slogan-threads", type=int, default=16)
+    parser.add_argument("--tar-size", type=int, default=1 << 30, help="bytes per tar archive")
+    parser.add_argument("--storage", choices=["json", "hash"], default="json")
+    parser.add_argument("--dim", type=int, default=DEFAULT_EMBEDDING_DIM)
+    parser.add_argument("--local-aibox", action="store_true", help="use network-free LocalAIBox slogans")
+    parser.add_argument("--icons", default="icons", help="icon library built by iconlibrary.py")
+    args = parser.parse_args()
+
+    load_dotenv()
+    aibox = LocalAIBox(dimensions=args.dim) if args.local_aibox else OpenAIBox(os.getenv("OPENAI_KEY"), dimensions=args.dim)
+    data_layer = RedisDataLayer.from_env()
+    renderer = BatchRenderer(data_layer.product_store(storage=args.storage, dim=args.dim),
+                             data_layer.user_store(storage=args.storage, dim=args.dim),
+                             RedisSloganStore(data_layer.client),
+                             aibox,
+                             args.output_dir,
+                             output=args.output,
+                             batch_size=args.batch,
+                             workers=args.workers,
+                             slogan_threads=args.slogan_threads,
+                             tar_size=args.tar_size,
+                             icons=IconLibrary(args.icons))
+    totals = renderer.run(args.items)
+    data_layer.close()
+    print(f"Done, {totals['items']} items: {totals['rendered']} rendered, {totals['reused']} reused, {totals['failed']} failed")
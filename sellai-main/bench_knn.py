@@ -0,0 +1,107 @@
+"""
+KNN benchmark of FLAT vs HNSW product indexes on a local Redis Stack.
+
+Fills the database with synthetic normalized product vectors, builds a FLAT and an HNSW index
+over them and reports query latency percentiles and HNSW recall@k against the exact FLAT results
+for several EF_RUNTIME values.
+WARNING: the benchmark writes product:* keys, run it against a scratch instance, e.g.
+    docker run -p 6380:6379 redis/redis-stack-server
+
+Usage: python bench_knn.py [--port 6380] [--products 100000] [--dim 1536] [--queries 200] [--k 10]
+                           [--ef-runtime 10 50 200] [--m 16] [--ef-construction 200] [--flush]
+"""
+import argparse
+import time
+
+import numpy as np
+from redis import Redis
+from redis.commands.search.query import Query
+
+from dbcontrol import HNSWParams, _create_redis_index, pack_vector, wait_for_indexing
+
+
+def fill(redis_client: Redis, n: int, dim: int, rng: np.random.Generator, batch: int = 1000) -> None:
+    for start in range(0, n, batch):
+        vectors = rng.normal(size=(min(batch, n - start), dim)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        pipe = redis_client.pipeline(transaction=False)
+        for i, vector in enumerate(vectors):
+            key = f"product:{start + i + 1}"
+            pipe.hset(key, mapping={
+                "name": key,
+                "description": "synthetic product",
+                "image_link": "img/tea.png",
+                "embedding": pack_vector(vector),
+            })
+        pipe.execute()
+    redis_client.set("product_counter", n)
+
+
+def run_queries(redis_client: Redis, index_name: str, queries: np.ndarray, k: int, ef_runtime=None):
+    latencies, results = [], []
+    for query in queries:
+        started = time.perf_counter()
+        docs = redis_client.ft(index_name).search(*_knn_query(query, k, ef_runtime)).docs
+        latencies.append(time.perf_counter() - started)
+        results.append({doc.id for doc in docs})
+    return np.array(latencies) * 1000, results
+
+
+def _knn_query(vector: np.ndarray, k: int, ef_runtime):
+    ef_clause = "" if ef_runtime is None else " EF_RUNTIME $ef_runtime"
+    query = (Query(f"*=>[KNN {k} @embedding $vec{ef_clause} as score]")
+             .return_fields("score").sort_by("score").paging(0, k).dialect(2))
+    params = {"vec": pack_vector(vector)}
+    if ef_runtime is not None:
+        params["ef_runtime"] = ef_runtime
+    return query, params
+
+
+def report(name: str, latencies: np.ndarray, recall: float) -> None:
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(f"{name:<22} p50 {p50:8.2f} ms  p95 {p95:8.2f} ms  p99 {p99:8.2f} ms  recall {recall:.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FLAT vs HNSW KNN benchmark")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6380)
+    parser.add_argument("--products", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--ef-runtime", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--m", type=int, default=HNSWParams.m)
+    parser.add_argument("--ef-construction", type=int, default=HNSWParams.ef_construction)
+    parser.add_argument("--flush", action="store_true", help="flush the database before filling it")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    redis_client = Redis(host=args.host, port=args.port, decode_responses=True)
+    binary_client = Redis(host=args.host, port=args.port, decode_responses=False)
+    rng = np.random.default_rng(args.seed)
+    if args.flush:
+        redis_client.flushdb()
+    if int(redis_client.get("product_counter") or 0) != args.products:
+        print(f"Filling {args.products} synthetic products")
+        fill(binary_client, args.products, args.dim, rng)
+
+    flat_name, hnsw_name = "benchFlatIdx", f"benchHnswIdx_{args.m}_{args.ef_construction}"
+    for name, hnsw in ((flat_name, None), (hnsw_name, HNSWParams(args.m, args.ef_construction))):
+        try:
+            started = time.perf_counter()
+            _create_redis_index(redis_client, name, "hash", args.dim, hnsw)
+            wait_for_indexing(redis_client, name, poll_interval=5.0)
+            print(f"Built {name} in {time.perf_counter() - started:.1f} s")
+        except RuntimeError:
+            print(f"Reusing existing index {name}")
+
+    queries = rng.normal(size=(args.queries, args.dim)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    flat_latencies, truth = run_queries(redis_client, flat_name, queries, args.k)
+    report("FLAT", flat_latencies, 1.0)
+    for ef_runtime in args.ef_runtime:
+        latencies, found = run_queries(redis_client, hnsw_name, queries, args.k, ef_runtime)
+        recall = np.mean([len(t & f) / max(len(t), 1) for t, f in zip(truth, found)])
+        report(f"HNSW ef_runtime={ef_runtime}", latencies, recall)
@@ -0,0 +1,133 @@
+import os
+import threading
+from typing import Dict, List, Optional
+
+import redis
+from redis import Redis
+
+from aibox import DEFAULT_EMBEDDING_DIM
+from dbcontrol import RedisProductStore, RedisUserStore
+
+
+class KeyAllocator:
+    """
+    Hands out keys from blocks reserved with a single INCRBY, so that creating a document does not
+    need its own INCR round trip. Keys of a block left unused when the process exits are skipped.
+    Thread-safe.
+    """
+    def __init__(self, redis_client: Redis, counter: str, prefix: str, block_size: int = 100) -> None:
+        self.redis_client = redis_client
+        self.counter = counter
+        self.prefix = prefix
+        self.block_size = block_size
+        self._next = 0
+        self._last = -1
+        self._lock = threading.Lock()
+
+    def next_key(self) -> str:
+        with self._lock:
+            if self._next > self._last:
+                self._last = self.redis_client.incrby(self.counter, self.block_size)
+                self._next = self._last - self.block_size + 1
+            key = self.prefix + str(self._next)
+            self._next += 1
+            return key
+
+
+class RedisDataLayer:
+    """
+    Shared, bounded connection pools for everything talking to Redis in a process.
+    There is one pool decoding responses (JSON documents, search results) and one returning raw bytes
+    (packed vectors of the HASH storage format). When all connections are busy, callers wait up to
+    pool_timeout seconds for a free one instead of opening new connections.
+    With product_shards, products live on other instances, each with pools of its own configured
+    like the main ones, see shardedstore.ShardedProductStore. Users and caches stay on the main instance.
+    """
+    def __init__(self,
+                 host: str = "localhost",
+                 port: int = 6379,
+                 db: int = 0,
+                 password: Optional[str] = None,
+                 max_connections: int = 50,
+                 socket_timeout: Optional[float] = 1.0,
+                 socket_connect_timeout: Optional[float] = 1.0,
+                 pool_timeout: Optional[float] = 1.0,
+                 health_check_interval: int = 30,
+                 product_shards: Optional[str] = None) -> None:
+        """
+        :param max_connections: size of each of the two pools
+        :param socket_timeout: seconds to wait for a reply before failing the command
+        :param socket_connect_timeout: seconds to wait for a new connection to be established
+        :param pool_timeout: seconds to wait for a free connection when the pool is exhausted
+        :param product_shards: comma separated host:port[/db] of product shards, products are stored on this instance if None
+        """
+        connection_kwargs = dict(
+            host=host,
+            port=port,
+            db=db,
+            password=password,
+            max_connections=max_connections,
+            timeout=pool_timeout,
+            socket_timeout=socket_timeout,
+            socket_connect_timeout=socket_connect_timeout,
+            health_check_interval=health_check_interval,
+        )
+        self.pool = redis.BlockingConnectionPool(decode_responses=True, **connection_kwargs)
+        self.binary_pool = redis.BlockingConnectionPool(decode_responses=False, **connection_kwargs)
+        self.client = Redis(connection_pool=self.pool)
+        self.binary_client = Redis(connection_pool=self.binary_pool)
+        self.shard_layers: Dict[str, "RedisDataLayer"] = {}
+        if product_shards:
+            from shardedstore import parse_shards
+            for shard_host, shard_port, shard_db in parse_shards(product_shards):
+                self.shard_layers[f"{shard_host}:{shard_port}/{shard_db}"] = RedisDataLayer(
+                    shard_host, shard_port, shard_db, password, max_connections, socket_timeout,
+                    socket_connect_timeout, pool_timeout, health_check_interval)
+
+    @classmethod
+    def from_env(cls) -> "RedisDataLayer":
+        """
+        Reads REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD, REDIS_MAX_CONNECTIONS,
+        REDIS_SOCKET_TIMEOUT, REDIS_SOCKET_CONNECT_TIMEOUT, REDIS_POOL_TIMEOUT and PRODUCT_SHARDS
+        environment variables
+        """
+        return cls(
+            host=os.getenv("REDIS_HOST", "localhost"),
+            port=int(os.getenv("REDIS_PORT", 6379)),
+            db=int(os.getenv("REDIS_DB", 0)),
+            password=os.getenv("REDIS_PASSWORD"),
+            max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", 50)),
+            socket_timeout=float(os.getenv("REDIS_SOCKET_TIMEOUT", 1.0)),
+            socket_connect_timeout=float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", 1.0)),
+            pool_timeout=float(os.getenv("REDIS_POOL_TIMEOUT", 1.0)),
+            product_shards=os.getenv("PRODUCT_SHARDS"),
+        )
+
+    def product_store(self, storage: str = "json", dim: int = DEFAULT_EMBEDDING_DIM, **kwargs) -> RedisProductStore:
+        """
+        Store of this instance, or a shardedstore.ShardedProductStore over the product shards.
+        A local_index covers the whole catalog, it is consulted before the shards rather than by each of them
+        """
+        if self.shard_layers:
+            from shardedstore import ShardedProductStore
+            local_index = kwargs.pop("local_index", None)
+            return ShardedProductStore({name: layer.product_store(storage=storage, dim=dim, **kwargs)
+                                        for name, layer in self.shard_layers.items()}, local_index=local_index)
+        return RedisProductStore(self.client, storage=storage, dim=dim, binary_client=self.binary_client, **kwargs)
+
+    def user_store(self, storage: str = "json", dim: int = DEFAULT_EMBEDDING_DIM, key_block_size: int = 100) -> RedisUserStore:
+        return RedisUserStore(self.client, storage=storage, dim=dim, binary_client=self.binary_client,
+                              key_allocator=KeyAllocator(self.client, "user_counter", "user:", key_block_size))
+
+    def transaction(self, binary: bool = False) -> redis.client.Pipeline:
+        """
+        Returns a MULTI/EXEC pipeline: queued writes are sent in one round trip and applied atomically.
+        Use as a context manager and call execute() at the end
+        """
+        return (self.binary_client if binary else self.client).pipeline(transaction=True)
+
+    def close(self) -> None:
+        self.pool.disconnect()
+        self.binary_pool.disconnect()
+        for layer in self.shard_layers.values():
+            layer.close()
@@ -2,20 +2,116 @@ import json
 import jsonschema
 import redis
 from redis import Redis
-from redis.commands.search.field import TextField, VectorField
+from redis.commands.search.field import NumericField, TagField, TextField, VectorField
 from redis.commands.search.indexDefinition import IndexDefinition, IndexType
 from redis.commands.search import Search
 from redis.commands.search.query import Query
 from openai import OpenAI
 import numpy as np
 from PIL import Image
-from typing import Dict, Optional, Tuple, Any
+from typing import Dict, List, Optional, Tuple, Any
 from dotenv import load_dotenv
+import collections
 import datetime
-from aibox import AIBox
+import hashlib
+import threading
+import time
+from dataclasses import dataclass, field
+from aibox import AIBox, DEFAULT_EMBEDDING_DIM
+from metrics import record_cache, timed
 
 # FT.CREATE productIdx ON JSON PREFIX 1 product: SCHEMA $.description AS description TEXT $.image_link AS image_link TEXT $.embedding AS embedding VECTOR FLAT 6 TYPE FLOAT32 DIM 1536 DISTANCE_METRIC COSINE
 
+def _embedding_schema(dim: int) -> Dict[str, Any]:
+    return {
+        "type": "array",
+        "items": {
+            "type": "number"
+        },
+        "minItems": dim,
+        "maxItems": dim
+    }
+
+
+def with_embedding_dim(schema: Dict[str, Any], dim: int) -> Dict[str, Any]:
+    """
+    Returns a copy of storage schema which expects embeddings of given dimension
+    """
+    properties = dict(schema["properties"])
+    properties["embedding"] = _embedding_schema(dim)
+    return {**schema, "properties": properties}
+
+
+# Optional product attributes indexed as TAG/NUMERIC fields for filtered KNN queries
+product_attribute_properties = {
+    "category": {
+        "type": "string"
+    },
+    "advertiser": {
+        "type": "string"
+    },
+    "in_stock": {
+        "type": "integer",
+        "enum": [0, 1]
+    },
+}
+
+# Compact prompt context generated at ingest time, keywords are stored comma separated
+product_summary_properties = {
+    "summary": {
+        "type": "string"
+    },
+    "summary_keywords": {
+        "type": "string"
+    },
+}
+
+DEFAULT_SUMMARY_WORDS = 30
+DEFAULT_SUMMARY_KEYWORDS = 8
+
+# stream of keys of written and deleted products, followed by vectorindex.MmapVectorIndexWriter
+PRODUCT_CHANGES = "product_changes"
+PRODUCT_CHANGES_MAXLEN = 1000000
+
+# embedding writes of the refresh scheduler only touch users that still exist, a user deleted
+# meanwhile would otherwise come back as a partial record. KEYS: user, users:refreshed
+# ARGV: refresh timestamp, then field/value pairs (HSET) or path/JSON value pairs (JSON.SET)
+_WRITE_HASH_EMBEDDING_SCRIPT = """
+if redis.call("exists", KEYS[1]) == 0 then
+    return 0
+end
+redis.call("hset", KEYS[1], unpack(ARGV, 2))
+redis.call("zadd", KEYS[2], ARGV[1], KEYS[1])
+return 1
+"""
+_WRITE_JSON_EMBEDDING_SCRIPT = """
+if redis.call("exists", KEYS[1]) == 0 then
+    return 0
+end
+for i = 2, #ARGV, 2 do
+    redis.call("JSON.SET", KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call("zadd", KEYS[2], ARGV[1], KEYS[1])
+return 1
+"""
+
+
+def split_keywords(value: Optional[str]) -> Optional[List[str]]:
+    """Parses keywords stored comma separated"""
+    if value is None:
+        return None
+    return [keyword.strip() for keyword in value.split(",") if keyword.strip()]
+
+
+def summary_prompt(description: str, summary: Optional[str], summary_keywords: Optional[List[str]]) -> str:
+    """Product text sent to the LLM, the compact summary where one was generated"""
+    if not summary:
+        return description
+    if summary_keywords:
+        return f"{summary} Keywords: {', '.join(summary_keywords)}"
+    return summary
+
+
 # Schemas
 input_product_schema = {
     "$schema": "http://json-schema.org/draft-07/schema#",
@@ -31,6 +127,8 @@ input_product_schema = {
             "type": "string",
             "format": "uri"
         },
+        **product_attribute_properties,
+        **product_summary_properties,
     },
     "required": ["name", "description", "image_link"],
 }
@@ -49,14 +147,9 @@ storage_product_schema = {
             "type": "string",
             "format": "uri"
         },
-        "embedding": {
-            "type": "array",
-            "items": {
-                "type": "number"
-            },
-            "minItems": 1536,
-            "maxItems": 1536
-        }
+        "embedding": _embedding_schema(DEFAULT_EMBEDDING_DIM),
+        **product_attribute_properties,
+        **product_summary_properties,
     },
     "required": ["name", "description", "image_link", "embedding"],
 }
@@ -71,27 +164,80 @@ user_schema = {
                 "type": "string",
             }
         },
-        "embedding": {
-            "type": "array",
-            "items": {
+        "keyword_weights": {
+            "type": "object",
+            "additionalProperties": {
                 "type": "number"
-            },
-            "minItems": 1536,
-            "maxItems": 1536
+            }
         },
+        "embedding": _embedding_schema(DEFAULT_EMBEDDING_DIM),
         # last_refreshed_db lets know when the user object was last refreshed
         "last_refreshed": {
-            "type": "string",
+            "type": ["string", "null"],
+            "format": "date-time",
+        },
+        # time keyword weights were last decayed to
+        "updated_at": {
+            "type": ["string", "null"],
             "format": "date-time",
+        },
+        "embedding_norm": {
+            "type": ["number", "null"]
+        },
+        "embedding_version": {
+            "type": "integer"
+        },
+        "embedded_keywords_digest": {
+            "type": ["string", "null"]
         }
     },
     "required": ["keywords"],
 }
 
 
-def _create_redis_index(redis_client: Redis, index_name) -> None:
+# Schemas for the HASH storage format. Embeddings are validated with validate_vector instead
+product_metadata_schema = {
+    "$schema": "http://json-schema.org/draft-07/schema#",
+    "type": "object",
+    "properties": {
+        key: value for key, value in storage_product_schema["properties"].items() if key != "embedding"
+    },
+    "required": ["name", "description", "image_link"],
+}
+
+user_metadata_schema = {
+    "$schema": "http://json-schema.org/draft-07/schema#",
+    "type": "object",
+    "properties": {
+        key: value for key, value in user_schema["properties"].items() if key != "embedding"
+    },
+    "required": ["keywords"],
+}
+
+
+@dataclass
+class HNSWParams:
+    """
+    Parameters of an HNSW vector index.
+    m: maximum number of graph edges per node, ef_construction: candidate list size while building,
+    ef_runtime: default candidate list size while querying, can be overridden per query
+    """
+    m: int = 16
+    ef_construction: int = 200
+    ef_runtime: int = 10
+
+
+def _create_redis_index(redis_client: Redis, 
+                        index_name, 
+                        storage: str = "json", 
+                        dim: int = DEFAULT_EMBEDDING_DIM,
+                        hnsw: Optional[HNSWParams] = None) -> None:
     """
     Throws exception if index already exists
+    :param storage: "json" for products stored as JSON documents, "hash" for products stored 
+                    as HASHes with packed float32 embedding
+    :param dim: dimension of product embeddings
+    :param hnsw: builds an HNSW index with these parameters, FLAT (brute force) index is built if None
     """
     try:
         # Check if the index already exists
@@ -103,18 +249,42 @@ def _create_redis_index(redis_client: Redis, index_name) -> None:
             pass  # If it raises an error, the index does not exist
 
         # Define the index schema
-        
-        schema = (
-            TextField("$.name", as_name="name"),
-            TextField("$.description", as_name="description"),
-            TextField("$.image_link", as_name="image_link"),
-            VectorField("$.embedding", as_name="embedding", 
-                        algorithm="FLAT", 
-                        attributes={"TYPE": "FLOAT32", "DIM": 1536, "DISTANCE_METRIC": "COSINE", "INITIAL_CAP": 1000})
-        )
+        vector_attributes = {"TYPE": "FLOAT32", "DIM": dim, "DISTANCE_METRIC": "COSINE", "INITIAL_CAP": 1000}
+        algorithm = "FLAT"
+        if hnsw is not None:
+            algorithm = "HNSW"
+            vector_attributes.update({"M": hnsw.m, "EF_CONSTRUCTION": hnsw.ef_construction, "EF_RUNTIME": hnsw.ef_runtime})
+        if storage == "json":
+            schema = (
+                TextField("$.name", as_name="name"),
+                TextField("$.description", as_name="description"),
+                TextField("$.image_link", as_name="image_link"),
+                TagField("$.category", as_name="category"),
+                TagField("$.advertiser", as_name="advertiser"),
+                NumericField("$.in_stock", as_name="in_stock"),
+                VectorField("$.embedding", as_name="embedding", 
+                            algorithm=algorithm, 
+                            attributes=vector_attributes)
+            )
+            index_type = IndexType.JSON
+        elif storage == "hash":
+            schema = (
+                TextField("name"),
+                TextField("description"),
+                TextField("image_link"),
+                TagField("category"),
+                TagField("advertiser"),
+                NumericField("in_stock"),
+                VectorField("embedding",
+                            algorithm=algorithm,
+                            attributes=vector_attributes)
+            )
+            index_type = IndexType.HASH
+        else:
+            raise ValueError(f"Unknown storage format '{storage}'")
 
         # Create the index
-        search_client.create_index(schema, definition=IndexDefinition(prefix=["product:"], index_type=IndexType.JSON))
+        search_client.create_index(schema, definition=IndexDefinition(prefix=["product:"], index_type=index_type))
         print(f"Index '{index_name}' created successfully.")
         
     except Exception as e:
@@ -122,22 +292,205 @@ def _create_redis_index(redis_client: Redis, index_name) -> None:
         raise RuntimeError(f"Failed to create index '{index_name}': {e}")
 
 
+def index_hnsw_params(redis_client: Redis, index_name: str) -> Optional[HNSWParams]:
+    """
+    HNSW parameters of the vector field of an index or alias from FT.INFO, None for a FLAT index.
+    Parameters FT.INFO does not report keep their HNSWParams defaults
+    """
+    for attribute in redis_client.ft(index_name).info()["attributes"]:
+        fields = {str(name).lower(): value for name, value in zip(attribute[::2], attribute[1::2])}
+        if str(fields.get("type")).upper() != "VECTOR":
+            continue
+        if str(fields.get("algorithm")).upper() != "HNSW":
+            return None
+        defaults = HNSWParams()
+        return HNSWParams(m=int(fields.get("m", defaults.m)),
+                          ef_construction=int(fields.get("ef_construction", defaults.ef_construction)),
+                          ef_runtime=int(fields.get("ef_runtime", defaults.ef_runtime)))
+    return None
+
+
+def wait_for_indexing(redis_client: Redis, index_name: str, timeout: float = 3600, poll_interval: float = 1.0) -> None:
+    """
+    Blocks until the index has finished its background scan of existing keys.
+    Throws TimeoutError if it takes longer than timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        info = redis_client.ft(index_name).info()
+        if int(info["indexing"]) == 0:
+            return
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Index '{index_name}' is still indexing after {timeout} seconds")
+        print(f"{index_name}: {float(info['percent_indexed']) * 100:.1f}% indexed")
+        time.sleep(poll_interval)
+
+
+def swap_index_alias(redis_client: Redis, alias: str, new_index: str) -> Optional[str]:
+    """
+    Points alias at new_index and returns the name of the index it resolved to before, None if nothing.
+    If alias is itself a real index (productIdx created by older versions is), that index is dropped
+    without its documents and replaced by the alias in a single MULTI/EXEC transaction,
+    so queries against alias never see a missing index.
+    """
+    try:
+        current = redis_client.ft(alias).info()["index_name"]
+    except redis.exceptions.ResponseError:
+        current = None
+
+    if current == new_index:
+        return current
+    if current is None:
+        redis_client.ft(new_index).aliasadd(alias)
+    elif current == alias:
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.execute_command("FT.DROPINDEX", alias)
+        pipe.execute_command("FT.ALIASADD", alias, new_index)
+        pipe.execute()
+    else:
+        redis_client.ft(new_index).aliasupdate(alias)
+    return current
+
+
+def validate_vector(vector: np.ndarray, dim: Optional[int] = DEFAULT_EMBEDDING_DIM) -> None:
+    """
+    Checks that vector is a finite one-dimensional float array of length dim.
+    This replaces per-element jsonschema validation of embeddings.
+    :param dim: expected length, None accepts any length
+    """
+    if not isinstance(vector, np.ndarray):
+        raise ValueError(f"Embedding should be a numpy array, got {type(vector).__name__}")
+    if vector.ndim != 1 or (dim is not None and vector.shape != (dim,)):
+        raise ValueError(f"Embedding should have shape ({dim},), got {vector.shape}")
+    if vector.dtype.kind != "f":
+        raise ValueError(f"Embedding should have floating point dtype, got {vector.dtype}")
+    if not np.all(np.isfinite(vector)):
+        raise ValueError("Embedding contains NaN or infinite values")
+
+
+def pack_vector(vector: np.ndarray) -> bytes:
+    """Packs vector into little-endian float32 bytes, the layout RediSearch expects"""
+    return np.asarray(vector, dtype="<f4").tobytes()
+
+
+def unpack_vector(data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype="<f4")
+
+
+def _binary_client(redis_client: Redis) -> Redis:
+    """
+    Returns a client talking to the same server which does not decode responses,
+    so that packed vectors can be read back. Reuses redis_client if it does not decode.
+    """
+    pool = redis_client.connection_pool
+    if not pool.connection_kwargs.get("decode_responses"):
+        return redis_client
+    kwargs = dict(pool.connection_kwargs)
+    kwargs["decode_responses"] = False
+    return Redis(connection_pool=redis.ConnectionPool(connection_class=pool.connection_class, **kwargs))
+
 
 class Product:
-    def __init__(self, name: str, description: str, image_link: str, embedding: Optional[np.ndarray] = None) -> None:
+    def __init__(self, 
+                 name: str, 
+                 description: str, 
+                 image_link: str, 
+                 embedding: Optional[np.ndarray] = None,
+                 category: Optional[str] = None,
+                 advertiser: Optional[str] = None,
+                 in_stock: bool = True,
+                 summary: Optional[str] = None,
+                 summary_keywords: Optional[List[str]] = None) -> None:
+        """
+        :param summary: compact description used in prompts instead of the full one, see summarize
+        :param summary_keywords: keywords of the description used in prompts together with the summary
+        """
         self.name = name
         self.description = description
         self.image_link = image_link
         self.embedding = embedding
+        self.category = category
+        self.advertiser = advertiser
+        self.in_stock = in_stock
+        self.summary = summary
+        self.summary_keywords = summary_keywords
+
+    def _attributes(self) -> Dict[str, Any]:
+        """Filterable attributes, unset ones are left out so that the document lacks the field"""
+        attributes = {"in_stock": int(self.in_stock)}
+        if self.category is not None:
+            attributes["category"] = self.category
+        if self.advertiser is not None:
+            attributes["advertiser"] = self.advertiser
+        return attributes
+
+    def _summary_fields(self) -> Dict[str, str]:
+        fields = {}
+        if self.summary is not None:
+            fields["summary"] = self.summary
+        if self.summary_keywords is not None:
+            fields["summary_keywords"] = ", ".join(self.summary_keywords)
+        return fields
 
     def to_dict(self) -> Dict[str, Any]:
         return {
             "name": self.name,
             "description": self.description,
             "image_link": self.image_link,
-            "embedding": self.embedding.tolist() if self.embedding is not None else None
+            "embedding": self.embedding.tolist() if self.embedding is not None else None,
+            **self._attributes(),
+            **self._summary_fields()
+        }
+
+    def to_hash(self) -> Dict[str, Any]:
+        """
+        Returns HASH fields of the product, embedding is packed into float32 bytes
+        """
+        validate_vector(self.embedding, dim=None)
+        return {
+            "name": self.name,
+            "description": self.description,
+            "image_link": self.image_link,
+            "embedding": pack_vector(self.embedding),
+            **self._attributes(),
+            **self._summary_fields()
         }
 
+    @classmethod
+    def from_hash(cls, hash_data: Dict[bytes, bytes]) -> "Product":
+        """
+        Builds product from HASH fields read by a client that does not decode responses
+        """
+        return cls(
+            name=hash_data[b'name'].decode("utf-8"),
+            description=hash_data[b'description'].decode("utf-8"),
+            image_link=hash_data[b'image_link'].decode("utf-8"),
+            embedding=unpack_vector(hash_data[b'embedding']) if b'embedding' in hash_data else None,
+            category=hash_data[b'category'].decode("utf-8") if b'category' in hash_data else None,
+            advertiser=hash_data[b'advertiser'].decode("utf-8") if b'advertiser' in hash_data else None,
+            in_stock=hash_data.get(b'in_stock', b'1') == b'1',
+            summary=hash_data[b'summary'].decode("utf-8") if b'summary' in hash_data else None,
+            summary_keywords=split_keywords(hash_data[b'summary_keywords'].decode("utf-8")) if b'summary_keywords' in hash_data else None
+        )
+
+    @classmethod
+    def from_storage_dict(cls, data: Dict[str, Any]) -> "Product":
+        """
+        Builds product from a document stored in the JSON format, without validation
+        """
+        embedding = data.get("embedding")
+        return cls(
+            name=data["name"],
+            description=data["description"],
+            image_link=data["image_link"],
+            embedding=np.array(embedding) if embedding is not None else None,
+            category=data.get("category"),
+            advertiser=data.get("advertiser"),
+            in_stock=bool(data.get("in_stock", 1)),
+            summary=data.get("summary"),
+            summary_keywords=split_keywords(data.get("summary_keywords"))
+        )
+
     @classmethod
     def from_json(cls, json_data: Dict[str, Any]) -> "Product":
         jsonschema.validate(json_data, input_product_schema)
@@ -145,7 +498,12 @@ class Product:
         return cls(
             name=json_data['name'],
             description=json_data['description'],
-            image_link=json_data['image_link']
+            image_link=json_data['image_link'],
+            category=json_data.get('category'),
+            advertiser=json_data.get('advertiser'),
+            in_stock=bool(json_data.get('in_stock', 1)),
+            summary=json_data.get('summary'),
+            summary_keywords=split_keywords(json_data.get('summary_keywords'))
         )
 
     def refresh(self, aibox: AIBox) -> None:
@@ -153,6 +511,16 @@ class Product:
         text = self.description.replace("\n", " ")
         self.embedding = aibox.embedding_from_text(text)
 
+    def summarize(self, aibox: AIBox, max_words: int = DEFAULT_SUMMARY_WORDS, num_keywords: int = DEFAULT_SUMMARY_KEYWORDS) -> None:
+        """Generates the compact summary and keywords used in prompts instead of the full description"""
+        text = self.description.replace("\n", " ")
+        self.summary = aibox.summary(text, max_words)
+        self.summary_keywords = [keyword.strip() for keyword in aibox.keywords(text, num_keywords) if keyword.strip()]
+
+    def prompt_description(self) -> str:
+        """Description for LLM prompts: the summary with its keywords if generated, the full description otherwise"""
+        return summary_prompt(self.description, self.summary, self.summary_keywords)
+
     def save_image(self, key: str) -> None:
         """
         Takes image key as an input and saves image to image storage database
@@ -163,11 +531,93 @@ class Product:
         self.image_link = location
 
 
+@dataclass
+class ProductMatch:
+    """One KNN result, score is cosine distance (lower is closer)"""
+    key: str
+    name: Optional[str]
+    description: str
+    image_link: str
+    score: float
+    summary: Optional[str] = None
+    summary_keywords: Optional[List[str]] = None
+
+    def to_product(self) -> Product:
+        """Product with the fields needed to render and write slogans, without embedding and attributes"""
+        return Product(self.name or "", self.description, self.image_link,
+                       summary=self.summary, summary_keywords=self.summary_keywords)
+
+
+def _escape_tag(value: str) -> str:
+    """Escapes punctuation and spaces which have special meaning inside a TAG query"""
+    return "".join("\\" + char if not char.isalnum() and char != "_" else char for char in value)
+
+
+@dataclass
+class ProductFilter:
+    """
+    Pre-filter for KNN queries evaluated inside productIdx.
+    Products saved before the attribute fields were added to the index need a rebuild 
+    (rebuild_index.py) to be matched by filters
+    """
+    categories: List[str] = field(default_factory=list)
+    advertisers: List[str] = field(default_factory=list)
+    blocked_advertisers: List[str] = field(default_factory=list)
+    in_stock_only: bool = False
+
+    def is_empty(self) -> bool:
+        return not (self.categories or self.advertisers or self.blocked_advertisers or self.in_stock_only)
+
+    def to_query(self) -> str:
+        clauses = []
+        if self.categories:
+            clauses.append("@category:{" + " | ".join(_escape_tag(c) for c in self.categories) + "}")
+        if self.advertisers:
+            clauses.append("@advertiser:{" + " | ".join(_escape_tag(a) for a in self.advertisers) + "}")
+        if self.blocked_advertisers:
+            clauses.append("-@advertiser:{" + " | ".join(_escape_tag(a) for a in self.blocked_advertisers) + "}")
+        if self.in_stock_only:
+            clauses.append("@in_stock:[1 1]")
+        if not clauses:
+            return "*"
+        return "(" + " ".join(clauses) + ")"
+
+
 class RedisProductStore:
-    def __init__(self, redis_client: Redis) -> None:
+    def __init__(self, 
+                 redis_client: Redis, 
+                 storage: str = "json", 
+                 dim: int = DEFAULT_EMBEDDING_DIM,
+                 hnsw: Optional[HNSWParams] = None,
+                 index_name: str = "productIdx",
+                 local_index = None,
+                 binary_client: Optional[Redis] = None,
+                 image_store = None) -> None:
+        """
+        :param storage: "json" stores products as JSON documents with embedding as float array,
+                        "hash" stores them as HASHes with embedding packed into float32 bytes.
+                        See migrate_vectors.py for converting existing keys.
+        :param dim: embedding dimension, should match dimensions of the AIBox used for saving
+        :param hnsw: parameters of HNSW index created if the index does not exist yet, FLAT if None.
+                     See rebuild_index.py for converting an existing index
+        :param index_name: name or alias of the product index
+        :param local_index: optional vectorindex.MmapVectorIndex answering KNN queries in-process.
+                            Redis index is used whenever the local one cannot answer
+        :param binary_client: client without response decoding for the HASH format, 
+                              e.g. from datalayer.RedisDataLayer. Created from redis_client if None
+        :param image_store: optional imagestore.ImageStore keeping deduplicated pre-scaled image variants,
+                            images are copied to db-img/<key>.png if None
+        """
         self.redis_client = redis_client
+        self.storage = storage
+        self.dim = dim
+        self.index_name = index_name
+        self.local_index = local_index
+        self.image_store = image_store
+        self.storage_schema = with_embedding_dim(storage_product_schema, dim)
+        self.binary_client = (binary_client or _binary_client(redis_client)) if storage == "hash" else None
         try:
-            _create_redis_index(self.redis_client, "productIdx")
+            _create_redis_index(self.redis_client, index_name, storage, dim, hnsw)
         except RuntimeError:
             print("RedisProductStore: product index already exists, skipping creation")        
 
@@ -178,101 +628,691 @@ class RedisProductStore:
         """
         return "product:" + str(self.redis_client.incr("product_counter"))
 
-    def save_product(self, product: Product, aibox: AIBox) -> None:
+    def save_product(self, product: Product, aibox: AIBox, key: Optional[str] = None, summarize: bool = False) -> str:
         """
-        Saves product object to database 
+        Saves product object to database and returns its key
+        :param key: key allocated elsewhere, e.g. by shardedstore.ShardedProductStore. A new one if None
+        :param summarize: also generate the prompt summary unless the product has one already, one more AIBox call
         """
         # Generate embedding
         product.refresh(aibox)
+        if summarize and product.summary is None:
+            product.summarize(aibox)
 
         # Validate product
-        storage_product_dict = product.to_dict()
-        jsonschema.validate(storage_product_dict, storage_product_schema)
+        if self.storage == "hash":
+            validate_vector(product.embedding, self.dim)
+            jsonschema.validate({"name": product.name, "description": product.description, "image_link": product.image_link,
+                                 **product._attributes()},
+                                product_metadata_schema)
+        else:
+            storage_product_dict = product.to_dict()
+            jsonschema.validate(storage_product_dict, self.storage_schema)
 
         # Save image and update link
-        key = self.__get_next_product_key()
-        product.save_image("db-img/" + key + ".png")
+        if key is None:
+            key = self.__get_next_product_key()
+        if self.image_store is not None:
+            product.image_link = self.image_store.put(product.image_link)
+        else:
+            product.save_image("db-img/" + key + ".png")
 
         # Save product to Redis
-        self.redis_client.json().set(key, "$", storage_product_dict)
+        if self.storage == "hash":
+            pipe = self.binary_client.pipeline(transaction=True)
+            pipe.hset(key, mapping=product.to_hash())
+        else:
+            storage_product_dict["image_link"] = product.image_link
+            pipe = self.redis_client.pipeline(transaction=True)
+            pipe.json().set(key, "$", storage_product_dict)
+        self._queue_changes(pipe, [key])
+        pipe.execute()
+        return key
+
+    @staticmethod
+    def _queue_changes(pipe, keys: List[str]) -> None:
+        """Queues the catalog version bump and change log entries of written or deleted products"""
+        pipe.incr("catalog_version")
+        for key in keys:
+            pipe.xadd(PRODUCT_CHANGES, {"key": key}, maxlen=PRODUCT_CHANGES_MAXLEN, approximate=True)
+
+    def catalog_version(self) -> int:
+        """
+        Counter increased by every change of the catalog, results cached for an older version may be outdated
+        """
+        return int(self.redis_client.get("catalog_version") or 0)
+
+    def bump_catalog_version(self) -> int:
+        return self.redis_client.incr("catalog_version")
+
+    def delete_product(self, key: str) -> bool:
+        """
+        Removes product from database, returns False if there was no such key
+        """
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.delete(key)
+        self._queue_changes(pipe, [key])
+        return bool(pipe.execute()[0])
+
+    def allocate_product_keys(self, count: int) -> List[str]:
+        """
+        Reserves count consecutive product keys with a single INCRBY
+        """
+        last = self.redis_client.incrby("product_counter", count)
+        return ["product:" + str(i) for i in range(last - count + 1, last + 1)]
+
+    def write_products(self, keys: List[str], products: List[Product]) -> None:
+        """
+        Validates products and writes them under given keys in one pipeline.
+        Unlike save_product, expects embeddings to be generated and images to be saved already
+        """
+        client = self.binary_client if self.storage == "hash" else self.redis_client
+        pipe = client.pipeline(transaction=False)
+        for key, product in zip(keys, products):
+            if self.storage == "hash":
+                validate_vector(product.embedding, self.dim)
+                jsonschema.validate({"name": product.name, "description": product.description, "image_link": product.image_link,
+                                     **product._attributes()},
+                                    product_metadata_schema)
+                pipe.hset(key, mapping=product.to_hash())
+            else:
+                storage_product_dict = product.to_dict()
+                jsonschema.validate(storage_product_dict, self.storage_schema)
+                pipe.json().set(key, "$", storage_product_dict)
+        self._queue_changes(pipe, keys)
+        pipe.execute()
+
+    def scan_product_keys(self, count: int) -> List[str]:
+        """Up to count product keys in no particular order, without blocking the server"""
+        keys = []
+        for key in self.redis_client.scan_iter(match="product:*", count=1000):
+            keys.append(key)
+            if len(keys) >= count:
+                break
+        return keys
 
-    def find_similar_from_embedding(self, embedding: np.ndarray, k: int, vector_field: str) -> Tuple[str, str]:
+    def get_product(self, key: str) -> Optional[Product]:
+        """
+        Loads product object from database, returns None if there is no such key
+        """
+        if self.storage == "hash":
+            hash_data = self.binary_client.hgetall(key)
+            return Product.from_hash(hash_data) if hash_data else None
+
+        data = self.redis_client.json().get(key)
+        return Product.from_storage_dict(data) if data is not None else None
+
+    def get_products(self, keys: List[str]) -> List[Optional[Product]]:
+        """
+        Loads several products in one round trip (JSON.MGET or pipelined HGETALL).
+        Returns None in place of missing keys
+        """
+        if not keys:
+            return []
+        if self.storage == "hash":
+            pipe = self.binary_client.pipeline(transaction=False)
+            for key in keys:
+                pipe.hgetall(key)
+            return [Product.from_hash(data) if data else None for data in pipe.execute()]
+
+        documents = self.redis_client.json().mget(keys, "$")
+        return [Product.from_storage_dict(document[0]) if document else None for document in documents]
+
+    def _fetch_matches(self, scored_keys: List[Tuple[str, float]]) -> List["ProductMatch"]:
+        """
+        Loads name, description and image link of scored keys in one round trip, skips missing keys.
+        Also used by shardedstore.ShardedProductStore for keys of this shard
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key, _ in scored_keys:
+            if self.storage == "hash":
+                pipe.hmget(key, "name", "description", "image_link", "summary", "summary_keywords")
+            else:
+                pipe.json().get(key, "$.name", "$.description", "$.image_link", "$.summary", "$.summary_keywords")
+        matches = []
+        for (key, score), fields in zip(scored_keys, pipe.execute()):
+            if fields is None:
+                continue
+            if self.storage == "hash":
+                name, description, image_link, summary, summary_keywords = fields
+            else:
+                name, description, image_link, summary, summary_keywords = (
+                    fields[path][0] if fields.get(path) else None
+                    for path in ("$.name", "$.description", "$.image_link", "$.summary", "$.summary_keywords"))
+            if description is None or image_link is None:
+                continue
+            matches.append(ProductMatch(key, name, description, image_link, score, summary, split_keywords(summary_keywords)))
+        return matches
+
+    def __find_similar_locally(self, embedding: np.ndarray, k: int) -> Optional[List["ProductMatch"]]:
+        """
+        Answers the query from the local index. Returns None if it cannot, e.g. when the index 
+        is empty or its matches have been removed from Redis since the index was published
+        """
+        try:
+            with timed("knn_local"):
+                matches = self._fetch_matches(self.local_index.search(embedding, k)[0])
+            if matches:
+                return matches
+        except Exception as e:
+            print(f"RedisProductStore: local index failed, falling back to Redis: {e}")
+        return None
+
+    def find_similar_from_embedding(self, 
+                                    embedding: np.ndarray, 
+                                    k: int, 
+                                    vector_field: str, 
+                                    ef_runtime: Optional[int] = None,
+                                    filters: Optional["ProductFilter"] = None) -> List["ProductMatch"]:
+        """
+        Returns up to k products closest to embedding, ranked by cosine distance (lower is closer)
+        :param ef_runtime: HNSW candidate list size for this query, overrides the index default.
+                           Only valid for HNSW indexes, queries with it always go to Redis
+        :param filters: pre-filter applied inside the index before KNN. Filtered queries always go to Redis
+        """
+        if self.local_index is not None and ef_runtime is None and (filters is None or filters.is_empty()):
+            local_result = self.__find_similar_locally(embedding, k)
+            if local_result is not None:
+                return local_result
+
+        prefilter = filters.to_query() if filters is not None else "*"
+        ef_clause = "" if ef_runtime is None else " EF_RUNTIME $ef_runtime"
         query: Query = (
-            Query(f"*=>[KNN {k} @{vector_field} $vec as score]")
-            .return_fields("description", "image_link", "score")
+            Query(f"{prefilter}=>[KNN {k} @{vector_field} $vec{ef_clause} as score]")
+            .return_fields("name", "description", "image_link", "score")
+            .return_field("$.summary" if self.storage == "json" else "summary", as_field="summary")
+            .return_field("$.summary_keywords" if self.storage == "json" else "summary_keywords", as_field="summary_keywords")
             .sort_by("score")
             .paging(0, k)
             .dialect(2)
         )
 
-        query_params: Dict[str, bytes] = {
+        query_params: Dict[str, Any] = {
             "vec": embedding.astype(np.float32).tobytes()
         }
+        if ef_runtime is not None:
+            query_params["ef_runtime"] = ef_runtime
 
-        res = self.redis_client.ft("productIdx").search(query, query_params).docs
+        with timed("knn"):
+            res = self.redis_client.ft(self.index_name).search(query, query_params).docs
         if not res:
             raise RuntimeError("Failed to retrieve any matching documents from Redis index")
-        return res[0].description, res[0].image_link
+        return [ProductMatch(doc.id, getattr(doc, "name", None), doc.description, doc.image_link, float(doc.score),
+                             getattr(doc, "summary", None), split_keywords(getattr(doc, "summary_keywords", None)))
+                for doc in res]
     
 
 class User:
-    def __init__(self, keywords, embedding: Optional[np.ndarray], last_refreshed = datetime.datetime.now()) -> None:
-        self.keywords = keywords
+    # profile keeps at most this many keywords, the lowest weighted ones are evicted first
+    MAX_KEYWORDS = 50
+    # time after which weight of a keyword that was not pushed again halves
+    KEYWORD_HALF_LIFE = datetime.timedelta(days=7)
+
+    def __init__(self, 
+                 keywords, 
+                 embedding: Optional[np.ndarray], 
+                 last_refreshed = datetime.datetime.now(),
+                 keyword_weights: Optional[Dict[str, float]] = None,
+                 updated_at: Optional[datetime.datetime] = None,
+                 embedding_norm: Optional[float] = None,
+                 embedding_version: int = 0,
+                 embedded_keywords_digest: Optional[str] = None) -> None:
+        """
+        :param keywords: used when keyword_weights is not given, every keyword gets weight 1
+        :param keyword_weights: deduplicated keyword -> weight, weights are as of updated_at
+        :param embedding_norm: norm of the weighted keyword embedding sum the embedding was normalized from,
+                               None if the embedding was not built incrementally
+        :param embedding_version: increases every time the embedding changes
+        :param embedded_keywords_digest: keywords_digest() of the keyword set the embedding was computed for
+        """
+        if keyword_weights is None:
+            keyword_weights = {}
+            for keyword in keywords:
+                normalized = self.normalize_keyword(keyword)
+                if normalized:
+                    keyword_weights[normalized] = keyword_weights.get(normalized, 0.0) + 1.0
+        self.keyword_weights = keyword_weights
         self.embedding = embedding
         self.last_refreshed = last_refreshed
-        
+        self.updated_at = updated_at
+        self.embedding_norm = embedding_norm
+        self.embedding_version = embedding_version
+        self.embedded_keywords_digest = embedded_keywords_digest
+
+    @staticmethod
+    def normalize_keyword(keyword: str) -> str:
+        return " ".join(keyword.lower().split())
+
+    @property
+    def keywords(self) -> List[str]:
+        """Keywords ordered by weight, heaviest first"""
+        return sorted(self.keyword_weights, key=lambda keyword: self.keyword_weights[keyword], reverse=True)
+
+    def keywords_digest(self) -> str:
+        """Digest of the keyword set, weights are not taken into account"""
+        return hashlib.sha1("\n".join(sorted(self.keyword_weights)).encode("utf-8")).hexdigest()
+
+    def needs_refresh(self, ttl: datetime.timedelta, now: Optional[datetime.datetime] = None) -> bool:
+        """
+        True if the user has no embedding, its keyword set changed since the embedding was computed,
+        or the embedding is older than ttl
+        """
+        now = now or datetime.datetime.now()
+        return (self.embedding is None
+                or self.last_refreshed is None
+                or self.embedded_keywords_digest != self.keywords_digest()
+                or now - self.last_refreshed > ttl)
     
     def to_dict(self) -> Dict[str, Any]:
-        return {
+        user_dict = {
             "keywords": self.keywords,
-            "embedding": self.embedding.tolist() if self.embedding is not None else None,
-            "last_refreshed": self.last_refreshed.isoformat()
+            "keyword_weights": self.keyword_weights,
+            "last_refreshed": self.last_refreshed.isoformat() if self.last_refreshed is not None else None,
+            "updated_at": self.updated_at.isoformat() if self.updated_at is not None else None,
+            "embedding_norm": self.embedding_norm,
+            "embedding_version": self.embedding_version,
+            "embedded_keywords_digest": self.embedded_keywords_digest,
         }
+        # users saved without refreshing have no embedding until the refresh scheduler computes it
+        if self.embedding is not None:
+            user_dict["embedding"] = self.embedding.tolist()
+        return user_dict
         
+    def to_hash(self) -> Dict[str, Any]:
+        """
+        Returns HASH fields of the user, embedding is packed into float32 bytes
+        """
+        fields = {
+            "keywords": json.dumps(self.keywords), 
+            "keyword_weights": json.dumps(self.keyword_weights),
+            "embedding_version": self.embedding_version,
+        }
+        if self.embedding is not None:
+            validate_vector(self.embedding, dim=None)
+            fields["embedding"] = pack_vector(self.embedding)
+        if self.last_refreshed is not None:
+            fields["last_refreshed"] = self.last_refreshed.isoformat()
+        if self.updated_at is not None:
+            fields["updated_at"] = self.updated_at.isoformat()
+        if self.embedding_norm is not None:
+            fields["embedding_norm"] = repr(self.embedding_norm)
+        if self.embedded_keywords_digest is not None:
+            fields["embedded_keywords_digest"] = self.embedded_keywords_digest
+        return fields
+
     @classmethod
-    def from_json(cls, json_data: Dict[str, Any]) -> "User":
-        jsonschema.validate(json_data, user_schema)
+    def from_hash(cls, hash_data: Dict[bytes, bytes]) -> "User":
+        """
+        Builds user from HASH fields read by a client that does not decode responses
+        """
+        return cls(
+            keywords=json.loads(hash_data[b'keywords']),
+            embedding=unpack_vector(hash_data[b'embedding']) if b'embedding' in hash_data else None,
+            last_refreshed=datetime.datetime.fromisoformat(hash_data[b'last_refreshed'].decode("utf-8")) if b'last_refreshed' in hash_data else None,
+            keyword_weights=json.loads(hash_data[b'keyword_weights']) if b'keyword_weights' in hash_data else None,
+            updated_at=datetime.datetime.fromisoformat(hash_data[b'updated_at'].decode("utf-8")) if b'updated_at' in hash_data else None,
+            embedding_norm=float(hash_data[b'embedding_norm']) if b'embedding_norm' in hash_data else None,
+            embedding_version=int(hash_data.get(b'embedding_version', 0)),
+            embedded_keywords_digest=hash_data[b'embedded_keywords_digest'].decode("utf-8") if b'embedded_keywords_digest' in hash_data else None
+        )
+
+    @classmethod
+    def from_storage_dict(cls, data: Dict[str, Any]) -> "User":
+        """
+        Builds user from a document stored in the JSON format, without validation
+        """
+        embedding = data.get("embedding")
+        last_refreshed = data.get("last_refreshed")
+        updated_at = data.get("updated_at")
+        return cls(
+            keywords=data["keywords"],
+            embedding=np.array(embedding) if embedding is not None else None,
+            last_refreshed=datetime.datetime.fromisoformat(last_refreshed) if last_refreshed else None,
+            keyword_weights=data.get("keyword_weights"),
+            updated_at=datetime.datetime.fromisoformat(updated_at) if updated_at else None,
+            embedding_norm=data.get("embedding_norm"),
+            embedding_version=data.get("embedding_version", 0),
+            embedded_keywords_digest=data.get("embedded_keywords_digest")
+        )
+
+    @classmethod
+    def from_json(cls, json_data: Dict[str, Any], dim: int = DEFAULT_EMBEDDING_DIM) -> "User":
+        """
+        Raises jsonschema.ValidationError on malformed input and ValueError on a non-finite embedding
+        """
+        jsonschema.validate(json_data, with_embedding_dim(user_schema, dim))
+        embedding = None
+        if 'embedding' in json_data:
+            embedding = np.asarray(json_data['embedding'], dtype=np.float32)
+            validate_vector(embedding, dim)
         return cls(
             keywords=json_data['keywords'],
-            embedding=json_data['embedding'] if 'embedding' in json_data else None,
+            embedding=embedding,
             last_refreshed=datetime.datetime.fromisoformat(json_data['last_refreshed']) if 'last_refreshed' in json_data else None
         )
 
-    def refresh(self, aibox: AIBox) -> None:
-        """Generator an embedding for the user, refreshes the last_refreshed field"""
-        self.embedding = aibox.embedding_from_text(" ".join(self.keywords))
+    def refresh(self, aibox: AIBox, embedding_cache: Optional["RedisKeywordEmbeddingCache"] = None) -> None:
+        """
+        Generator an embedding for the user, refreshes the last_refreshed field.
+        With embedding_cache the embedding is the weighted mean of cached keyword embeddings, 
+        which push_keywords can then update incrementally
+        """
+        if embedding_cache is not None:
+            self.__rebuild_embedding(embedding_cache, aibox)
+            self.last_refreshed = datetime.datetime.now()
+        else:
+            self.set_text_embedding(aibox.embedding_from_text(self.embedding_text()))
+
+    def embedding_text(self) -> str:
+        """Text embedded by refresh() without keyword embedding cache"""
+        return " ".join(self.keywords)
+
+    def set_text_embedding(self, embedding: np.ndarray) -> None:
+        """Sets embedding of embedding_text(), e.g. computed for many users in one batched request"""
+        self.embedding = embedding
+        self.embedding_norm = None
+        self.embedding_version += 1
+        self.embedded_keywords_digest = self.keywords_digest()
         self.last_refreshed = datetime.datetime.now()
+
+    def __decay(self, now: datetime.datetime) -> float:
+        """Brings keyword weights from updated_at to now, returns the applied decay factor"""
+        if self.updated_at is None or now <= self.updated_at:
+            self.updated_at = now
+            return 1.0
+        factor = 0.5 ** ((now - self.updated_at) / self.KEYWORD_HALF_LIFE)
+        for keyword in self.keyword_weights:
+            self.keyword_weights[keyword] *= factor
+        self.updated_at = now
+        return factor
+
+    def __set_embedding_from_sum(self, weighted_sum: np.ndarray) -> None:
+        norm = float(np.linalg.norm(weighted_sum))
+        if norm == 0:
+            # nothing to normalize, the next push with a cache rebuilds the embedding
+            self.embedding_norm = None
+            return
+        self.embedding = weighted_sum / norm
+        self.embedding_norm = norm
+        self.embedding_version += 1
+        self.embedded_keywords_digest = self.keywords_digest()
+
+    def __rebuild_embedding(self, embedding_cache: "RedisKeywordEmbeddingCache", aibox: AIBox) -> None:
+        keywords = list(self.keyword_weights)
+        if not keywords:
+            return
+        embeddings = embedding_cache.get_many(keywords, aibox)
+        weights = np.array([self.keyword_weights[keyword] for keyword in keywords])
+        self.__set_embedding_from_sum(weights @ embeddings)
         
-    def push_keywords(self, keywords: list) -> None:
-        """So far this function is simply a placeholder that does not work efficiently"""
-        self.keywords.extend(keywords)
+    def push_keywords(self, 
+                      keywords: list, 
+                      embedding_cache: Optional["RedisKeywordEmbeddingCache"] = None,
+                      aibox: Optional[AIBox] = None,
+                      now: Optional[datetime.datetime] = None) -> None:
+        """
+        Adds one unit of weight to every pushed keyword after decaying existing weights, 
+        and evicts the lightest keywords beyond MAX_KEYWORDS.
+        With embedding_cache (and aibox for keywords never seen before) the embedding is kept current as
+        normalized sum of weight * keyword embedding: a pushed keyword costs one cached lookup
+        instead of re-embedding the whole profile. Without it the embedding is left for refresh()
+        """
+        now = now or datetime.datetime.now()
+        factor = self.__decay(now)
+        pushed = []
+        for keyword in keywords:
+            normalized = self.normalize_keyword(keyword)
+            if normalized:
+                self.keyword_weights[normalized] = self.keyword_weights.get(normalized, 0.0) + 1.0
+                pushed.append(normalized)
+
+        evicted = []
+        if len(self.keyword_weights) > self.MAX_KEYWORDS:
+            for keyword in self.keywords[self.MAX_KEYWORDS:]:
+                evicted.append((keyword, self.keyword_weights.pop(keyword)))
+
+        if self.embedding_norm is not None:
+            # decay scales all weights alike, the direction of the embedding stays the same
+            self.embedding_norm *= factor
+        if not pushed and not evicted:
+            return
+        if embedding_cache is None:
+            # the weighted sum no longer matches the keywords, the next push with a cache rebuilds it
+            self.embedding_norm = None
+            return
+        if self.embedding is None or self.embedding_norm is None:
+            # embedding was not built from keyword embeddings, incremental update would mix two bases
+            self.__rebuild_embedding(embedding_cache, aibox)
+            return
+        lookups = embedding_cache.get_many(pushed + [keyword for keyword, _ in evicted], aibox)
+        weighted_sum = np.asarray(self.embedding, dtype=np.float64) * self.embedding_norm
+        weighted_sum += lookups[:len(pushed)].sum(axis=0)
+        for (_, weight), vector in zip(evicted, lookups[len(pushed):]):
+            weighted_sum -= weight * vector
+        self.__set_embedding_from_sum(weighted_sum)
+
+
+class RedisKeywordEmbeddingCache:
+    """
+    Embeddings of single keywords shared by all users, kept in process memory (LRU) and in
+    the Redis HASH keyword_embeddings as packed float32. Keywords missing from both are embedded
+    with one batched AIBox request and written back
+    """
+    def __init__(self, redis_client: Redis, max_local_entries: int = 100000, binary_client: Optional[Redis] = None) -> None:
+        self.binary_client = binary_client or _binary_client(redis_client)
+        self.max_local_entries = max_local_entries
+        self._local: "collections.OrderedDict[str, np.ndarray]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keywords: List[str], aibox: Optional[AIBox]) -> np.ndarray:
+        """Returns a (len(keywords), dim) matrix of keyword embeddings"""
+        found: Dict[str, np.ndarray] = {}
+        with self._lock:
+            for keyword in keywords:
+                if keyword in self._local:
+                    self._local.move_to_end(keyword)
+                    found[keyword] = self._local[keyword]
+
+        missing = list(dict.fromkeys(keyword for keyword in keywords if keyword not in found))
+        record_cache("keyword_embeddings_local", True, len(found))
+        record_cache("keyword_embeddings_local", False, len(missing))
+        if missing:
+            for keyword, data in zip(missing, self.binary_client.hmget("keyword_embeddings", missing)):
+                if data is not None:
+                    found[keyword] = unpack_vector(data)
+            to_embed = [keyword for keyword in missing if keyword not in found]
+            record_cache("keyword_embeddings_redis", True, len(missing) - len(to_embed))
+            record_cache("keyword_embeddings_redis", False, len(to_embed))
+            if to_embed:
+                if aibox is None:
+                    raise RuntimeError(f"No cached embeddings for {to_embed} and no AIBox to generate them")
+                with timed("embedding"):
+                    embeddings = aibox.embeddings_from_texts(to_embed)
+                self.binary_client.hset("keyword_embeddings", mapping={
+                    keyword: pack_vector(embedding) for keyword, embedding in zip(to_embed, embeddings)
+                })
+                found.update(zip(to_embed, (np.asarray(e, dtype=np.float32) for e in embeddings)))
+            with self._lock:
+                for keyword in missing:
+                    self._local[keyword] = found[keyword]
+                while len(self._local) > self.max_local_entries:
+                    self._local.popitem(last=False)
+
+        return np.vstack([found[keyword] for keyword in keywords]).astype(np.float64)
     
     
 class RedisUserStore:
-    def __init__(self, redis_client: Redis) -> None:
+    def __init__(self, 
+                 redis_client: Redis, 
+                 storage: str = "json", 
+                 dim: int = DEFAULT_EMBEDDING_DIM,
+                 binary_client: Optional[Redis] = None,
+                 key_allocator = None) -> None:
+        """
+        :param storage: "json" or "hash", see RedisProductStore
+        :param dim: embedding dimension, should match dimensions of the AIBox used for saving
+        :param binary_client: see RedisProductStore
+        :param key_allocator: optional datalayer.KeyAllocator handing out user keys from reserved blocks,
+                              which saves the INCR round trip of every save_user
+        """
         self.redis_client = redis_client
+        self.storage = storage
+        self.dim = dim
+        self.storage_schema = with_embedding_dim(user_schema, dim)
+        self.binary_client = (binary_client or _binary_client(redis_client)) if storage == "hash" else None
+        self.key_allocator = key_allocator
             
     def __get_next_user_key(self) -> str:
         """
         This function increases user counter in the database and returns a new user ID.
         This function goes against principles of good programming.
         """
+        if self.key_allocator is not None:
+            return self.key_allocator.next_key()
         return "user:" + str(self.redis_client.incr("user_counter"))
     
-    def save_user(self, user: User, aibox: AIBox) -> None:
+    def __validate(self, user: User) -> None:
+        if self.storage == "hash":
+            jsonschema.validate({"keywords": user.keywords}, user_metadata_schema)
+            if user.embedding is not None:
+                validate_vector(user.embedding, self.dim)
+        else:
+            jsonschema.validate(user.to_dict(), self.storage_schema)
+
+    def __queue_write(self, pipe, key: str, user: User) -> None:
+        """Queues a full write of the user and of its refresh bookkeeping"""
+        if self.storage == "hash":
+            pipe.delete(key)
+            pipe.hset(key, mapping=user.to_hash())
+        else:
+            pipe.json().set(key, "$", user.to_dict())
+        self.__queue_tracking(pipe, key, user)
+
+    def __queue_tracking(self, pipe, key: str, user: User) -> None:
+        """
+        users:refreshed ZSET holds time of the last embedding refresh of every user,
+        users:stale SET holds users whose embedding does not match their keywords
         """
-        Saves user object to database 
+        if user.last_refreshed is not None:
+            pipe.zadd("users:refreshed", {key: user.last_refreshed.timestamp()})
+        if user.embedding is None or user.embedded_keywords_digest != user.keywords_digest():
+            pipe.sadd("users:stale", key)
+
+    def __client(self) -> Redis:
+        return self.binary_client if self.storage == "hash" else self.redis_client
+
+    def save_user(self, user: User, aibox: Optional[AIBox] = None, refresh: bool = True) -> str:
+        """
+        Saves user object to database and returns its key
+        :param refresh: generate the embedding before saving. Without it the user is queued for
+                        userrefresh.UserRefreshScheduler and saving does not wait for the embedding API
         """
         # Generate embedding
-        user.refresh(aibox)
+        if refresh:
+            user.refresh(aibox)
 
         # Validate user
-        storage_user_dict = user.to_dict()
-        jsonschema.validate(storage_user_dict, user_schema)
+        self.__validate(user)
 
         # Save user to Redis
         key = self.__get_next_user_key()
-        self.redis_client.json().set(key, "$", storage_user_dict)
+        pipe = self.__client().pipeline(transaction=False)
+        self.__queue_write(pipe, key, user)
+        pipe.execute()
+        return key
+
+    def update_user(self, key: str, user: User) -> None:
+        """
+        Overwrites an existing user without refreshing its embedding, 
+        queues it for refresh if its keywords changed
+        """
+        self.__validate(user)
+        pipe = self.__client().pipeline(transaction=True)
+        self.__queue_write(pipe, key, user)
+        pipe.execute()
+
+    def write_user_embeddings(self, keys: List[str], users: List[User]) -> List[str]:
+        """
+        Writes only embedding related fields in one pipeline, keywords pushed concurrently are preserved
+        and such users stay queued for the next refresh. Users deleted since they were read are skipped
+        and their refresh bookkeeping is dropped, returns their keys
+        """
+        pipe = self.__client().pipeline(transaction=False)
+        for key, user in zip(keys, users):
+            validate_vector(user.embedding, self.dim)
+            args = [user.last_refreshed.timestamp()]
+            if self.storage == "hash":
+                fields = user.to_hash()
+                # keyword state may have changed since the user was read
+                del fields["keywords"], fields["keyword_weights"]
+                fields.pop("updated_at", None)
+                for name, value in fields.items():
+                    args += [name, value]
+                pipe.eval(_WRITE_HASH_EMBEDDING_SCRIPT, 2, key, "users:refreshed", *args)
+            else:
+                user_dict = user.to_dict()
+                for field_name in ("embedding", "embedding_norm", "embedding_version", 
+                                   "embedded_keywords_digest", "last_refreshed"):
+                    args += ["$." + field_name, json.dumps(user_dict[field_name])]
+                pipe.eval(_WRITE_JSON_EMBEDDING_SCRIPT, 2, key, "users:refreshed", *args)
+        deleted = [key for key, written in zip(keys, pipe.execute()) if not written]
+        self.forget_users(deleted)
+        return deleted
+
+    def delete_user(self, key: str) -> bool:
+        """
+        Removes user and its refresh bookkeeping from database, returns False if there was no such key
+        """
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.zrem("users:refreshed", key)
+        pipe.srem("users:stale", key)
+        return bool(pipe.execute()[0])
+
+    def forget_users(self, keys: List[str]) -> None:
+        """Drops refresh bookkeeping of users which no longer exist, so they stop coming back from expired_users"""
+        if keys:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.zrem("users:refreshed", *keys)
+            pipe.srem("users:stale", *keys)
+            pipe.execute()
+
+    def mark_stale(self, keys: List[str]) -> None:
+        if keys:
+            self.redis_client.sadd("users:stale", *keys)
+
+    def pop_stale(self, count: int) -> List[str]:
+        """Takes up to count users queued for refresh"""
+        keys = self.redis_client.spop("users:stale", count) or []
+        return [key.decode("utf-8") if isinstance(key, bytes) else key for key in keys]
+
+    def expired_users(self, ttl: datetime.timedelta, count: int) -> List[str]:
+        """Returns up to count users whose embedding is older than ttl, oldest first"""
+        deadline = (datetime.datetime.now() - ttl).timestamp()
+        keys = self.redis_client.zrangebyscore("users:refreshed", "-inf", deadline, start=0, num=count)
+        return [key.decode("utf-8") if isinstance(key, bytes) else key for key in keys]
+
+    def get_user(self, key: str) -> Optional[User]:
+        """
+        Loads user object from database, returns None if there is no such key
+        """
+        return self.get_users([key])[0]
+
+    def get_users(self, keys: List[str]) -> List[Optional[User]]:
+        """
+        Loads several users in one round trip (JSON.MGET or pipelined HGETALL).
+        Returns None in place of missing keys
+        """
+        if not keys:
+            return []
+        if self.storage == "hash":
+            pipe = self.binary_client.pipeline(transaction=False)
+            for key in keys:
+                pipe.hgetall(key)
+            return [User.from_hash(data) if data else None for data in pipe.execute()]
+
+        documents = self.redis_client.json().mget(keys, "$")
+        return [User.from_storage_dict(document[0]) if document else None for document in documents]
         
 
 # if __name__ == "__main__":
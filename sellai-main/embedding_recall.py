@@ -0,0 +1,121 @@
+"""
+Reports how much KNN quality is lost when product embeddings are shortened.
+
+text-embedding-3 models shorten embeddings by keeping the leading components and renormalizing,
+so the reduced vectors are computed locally from the full 1536-d vectors already stored in Redis,
+without any API calls. For every requested dimension the tool prints recall@k of the reduced-space
+top-k against the full-space top-k.
+
+Usage: python embedding_recall.py [--host localhost] [--port 6379] [--k 10] [--dims 256 512 1024]
+                                  [--queries products|users] [--max-queries 1000]
+"""
+import argparse
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from redis import Redis
+
+from dbcontrol import unpack_vector
+
+
+def load_embeddings(redis_client: Redis, pattern: str) -> Tuple[List[str], np.ndarray]:
+    """Loads embeddings of all keys matching pattern, from both JSON and HASH storage formats"""
+    keys, vectors = [], []
+    for key in redis_client.scan_iter(match=pattern, count=1000):
+        key_type = redis_client.type(key)
+        if key_type == b"ReJSON-RL":
+            embedding = redis_client.json().get(key, "$.embedding")
+            if not embedding or embedding[0] is None:
+                continue
+            vector = np.array(embedding[0], dtype=np.float32)
+        elif key_type == b"hash":
+            data = redis_client.hget(key, "embedding")
+            if data is None:
+                continue
+            vector = unpack_vector(data)
+        else:
+            continue
+        keys.append(key.decode("utf-8"))
+        vectors.append(vector)
+    if not vectors:
+        return keys, np.empty((0, 0), dtype=np.float32)
+    return keys, np.vstack(vectors)
+
+
+def shorten(matrix: np.ndarray, dim: int) -> np.ndarray:
+    """Keeps leading dim components and renormalizes rows, same as the API dimensions parameter"""
+    reduced = matrix[:, :dim]
+    norms = np.linalg.norm(reduced, axis=1, keepdims=True)
+    return reduced / np.maximum(norms, 1e-12)
+
+
+def top_k(queries: np.ndarray, corpus: np.ndarray, k: int, self_offset: Optional[int] = None) -> np.ndarray:
+    """
+    Returns indices of k nearest corpus rows for every query (unordered).
+    :param self_offset: when queries are corpus rows starting at this offset, they do not match themselves
+    """
+    scores = queries @ corpus.T
+    if self_offset is not None:
+        rows = np.arange(queries.shape[0])
+        scores[rows, self_offset + rows] = -np.inf
+        k = min(k, corpus.shape[0] - 1)
+    k = min(k, corpus.shape[0])
+    return np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+
+def recall_at_k(queries: np.ndarray, corpus: np.ndarray, dims: List[int], k: int, exclude_self: bool, chunk: int = 512) -> Dict[int, float]:
+    reduced = {dim: (shorten(queries, dim), shorten(corpus, dim)) for dim in dims}
+    full_queries = shorten(queries, queries.shape[1])
+    full_corpus = shorten(corpus, corpus.shape[1])
+    hits = {dim: 0 for dim in dims}
+    total = 0
+    for start in range(0, queries.shape[0], chunk):
+        stop = min(start + chunk, queries.shape[0])
+        offset = start if exclude_self else None
+        truth = top_k(full_queries[start:stop], full_corpus, k, offset)
+        total += truth.size
+        for dim, (reduced_queries, reduced_corpus) in reduced.items():
+            found = top_k(reduced_queries[start:stop], reduced_corpus, k, offset)
+            hits[dim] += sum(len(set(t) & set(f)) for t, f in zip(truth, found))
+    return {dim: hits[dim] / total for dim in dims}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall@k of shortened embeddings against full ones")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dims", type=int, nargs="+", default=[256, 512, 1024])
+    parser.add_argument("--queries", choices=["products", "users"], default="products")
+    parser.add_argument("--max-queries", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    redis_client = Redis(host=args.host, port=args.port, decode_responses=False)
+    _, products = load_embeddings(redis_client, "product:*")
+    if products.shape[0] < 2:
+        raise SystemExit("Need at least two products with embeddings")
+
+    rng = np.random.default_rng(args.seed)
+    if args.queries == "products":
+        # every sampled product queries the rest of the catalog
+        order = rng.permutation(products.shape[0])
+        corpus = products[order]
+        queries = corpus[:args.max_queries]
+        exclude_self = True
+    else:
+        _, users = load_embeddings(redis_client, "user:*")
+        if users.shape[0] == 0:
+            raise SystemExit("No users with embeddings")
+        queries = users[rng.permutation(users.shape[0])[:args.max_queries]]
+        corpus = products
+        exclude_self = False
+
+    full_dim = products.shape[1]
+    dims = [dim for dim in args.dims if dim < full_dim]
+    results = recall_at_k(queries, corpus, dims, args.k, exclude_self)
+    print(f"{corpus.shape[0]} products, {queries.shape[0]} queries ({args.queries}), full dimension {full_dim}")
+    print(f"{'dim':>6} {'recall@' + str(args.k):>10} {'bytes/vector':>13}")
+    for dim in dims:
+        print(f"{dim:>6} {results[dim]:>10.4f} {dim * 4:>13}")
+    print(f"{full_dim:>6} {1.0:>10.4f} {full_dim * 4:>13}")
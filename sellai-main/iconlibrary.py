@@ -0,0 +1,172 @@
+"""
+Local icon library for banner templates.
+
+Icons are described in <root>/tags.json as {"tv": {"file": "tv.png", "tags": ["television", "tv shows"]}, ...},
+files are PNG or SVG (SVG needs the optional cairosvg package at build time). Building the library embeds
+every tag with the AIBox and rasterizes every icon at ICON_SIZES:
+    <root>/raster/<name>/<size>.png   icon scaled to fit a size x size box
+    <root>/embeddings.npy             L2-normalized tag embeddings, one row per tag
+    <root>/index.json                 embedding dimension, owner icon of every row, raster sizes of every icon
+At request time the user embedding is matched against all tags with one matrix-vector product and
+the icon of the closest tag is served from the raster fitting the slot, without any network call.
+Until the library is built, every banner gets the fallback icon, img/tv.png by default.
+
+Usage: python iconlibrary.py icons [--dim 1536] [--local-aibox] [--sizes 32,64,128,256,512]
+"""
+import argparse
+import functools
+import io
+import json
+import os
+import shutil
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image
+
+from aibox import AIBox, LocalAIBox, OpenAIBox, DEFAULT_EMBEDDING_DIM
+from imagestore import pick_variant
+from metrics import record_cache, timed
+
+try:
+    import cairosvg
+except ImportError:
+    cairosvg = None
+
+
+ICON_SIZES = (32, 64, 128, 256, 512)
+# icon of every banner before the library existed
+DEFAULT_ICON = "img/tv.png"
+
+
+@functools.lru_cache(maxsize=1024)
+def read_icon(path: str) -> bytes:
+    """Icon rasters are small and immutable, every process reads each one once"""
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def _load_source(path: str, size: int) -> Image.Image:
+    if path.lower().endswith(".svg"):
+        if cairosvg is None:
+            raise RuntimeError(f"Rasterizing {path} requires the cairosvg package")
+        return Image.open(io.BytesIO(cairosvg.svg2png(url=path, output_width=size, output_height=size)))
+    return Image.open(path)
+
+
+def build_library(root: str, aibox: AIBox, sizes: Tuple[int, ...] = ICON_SIZES) -> int:
+    """
+    Embeds the tags and rasterizes the icons listed in <root>/tags.json, returns the number of icons.
+    The previous rasters are replaced, the index is written last so readers never see a partial library
+    """
+    with open(os.path.join(root, "tags.json")) as file:
+        icons: Dict[str, dict] = json.load(file)
+    owners: List[str] = []
+    texts: List[str] = []
+    variants: Dict[str, List[Tuple[int, int]]] = {}
+    raster_root = os.path.join(root, "raster")
+    tmp_root = raster_root + ".tmp"
+    shutil.rmtree(tmp_root, ignore_errors=True)
+    for name, icon in icons.items():
+        if not icon.get("tags"):
+            raise ValueError(f"Icon {name} has no tags")
+        source = _load_source(os.path.join(root, icon["file"]), max(sizes)).convert("RGBA")
+        source = source.crop(source.getbbox() or (0, 0) + source.size)
+        os.makedirs(os.path.join(tmp_root, name))
+        variants[name] = []
+        for size in sizes:
+            raster = source.copy()
+            raster.thumbnail((size, size), Image.LANCZOS)
+            raster.save(os.path.join(tmp_root, name, f"{size}.png"), optimize=True)
+            variants[name].append(raster.size)
+        for tag in icon["tags"]:
+            owners.append(name)
+            texts.append(tag)
+
+    embeddings = np.asarray(aibox.embeddings_from_texts(texts), dtype=np.float32)
+    embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    shutil.rmtree(raster_root, ignore_errors=True)
+    os.replace(tmp_root, raster_root)
+    np.save(os.path.join(root, "embeddings.npy"), embeddings)
+    tmp_path = os.path.join(root, "index.json.tmp")
+    with open(tmp_path, "w") as file:
+        json.dump({"dim": int(embeddings.shape[1]), "owners": owners, "tags": texts,
+                   "variants": variants, "sizes": list(sizes)}, file)
+    os.replace(tmp_path, os.path.join(root, "index.json"))
+    return len(icons)
+
+
+class IconLibrary:
+    def __init__(self, root: str = "icons", min_score: float = 0.2, fallback_icon: Optional[str] = DEFAULT_ICON) -> None:
+        """
+        An unbuilt library is empty and matches nothing.
+        :param root: directory built by build_library
+        :param min_score: minimal cosine similarity of the closest tag, banners get no icon below it
+        :param fallback_icon: icon of every banner while the library is not built, None for no icon
+        """
+        self.root = root
+        self.min_score = min_score
+        self.fallback_icon = fallback_icon
+        self.dim = 0
+        self.owners: List[str] = []
+        self.sizes: List[int] = []
+        self.variants: Dict[str, List[Tuple[int, int]]] = {}
+        self.embeddings = np.zeros((0, 0), dtype=np.float32)
+        index_path = os.path.join(root, "index.json")
+        if os.path.exists(index_path):
+            with open(index_path) as file:
+                index = json.load(file)
+            self.dim = index["dim"]
+            self.owners = index["owners"]
+            self.sizes = index["sizes"]
+            self.variants = {name: [tuple(size) for size in sizes] for name, sizes in index["variants"].items()}
+            self.embeddings = np.load(os.path.join(root, "embeddings.npy"))
+        else:
+            print(f"IconLibrary: {root} is not built, run python iconlibrary.py {root}. Using {fallback_icon} for every banner")
+
+    def __len__(self) -> int:
+        return len(self.variants)
+
+    def match(self, embedding: Optional[np.ndarray]) -> Optional[str]:
+        """Name of the icon whose tag is closest to the embedding, None if none is close enough"""
+        if embedding is None or not self.owners or len(embedding) != self.dim:
+            return None
+        with timed("icon_match"):
+            query = np.asarray(embedding, dtype=np.float32)
+            scores = self.embeddings @ (query / max(float(np.linalg.norm(query)), 1e-12))
+            best = int(np.argmax(scores))
+            name = self.owners[best] if scores[best] >= self.min_score else None
+        record_cache("icons", name is not None)
+        return name
+
+    def icon_path(self, name: str, width: int, height: int) -> str:
+        """Path of the smallest raster of the icon fitting a width x height slot"""
+        # variants are listed in the order of sizes, smaller sources repeat their original size
+        best = self.variants[name].index(pick_variant(self.variants[name], width, height, "fit"))
+        return os.path.join(self.root, "raster", name, f"{self.sizes[best]}.png")
+
+    def icon_for(self, embedding: Optional[np.ndarray], width: int, height: int) -> Optional[str]:
+        """Raster path of the best matching icon for a banner of the given size, or None"""
+        if not self.variants:
+            return self.fallback_icon
+        name = self.match(embedding)
+        if name is None:
+            return None
+        # the icon slot is a part of the banner, its smaller side is an upper bound of the slot
+        side = min(width, height)
+        return self.icon_path(name, side, side)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds the local icon library")
+    parser.add_argument("root", nargs="?", default="icons")
+    parser.add_argument("--dim", type=int, default=DEFAULT_EMBEDDING_DIM)
+    parser.add_argument("--local-aibox", action="store_true", help="use network-free LocalAIBox embeddings")
+    parser.add_argument("--sizes", default=",".join(map(str, ICON_SIZES)), help="comma separated raster sizes")
+    args = parser.parse_args()
+
+    load_dotenv()
+    aibox = LocalAIBox(dimensions=args.dim) if args.local_aibox else OpenAIBox(os.getenv("OPENAI_KEY"), dimensions=args.dim)
+    count = build_library(args.root, aibox, tuple(int(size) for size in args.sizes.split(",")))
+    print(f"Built {count} icons in {args.root}")
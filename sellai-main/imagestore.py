@@ -0,0 +1,187 @@
+"""
+Content-addressed product image storage.
+
+Images are keyed by SHA-256 of the uploaded file, so an image shared by many products is stored once.
+At upload the image is trimmed of uniform borders and saved as a set of pre-scaled WebP variants:
+    <root>/<digest[:2]>/<digest>/<width>.webp   variants, the largest one has the trimmed original size
+    <root>/<digest[:2]>/<digest>/meta.json      list of (width, height) of all variants
+Products link the largest variant. At render time Picture asks for the smallest variant covering
+its slot, so banners never decode and downscale full-size originals.
+"""
+import functools
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageChops
+
+
+DEFAULT_VARIANT_WIDTHS = (128, 256, 512, 1024)
+
+_VARIANT_PATTERN = re.compile(r"^(?P<dir>.*[/\\](?P<digest>[0-9a-f]{64}))[/\\](?P<width>\d+)\.webp$")
+
+
+def _trim(image: Image.Image, tolerance: int = 8) -> Image.Image:
+    """Removes transparent borders, or borders of the top-left pixel color for opaque images"""
+    if image.mode == "RGBA" and image.getextrema()[3][0] < 255:
+        bbox = image.getchannel("A").point(lambda alpha: 255 if alpha > tolerance else 0).getbbox()
+    else:
+        rgb = image.convert("RGB")
+        background = Image.new("RGB", rgb.size, rgb.getpixel((0, 0)))
+        difference = ImageChops.difference(rgb, background).convert("L")
+        bbox = difference.point(lambda value: 255 if value > tolerance else 0).getbbox()
+    if bbox is None:
+        return image
+    return image.crop(bbox)
+
+
+@functools.lru_cache(maxsize=4096)
+def _variants(image_dir: str) -> List[Tuple[int, int]]:
+    # directories are immutable once published, so meta can be cached for the lifetime of the process
+    with open(os.path.join(image_dir, "meta.json")) as file:
+        return [tuple(size) for size in json.load(file)["variants"]]
+
+
+def pick_variant(variants: List[Tuple[int, int]], width: int, height: int, mode: str = "fill") -> Tuple[int, int]:
+    """
+    Returns the smallest variant that does not have to be upscaled to the slot, or the largest one if none is large enough.
+    In "fit" mode the picture has to cover one dimension of the slot, in "fill" mode both of them
+    :param variants: (width, height) of available variants
+    """
+    def covers(size: Tuple[int, int]) -> bool:
+        if mode == "fit":
+            return size[0] >= width or size[1] >= height
+        return size[0] >= width and size[1] >= height
+
+    ordered = sorted(variants)
+    for size in ordered:
+        if covers(size):
+            return size
+    return ordered[-1]
+
+
+def resolve_variant(image_link: str, width: int, height: int, mode: str = "fill") -> str:
+    """
+    Maps a link to any variant of a stored image to the best variant for the slot.
+    Links outside of an image store are returned unchanged
+    """
+    match = _VARIANT_PATTERN.match(image_link) if isinstance(image_link, str) else None
+    if match is None or width <= 0 or height <= 0:
+        return image_link
+    try:
+        variants = _variants(match.group("dir"))
+    except OSError:
+        return image_link
+    best_width = pick_variant(variants, width, height, mode)[0]
+    return os.path.join(match.group("dir"), f"{best_width}.webp")
+
+
+def dominant_color(image: Image.Image) -> Tuple[int, int, int, int]:
+    """Most frequent visible color of a thumbnail, quantized to 32 levels per channel"""
+    thumbnail = image.convert("RGBA").resize((64, 64))
+    colors = [(count, (r // 8 * 8, g // 8 * 8, b // 8 * 8)) for count, (r, g, b, a) in thumbnail.getcolors(64 * 64) if a > 0]
+    if not colors:
+        return (0, 0, 0, 255)
+    counts: Dict[Tuple[int, int, int], int] = {}
+    for count, color in colors:
+        counts[color] = counts.get(color, 0) + count
+    return max(counts, key=counts.get) + (255,)
+
+
+def load_image(image_link: str, width: int, height: int) -> Tuple[str, bytes, Tuple[int, int, int, int]]:
+    """Reads the best stored variant of the product image and decodes it once for the main color"""
+    path = resolve_variant(image_link, width, height, "fit")
+    with open(path, "rb") as file:
+        data = file.read()
+    return path, data, dominant_color(Image.open(io.BytesIO(data)))
+
+
+class ImageStore:
+    def __init__(self,
+                 root: str = "db-img",
+                 widths: Tuple[int, ...] = DEFAULT_VARIANT_WIDTHS,
+                 quality: int = 90,
+                 trim: bool = True) -> None:
+        """
+        :param root: directory holding the store
+        :param widths: widths of pre-scaled variants, those not smaller than the original are skipped
+        :param quality: WebP quality of the variants
+        :param trim: crop uniform borders before scaling
+        """
+        self.root = root
+        self.widths = tuple(sorted(widths))
+        self.quality = quality
+        self.trim = trim
+
+    @staticmethod
+    def digest_of(source: str) -> str:
+        hasher = hashlib.sha256()
+        with open(source, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def image_dir(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def contains(self, digest: str) -> bool:
+        return os.path.exists(os.path.join(self.image_dir(digest), "meta.json"))
+
+    def variants(self, digest: str) -> List[Tuple[int, int]]:
+        return _variants(self.image_dir(digest))
+
+    def variant_path(self, digest: str, width: int, height: int, mode: str = "fill") -> str:
+        """Returns the smallest stored variant at least as large as the slot"""
+        best_width = pick_variant(self.variants(digest), width, height, mode)[0]
+        return os.path.join(self.image_dir(digest), f"{best_width}.webp")
+
+    def original_path(self, digest: str) -> str:
+        """Largest variant, this is what products link to"""
+        return os.path.join(self.image_dir(digest), f"{max(self.variants(digest))[0]}.webp")
+
+    def put(self, source: str) -> str:
+        """
+        Stores image file unless identical content is stored already, returns path of its largest variant.
+        Safe to call concurrently from several processes
+        """
+        digest = self.digest_of(source)
+        image_dir = self.image_dir(digest)
+        if self.contains(digest):
+            return self.original_path(digest)
+
+        image = Image.open(source)
+        image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+        if self.trim:
+            image = _trim(image)
+
+        tmp_dir = f"{image_dir}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        variants = []
+        for width in [w for w in self.widths if w < image.width] + [image.width]:
+            height = max(1, round(image.height * width / image.width))
+            variant = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+            variant.save(os.path.join(tmp_dir, f"{width}.webp"), "WEBP", quality=self.quality, method=4)
+            variants.append((width, height))
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as file:
+            json.dump({"variants": variants}, file)
+        try:
+            os.rename(tmp_dir, image_dir)
+        except OSError:
+            # another writer published the same content first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not self.contains(digest):
+                raise
+        return self.original_path(digest)
+
+
+def store_image(image_store: ImageStore, source: str) -> Tuple[Optional[str], Optional[str]]:
+    """Runs in a worker process, returns (stored link, None) or (None, error message)"""
+    try:
+        return image_store.put(source), None
+    except Exception as e:
+        return None, f"{source}: {e}"
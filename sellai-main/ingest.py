@@ -0,0 +1,208 @@
+"""
+Bulk product ingestion from JSONL or CSV files.
+
+Every batch of records gets one batched embedding request, its images are copied into db-img
+on a process pool, its keys are reserved with a single INCRBY and its documents are written
+in one pipeline. Progress is checkpointed after every batch together with the keys reserved
+for the next one, so an interrupted import resumes where it stopped and rewrites the same keys
+instead of creating duplicates. Compact summaries and keywords, which slogan prompts use instead of
+full descriptions, are generated on a thread pool while the batch is embedded.
+
+Usage: python ingest.py products.jsonl [--format jsonl|csv] [--batch 256] [--workers 8]
+                        [--shards host:port,...] [--storage json|hash] [--dim 1536] [--local-aibox]
+                        [--image-store db-img] [--no-summaries]
+"""
+import argparse
+import concurrent.futures
+import csv
+import functools
+import json
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import jsonschema
+from dotenv import load_dotenv
+from PIL import Image
+from aibox import AIBox, LocalAIBox, OpenAIBox, DEFAULT_EMBEDDING_DIM
+from datalayer import RedisDataLayer
+from dbcontrol import Product, RedisProductStore
+from imagestore import ImageStore, store_image
+from metrics import timed
+
+
+def read_records(path: str, file_format: str) -> Iterator[Dict[str, Any]]:
+    with open(path, newline="") as file:
+        if file_format == "csv":
+            for row in csv.DictReader(file):
+                if row.get("in_stock") not in (None, ""):
+                    row["in_stock"] = int(row["in_stock"])
+                yield {key: value for key, value in row.items() if value not in (None, "")}
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _copy_image(source: str, destination: str) -> Optional[str]:
+    """Same conversion as Product.save_image, runs in a worker process. Returns error message or None"""
+    try:
+        Image.open(source).save(destination)
+        return None
+    except Exception as e:
+        return f"{source}: {e}"
+
+
+class Checkpoint:
+    """
+    Progress of one input file: number of records fully written and keys reserved for the batch in flight
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.records_done = 0
+        self.pending_keys: List[str] = []
+        if os.path.exists(path):
+            with open(path) as file:
+                data = json.load(file)
+            self.records_done = data["records_done"]
+            self.pending_keys = data["pending_keys"]
+
+    def save(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"records_done": self.records_done, "pending_keys": self.pending_keys}, file)
+        os.replace(tmp_path, self.path)
+
+
+class BulkIngestor:
+    def __init__(self,
+                 product_store: RedisProductStore,
+                 aibox: AIBox,
+                 checkpoint: Checkpoint,
+                 batch_size: int = 256,
+                 workers: Optional[int] = None,
+                 image_dir: str = "db-img",
+                 image_store: Optional[ImageStore] = None,
+                 summarize: bool = True,
+                 summary_threads: int = 16) -> None:
+        """
+        :param image_store: store images deduplicated with pre-scaled variants instead of copying them to image_dir
+        :param summarize: generate prompt summaries for records that do not come with one
+        :param summary_threads: concurrent summary requests
+        """
+        self.product_store = product_store
+        self.aibox = aibox
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.image_dir = image_dir
+        self.image_store = image_store
+        self.summarize = summarize
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self.summary_pool = concurrent.futures.ThreadPoolExecutor(max_workers=summary_threads)
+
+    def _batches(self, records: Iterator[Dict[str, Any]]) -> Iterator[List[Tuple[int, Dict[str, Any]]]]:
+        batch = []
+        for number, record in enumerate(records):
+            if number < self.checkpoint.records_done:
+                continue
+            batch.append((number, record))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _reserve_keys(self, count: int) -> List[str]:
+        # keys reserved before an interruption are reused, so a retried batch overwrites its own documents
+        if len(self.checkpoint.pending_keys) < count:
+            self.checkpoint.pending_keys = self.product_store.allocate_product_keys(count)
+            self.checkpoint.save()
+        return self.checkpoint.pending_keys[:count]
+
+    def ingest_batch(self, batch: List[Tuple[int, Dict[str, Any]]]) -> int:
+        """Ingests one batch and returns number of stored products"""
+        products = []
+        for number, record in batch:
+            try:
+                products.append(Product.from_json(record))
+            except jsonschema.ValidationError as e:
+                print(f"record {number}: invalid product, skipping: {e.message}")
+        if not products:
+            return 0
+
+        # summaries are requested per product, they run while the batch is embedded and its images are copied
+        summaries = [(p, self.summary_pool.submit(p.summarize, self.aibox))
+                     for p in products if self.summarize and p.summary is None]
+        with timed("embedding"):
+            embeddings = self.aibox.embeddings_from_texts([p.description.replace("\n", " ") for p in products])
+        keys = self._reserve_keys(len(products))
+        if self.image_store is not None:
+            stored = list(self.pool.map(functools.partial(store_image, self.image_store), [p.image_link for p in products]))
+            destinations = [link for link, _ in stored]
+            errors = [error for _, error in stored]
+        else:
+            destinations = [os.path.join(self.image_dir, key + ".png") for key in keys]
+            errors = list(self.pool.map(_copy_image, [p.image_link for p in products], destinations))
+        with timed("summary"):
+            for product, future in summaries:
+                try:
+                    future.result()
+                except Exception as e:
+                    # a product without a summary is still stored, slogan prompts fall back to its description
+                    print(f"{product.name}: failed to summarize, storing without summary: {e}")
+                    product.summary, product.summary_keywords = None, None
+
+        stored_keys, stored_products = [], []
+        for key, product, embedding, destination, error in zip(keys, products, embeddings, destinations, errors):
+            if error is not None:
+                print(f"{key}: failed to copy image, skipping: {error}")
+                continue
+            product.embedding = embedding
+            product.image_link = destination
+            stored_keys.append(key)
+            stored_products.append(product)
+        self.product_store.write_products(stored_keys, stored_products)
+        return len(stored_products)
+
+    def run(self, records: Iterator[Dict[str, Any]]) -> int:
+        total = 0
+        try:
+            for batch in self._batches(records):
+                total += self.ingest_batch(batch)
+                self.checkpoint.records_done = batch[-1][0] + 1
+                self.checkpoint.pending_keys = []
+                self.checkpoint.save()
+                print(f"{self.checkpoint.records_done} records processed, {total} products stored in this run")
+        finally:
+            self.pool.shutdown()
+            self.summary_pool.shutdown()
+        return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk product ingestion")
+    parser.add_argument("input")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default=None, help="guessed from the extension by default")
+    parser.add_argument("--checkpoint", default=None, help="defaults to <input>.checkpoint.json")
+    parser.add_argument("--batch", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--shards", default=None, help="host:port[/db],... of product shards, PRODUCT_SHARDS by default")
+    parser.add_argument("--storage", choices=["json", "hash"], default="json")
+    parser.add_argument("--dim", type=int, default=DEFAULT_EMBEDDING_DIM)
+    parser.add_argument("--local-aibox", action="store_true", help="use network-free LocalAIBox embeddings")
+    parser.add_argument("--image-store", default=None, help="root of a content-addressed image store, images are copied to db-img if omitted")
+    parser.add_argument("--no-summaries", action="store_true", help="skip prompt summaries, slogans then use full descriptions")
+    args = parser.parse_args()
+
+    load_dotenv()
+    file_format = args.format or ("csv" if args.input.endswith(".csv") else "jsonl")
+    aibox = LocalAIBox(dimensions=args.dim) if args.local_aibox else OpenAIBox(os.getenv("OPENAI_KEY"), dimensions=args.dim)
+    data_layer = RedisDataLayer(host=args.host, port=args.port, product_shards=args.shards or os.getenv("PRODUCT_SHARDS"))
+    store = data_layer.product_store(storage=args.storage, dim=args.dim)
+    ingestor = BulkIngestor(store, aibox, Checkpoint(args.checkpoint or args.input + ".checkpoint.json"),
+                            batch_size=args.batch, workers=args.workers,
+                            image_store=ImageStore(args.image_store) if args.image_store else None,
+                            summarize=not args.no_summaries)
+    stored = ingestor.run(read_records(args.input, file_format))
+    print(f"Done, {stored} products stored")
@@ -0,0 +1,69 @@
+"""
+Per-request latency budget for the banner pipeline.
+
+The budget is split across ordered stages by their shares. Time left unused by a stage carries over
+to the following ones, so a stage may take its share of whatever is left. A stage which does not
+finish in time is replaced by its fallback and the fallback name is recorded, the abandoned work
+keeps running in the background (e.g. a slow slogan still lands in the slogan store).
+"""
+import asyncio
+import contextlib
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Type
+
+from metrics import BANNER_FALLBACKS, Trace
+
+
+DEFAULT_STAGE_SHARES = {"user": 0.1, "lookup": 0.2, "slogan": 0.25, "banner_cache": 0.05, "render": 0.3, "encode": 0.1}
+
+
+class LatencyBudget:
+    def __init__(self, total: float, shares: Dict[str, float] = DEFAULT_STAGE_SHARES, trace: Optional[Trace] = None) -> None:
+        """
+        :param total: seconds the whole request may take
+        :param shares: stage -> relative share of the budget, in the order the stages run
+        :param trace: request trace receiving a span per stage
+        """
+        self.total = total
+        self.shares = shares
+        self.trace = trace
+        self.started = time.monotonic()
+        self.fallbacks: List[str] = []
+        self.stage_times: Dict[str, float] = {}
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def remaining(self) -> float:
+        return max(0.0, self.total - self.elapsed())
+
+    def timeout_for(self, stage: str) -> float:
+        """Seconds the stage may take: its share of the time left for it and all the stages after it"""
+        stages = list(self.shares)
+        later = sum(self.shares[s] for s in stages[stages.index(stage):])
+        return self.remaining() * self.shares[stage] / later if later > 0 else self.remaining()
+
+    def record_fallback(self, name: str) -> None:
+        self.fallbacks.append(name)
+        BANNER_FALLBACKS.inc(fallback=name)
+
+    async def run(self,
+                  stage: str,
+                  awaitable: Awaitable[Any],
+                  fallback_name: str,
+                  fallback: Callable[[], Any],
+                  fallback_on: Tuple[Type[BaseException], ...] = ()) -> Any:
+        """
+        Awaits the stage within its share of the budget, returns fallback() if it runs out of time
+        or fails with one of fallback_on exceptions
+        """
+        started = time.monotonic()
+        with self.trace.span(stage) if self.trace is not None else contextlib.nullcontext():
+            try:
+                # shield keeps shared work (single-flight jobs other requests wait for) running after a timeout
+                return await asyncio.wait_for(asyncio.shield(awaitable), self.timeout_for(stage))
+            except (asyncio.TimeoutError, *fallback_on):
+                self.record_fallback(fallback_name)
+                return fallback()
+            finally:
+                self.stage_times[stage] = time.monotonic() - started
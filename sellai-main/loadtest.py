@@ -0,0 +1,271 @@
+"""
+Load generator for the /get_banner endpoint.
+
+In open-loop mode (default) requests arrive as a Poisson process at --rate per second regardless of how
+fast the server answers, and latency is measured from the scheduled arrival time, so a slow server is not
+hidden by the client waiting for it. At most --concurrency requests are in flight, arrivals beyond that
+wait for a free client and their waiting time counts into their latency. A report whose arrivals had
+to wait is flagged as saturated: the client, not only the server, limited the measured throughput.
+In closed-loop mode --concurrency clients send requests back to back.
+Requests draw a banner size from a weighted mix and a user from a Zipf-like popularity distribution,
+or send random anonymous embeddings with --anonymous.
+
+Against a local stack with a network-free AIBox (LOCAL_AIBOX_LATENCY adds simulated provider latency):
+    AIBOX=local EMBEDDING_DIM=256 LOCAL_AIBOX_LATENCY=0.2 flask --app main run
+    python loadtest.py --seed-products 1000 --seed-users 200 --dim 256 --rate 50 --duration 60
+
+Usage: python loadtest.py [--url http://localhost:5000/get_banner] [--mode open|closed] [--rate 20]
+                          [--duration 30] [--concurrency 64] [--sizes 728x90:4,300x250:3,160x600:2,320x50:1]
+                          [--users 200] [--anonymous] [--dim 1536] [--report report.json]
+                          [--seed-products N] [--seed-users N]
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import requests
+
+
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def parse_sizes(spec: str) -> Tuple[List[Tuple[int, int]], np.ndarray]:
+    """Parses "728x90:4,300x250:1" into sizes and normalized weights"""
+    sizes, weights = [], []
+    for item in spec.split(","):
+        size, _, weight = item.partition(":")
+        width, height = size.lower().split("x")
+        sizes.append((int(width), int(height)))
+        weights.append(float(weight or 1))
+    weights = np.array(weights)
+    return sizes, weights / weights.sum()
+
+
+def zipf_weights(n: int, exponent: float = 1.1) -> np.ndarray:
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+class RequestMix:
+    """Draws (params, json body) of the next request"""
+    def __init__(self, sizes_spec: str, users: int, anonymous: bool, dim: int, formats: List[str], seed: int) -> None:
+        self.sizes, self.size_weights = parse_sizes(sizes_spec)
+        self.users = users
+        self.user_weights = zipf_weights(users) if users else None
+        self.anonymous = anonymous
+        self.dim = dim
+        self.formats = formats
+        self.rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+
+    def next(self) -> Tuple[Dict[str, str], Optional[dict]]:
+        with self._lock:
+            width, height = self.sizes[self.rng.choice(len(self.sizes), p=self.size_weights)]
+            params = {"width": str(width), "height": str(height), "format": self.formats[self.rng.integers(len(self.formats))]}
+            if self.anonymous:
+                body = {"embedding": self.rng.normal(size=self.dim).tolist(), "keywords": ["television", "tea", "garden"]}
+                return params, body
+            params["user"] = f"user:{self.rng.choice(self.users, p=self.user_weights) + 1}"
+            return params, None
+
+
+class Results:
+    def __init__(self) -> None:
+        self.latencies: List[float] = []
+        self.statuses = collections.Counter()
+        self.fallbacks = collections.Counter()
+        self.errors = collections.Counter()
+        self.outstanding = 0
+        self.max_waiting = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency: float, status: Optional[int], fallback: Optional[str], error: Optional[str]) -> None:
+        with self._lock:
+            self.latencies.append(latency)
+            if status is not None:
+                self.statuses[status] += 1
+            if fallback:
+                for name in fallback.split(","):
+                    self.fallbacks[name] += 1
+            if error:
+                self.errors[error] += 1
+
+    def arrive(self, concurrency: int) -> None:
+        """Counts a scheduled arrival, arrivals beyond concurrency outstanding ones wait for a free client"""
+        with self._lock:
+            self.outstanding += 1
+            self.max_waiting = max(self.max_waiting, self.outstanding - concurrency)
+
+    def finish(self) -> None:
+        with self._lock:
+            self.outstanding -= 1
+
+    def report(self, elapsed: float) -> dict:
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        total = len(self.latencies)
+        failed = sum(count for status, count in self.statuses.items() if status >= 500) + sum(self.errors.values())
+        histogram = {}
+        for bound in LATENCY_BUCKETS_MS:
+            histogram[f"<={bound}ms"] = int((latencies <= bound).sum()) if total else 0
+        histogram["+Inf"] = total
+        return {
+            "requests": total,
+            # arrivals found every client busy and waited, latencies include the wait
+            "saturated": self.max_waiting > 0,
+            "max_waiting": self.max_waiting,
+            "duration_s": elapsed,
+            "throughput_rps": total / elapsed if elapsed > 0 else 0.0,
+            "error_rate": failed / total if total else 0.0,
+            "latency_ms": {name: float(np.percentile(latencies, q)) for name, q in
+                           (("p50", 50), ("p90", 90), ("p95", 95), ("p99", 99), ("max", 100))},
+            "latency_histogram": histogram,
+            "statuses": dict(self.statuses),
+            "fallbacks": dict(self.fallbacks),
+            "errors": dict(self.errors),
+        }
+
+
+def send(session: requests.Session, url: str, mix: RequestMix, results: Results, scheduled: float, timeout: float) -> None:
+    params, body = mix.next()
+    try:
+        response = session.get(url, params=params, json=body, timeout=timeout)
+        results.record(time.perf_counter() - scheduled, response.status_code, response.headers.get("X-Banner-Fallback"), None)
+    except requests.RequestException as e:
+        results.record(time.perf_counter() - scheduled, None, None, type(e).__name__)
+
+
+def run_open_loop(url: str, mix: RequestMix, rate: float, duration: float, concurrency: int, timeout: float, seed: int) -> Tuple[Results, float]:
+    results = Results()
+    rng = np.random.default_rng(seed + 1)
+    local = threading.local()
+
+    def worker(scheduled: float) -> None:
+        try:
+            if not hasattr(local, "session"):
+                local.session = requests.Session()
+            send(local.session, url, mix, results, scheduled, timeout)
+        finally:
+            results.finish()
+
+    started = time.perf_counter()
+    next_arrival = started
+    # arrivals beyond concurrency queue in the pool, latency still runs from their scheduled time
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while next_arrival - started < duration:
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            results.arrive(concurrency)
+            pool.submit(worker, next_arrival)
+            next_arrival += rng.exponential(1.0 / rate)
+    return results, time.perf_counter() - started
+
+
+def run_closed_loop(url: str, mix: RequestMix, duration: float, concurrency: int, timeout: float) -> Tuple[Results, float]:
+    results = Results()
+    started = time.perf_counter()
+
+    def client() -> None:
+        session = requests.Session()
+        while time.perf_counter() - started < duration:
+            send(session, url, mix, results, time.perf_counter(), timeout)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+
+def seed_local_stack(products: int, users: int, dim: int, storage: str, seed: int) -> None:
+    """Fills the Redis configured by REDIS_* variables with synthetic products and users embedded by LocalAIBox"""
+    from aibox import LocalAIBox
+    from datalayer import RedisDataLayer
+    from dbcontrol import Product, User
+
+    aibox = LocalAIBox(dimensions=dim, seed=seed)
+    data_layer = RedisDataLayer.from_env()
+    rng = np.random.default_rng(seed)
+    vocabulary = ["tea", "coffee", "garden", "television", "cacti", "royal", "football", "hiking", "cooking",
+                  "travel", "books", "music", "cats", "dogs", "cycling", "photography", "wine", "gaming"]
+    if products:
+        product_store = data_layer.product_store(storage=storage, dim=dim)
+        batch = 500
+        for start in range(0, products, batch):
+            count = min(batch, products - start)
+            descriptions = [" ".join(rng.choice(vocabulary, size=12)) for _ in range(count)]
+            embeddings = aibox.embeddings_from_texts(descriptions)
+            keys = product_store.allocate_product_keys(count)
+            product_store.write_products(keys, [Product(f"Product {key}", description, "img/tea.png", embedding=embedding)
+                                                for key, description, embedding in zip(keys, descriptions, embeddings)])
+    if users:
+        user_store = data_layer.user_store(storage=storage, dim=dim)
+        first_key = None
+        for _ in range(users):
+            key = user_store.save_user(User(list(rng.choice(vocabulary, size=4, replace=False)), None), aibox)
+            first_key = first_key or key
+        if first_key != "user:1":
+            print(f"Users were created from {first_key} on, the load test addresses user:1 .. user:{users}")
+    data_layer.close()
+    print(f"Seeded {products} products and {users} users")
+
+
+def print_report(report: dict) -> None:
+    print(f"requests {report['requests']}  throughput {report['throughput_rps']:.1f} req/s  "
+          f"error rate {report['error_rate']:.2%}")
+    if report["saturated"]:
+        print(f"SATURATED: up to {report['max_waiting']} arrivals waited for a free client, latencies include the wait")
+    print("latency ms  " + "  ".join(f"{name} {value:.1f}" for name, value in report["latency_ms"].items()))
+    total = max(report["requests"], 1)
+    previous = 0
+    for bucket, cumulative in report["latency_histogram"].items():
+        count = cumulative - previous
+        previous = cumulative
+        print(f"  {bucket:>9} {count:8d} {'#' * int(50 * count / total)}")
+    print(f"statuses {report['statuses']}")
+    if report["fallbacks"]:
+        print(f"fallbacks {report['fallbacks']}")
+    if report["errors"]:
+        print(f"errors {report['errors']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the banner endpoint")
+    parser.add_argument("--url", default="http://localhost:5000/get_banner")
+    parser.add_argument("--mode", choices=["open", "closed"], default="open")
+    parser.add_argument("--rate", type=float, default=20.0, help="arrivals per second in open-loop mode")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=10.0, help="seconds per request")
+    parser.add_argument("--sizes", default="728x90:4,300x250:3,160x600:2,320x50:1", help="WIDTHxHEIGHT:weight,...")
+    parser.add_argument("--formats", default="png", help="comma separated banner formats")
+    parser.add_argument("--users", type=int, default=200, help="requests address user:1 .. user:N")
+    parser.add_argument("--anonymous", action="store_true", help="send random embeddings instead of user keys")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report", default=None, help="write the report as JSON, e.g. to compare runs")
+    parser.add_argument("--seed-products", type=int, default=0, help="first fill local Redis with synthetic products")
+    parser.add_argument("--seed-users", type=int, default=0, help="first fill local Redis with synthetic users")
+    parser.add_argument("--storage", choices=["json", "hash"], default="json")
+    args = parser.parse_args()
+
+    if args.seed_products or args.seed_users:
+        seed_local_stack(args.seed_products, args.seed_users, args.dim, args.storage, args.seed)
+
+    mix = RequestMix(args.sizes, args.users, args.anonymous, args.dim, args.formats.split(","), args.seed)
+    if args.mode == "open":
+        results, elapsed = run_open_loop(args.url, mix, args.rate, args.duration, args.concurrency, args.timeout, args.seed)
+    else:
+        results, elapsed = run_closed_loop(args.url, mix, args.duration, args.concurrency, args.timeout)
+
+    report = results.report(elapsed)
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as file:
+            json.dump(report, file, indent=2)
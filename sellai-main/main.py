@@ -1,6 +1,13 @@
-from flask import Flask, request, send_file, render_template
+from flask import Flask, Response, abort, request, send_file, render_template
 import redis
-from dbcontrol import Product, User
+import asyncio
+import concurrent.futures
+import functools
+import io
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import jsonschema
+from dbcontrol import Product, ProductMatch, User, RedisProductStore, RedisUserStore
 from templates.basicxmltemplate.basicxmltemplate import BasicXMLTemplate
 from templates.basichtmltemplate.basichtmltemplate import BasicHTMLTemplate
 from openai import OpenAI, OpenAIError
@@ -8,12 +15,316 @@ from PIL import Image
 from visualnode import vnode_tree_from_file, VNode
 from legacy.products import get_embedding
 from dataclasses import dataclass
-from aibox import OpenAIBox
+from bannercache import BannerCache, DiskBannerTier, RedisBannerTier, banner_digest
+from aibox import AIBox, LocalAIBox, OpenAIBox, DEFAULT_EMBEDDING_DIM
+from iconlibrary import IconLibrary, read_icon
+from imagestore import load_image
+from slogans import DEFAULT_SLOGAN_INSTRUCTIONS, RedisSloganStore, get_slogan, segment_of
+from singleflight import SingleFlight
+from latencybudget import LatencyBudget
+from metrics import REGISTRY, FileTraceExporter, Trace, record_cache, register_gauge, timed
+from recommendations import RecommendationCache, RecommendationRefresher
+from renderservice import RenderDeadlineExceeded, RenderOverloaded, RenderService, encode_banner
+from datalayer import RedisDataLayer
+from vectorindex import MmapVectorIndex
 import os
 from dotenv import load_dotenv
 
 app = Flask(__name__)
-redis_client = redis.Redis(host="localhost", port=6379, decode_responses=True)
+# one pooled data layer per worker process, configured with REDIS_* environment variables
+data_layer = RedisDataLayer.from_env()
+redis_client = data_layer.client
+# image reads and banner encoding run here, Pillow releases the GIL while decoding and encoding
+io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=int(os.getenv("IO_WORKERS", 32)), thread_name_prefix="io")
+# identical concurrent slogan, render and encode jobs share one computation, SINGLEFLIGHT_SHARED=1 extends it across workers
+flights = SingleFlight(redis_client=data_layer.binary_client if os.getenv("SINGLEFLIGHT_SHARED", "0") == "1" else None)
+# concurrent requests for the same product image at the same size share one read
+image_flights = SingleFlight(executor=io_pool)
+encode_flights = SingleFlight(executor=io_pool, redis_client=flights.redis_client)
+
+# BANNER_CACHE_TIER=redis|disk|none selects the tier shared between workers
+BANNER_CACHE_TIER = os.getenv("BANNER_CACHE_TIER", "redis")
+banner_cache = BannerCache(
+    max_memory_bytes=int(os.getenv("BANNER_CACHE_BYTES", 64 * 1024 * 1024)),
+    shared={"redis": lambda: RedisBannerTier(data_layer.binary_client),
+            "disk": lambda: DiskBannerTier(os.getenv("BANNER_CACHE_DIR", "banner-cache"))}.get(BANNER_CACHE_TIER, lambda: None)(),
+)
+# banners are per user, so only the browser may keep them
+BANNER_MAX_AGE = int(os.getenv("BANNER_MAX_AGE", 300))
+
+# TRACE_FILE=<path> appends one JSON line with the spans of every banner request
+trace_exporter = FileTraceExporter(os.environ["TRACE_FILE"]) if os.getenv("TRACE_FILE") else None
+register_gauge("sellai_render_queue_depth", "Render jobs queued or running", lambda: render_service().queue_depth())
+register_gauge("sellai_render_queue_limit", "Maximal number of admitted render jobs", lambda: render_service().max_queue)
+register_gauge("sellai_singleflight_in_flight", "Distinct jobs in flight in this process", flights.in_flight)
+
+# hard end-to-end limit, stages that would exceed their share fall back to degraded alternatives
+BANNER_BUDGET = float(os.getenv("BANNER_BUDGET_MS", 500)) / 1000
+DEFAULT_CREATIVE = os.getenv("DEFAULT_CREATIVE", "static/image.png")
+GENERIC_SLOGAN = "Discover {name}"
+
+BANNER_FORMATS = {"png": ("PNG", "image/png"), "jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+
+
+@dataclass
+class Services:
+    aibox: AIBox
+    product_store: RedisProductStore
+    user_store: RedisUserStore
+    slogan_store: RedisSloganStore
+    recommendations: RecommendationCache
+    icons: IconLibrary
+
+
+def lazy_singleton(factory: Callable[[], Any]) -> Callable[[], Any]:
+    """
+    Creates the instance on the first call and returns it afterwards. Unlike functools.lru_cache,
+    concurrent first calls of a threaded server wait for a single instance instead of each building one
+    """
+    lock = threading.Lock()
+    instances = []
+
+    @functools.wraps(factory)
+    def get():
+        if not instances:
+            with lock:
+                if not instances:
+                    instances.append(factory())
+        return instances[0]
+    return get
+
+
+@lazy_singleton
+def render_service() -> RenderService:
+    """
+    CPU-bound rendering runs in pre-warmed worker processes, so the event loop never blocks on it.
+    The pool is started on first use rather than on import, so the app server forks its workers first
+    """
+    return RenderService(workers=int(os.getenv("RENDER_WORKERS", os.cpu_count() or 1)),
+                         max_queue=int(os.getenv("RENDER_MAX_QUEUE", 0)) or None,
+                         default_deadline=float(os.getenv("RENDER_DEADLINE", 2.0)))
+
+
+@lazy_singleton
+def services() -> Services:
+    """
+    Created on first request rather than on import, render worker processes never need them.
+    AIBOX=local selects the network-free LocalAIBox, LOCAL_AIBOX_LATENCY (seconds) simulates provider latency
+    of its calls. PRODUCT_STORAGE and EMBEDDING_DIM configure the stores, ICON_LIBRARY the directory built by iconlibrary.py
+    (banners get img/tv.png until it is built).
+    PRODUCT_SHARDS spreads products over several Redis instances, see datalayer.RedisDataLayer.
+    VECTOR_INDEX_PATH=<path> answers KNN queries from the memory-mapped index published there by vectorindex.py.
+    Every worker process recomputes recommendations outdated by catalog changes in the background,
+    RECOMMENDATION_REFRESHER=0 turns this off
+    """
+    load_dotenv()
+    dim = int(os.getenv("EMBEDDING_DIM", DEFAULT_EMBEDDING_DIM))
+    storage = os.getenv("PRODUCT_STORAGE", "json")
+    if os.getenv("AIBOX", "openai") == "local":
+        latency = float(os.getenv("LOCAL_AIBOX_LATENCY", 0.0))
+        aibox = LocalAIBox(dimensions=dim, embedding_latency=latency, completion_latency=latency, latency_jitter=latency / 2)
+    else:
+        aibox = OpenAIBox(openai_key=os.getenv("OPENAI_KEY"), dimensions=dim,
+                          timeout=float(os.getenv("OPENAI_TIMEOUT", 5.0)),
+                          max_retries=int(os.getenv("OPENAI_MAX_RETRIES", 1)))
+    index_path = os.getenv("VECTOR_INDEX_PATH")
+    product_store = data_layer.product_store(storage=storage, dim=dim,
+                                             local_index=MmapVectorIndex(index_path) if index_path else None)
+    user_store = data_layer.user_store(storage=storage, dim=dim)
+    recommendations = RecommendationCache(redis_client, product_store)
+    if os.getenv("RECOMMENDATION_REFRESHER", "1") == "1":
+        # workers share recs:stale, SPOP hands every entry to one of them
+        RecommendationRefresher(recommendations, user_store).start()
+    return Services(aibox=aibox,
+                    product_store=product_store,
+                    user_store=user_store,
+                    slogan_store=RedisSloganStore(redis_client),
+                    recommendations=recommendations,
+                    icons=IconLibrary(os.getenv("ICON_LIBRARY", "icons")))
+
+
+def slogan_job(slogan_store: RedisSloganStore, aibox: AIBox, product_key: str, product: Product, keywords: list) -> bytes:
+    return get_slogan(slogan_store, aibox, product_key, product, keywords).encode("utf-8")
+
+
+def render_job(product: Product,
+               image_future: concurrent.futures.Future,
+               dimensions: Tuple[int, int],
+               slogan: str,
+               icon_path: Optional[str],
+               deadline: float) -> bytes:
+    """Composes the banner with the render service, returns its raw RGBA pixels"""
+    image_path, image_data, main_color = image_future.result()
+    product = Product(product.name, product.description, image_path)
+    image_sources = {image_path: image_data}
+    if icon_path is not None:
+        image_sources[icon_path] = read_icon(icon_path)
+    return render_service().render(product, dimensions, slogan, main_color, image_sources, None,
+                                   deadline=deadline, icon_path=icon_path)
+
+
+def encode_job(digest: str, pixels: bytes, dimensions: Tuple[int, int], image_format: str) -> bytes:
+    """Encodes a composed banner and stores it in the banner cache"""
+    with timed("encode"):
+        banner = encode_banner(Image.frombytes("RGBA", dimensions, pixels), image_format)
+    banner_cache.put(digest, banner)
+    return banner
+
+
+@functools.lru_cache(maxsize=64)
+def default_creative(width: int, height: int, image_format: str) -> bytes:
+    """Plain product-independent banner served when the pipeline runs out of time, rendered once per size"""
+    creative = Image.open(DEFAULT_CREATIVE).convert("RGBA")
+    creative.thumbnail((width, height))
+    banner = Image.new("RGBA", (width, height), (255, 255, 255, 255))
+    banner.paste(creative, ((width - creative.width) // 2, (height - creative.height) // 2), creative)
+    if image_format == "JPEG":
+        banner = banner.convert("RGB")
+    output = io.BytesIO()
+    banner.save(output, image_format)
+    return output.getvalue()
+
+
+def banner_response(banner: Optional[bytes], digest: Optional[str], mimetype: str, budget: LatencyBudget) -> Response:
+    """
+    Response with strong ETag and cache headers, 304 without body when the client has this banner.
+    Degraded banners are listed in X-Banner-Fallback and must not be reused
+    """
+    response = Response(banner if banner is not None else b"", status=200 if banner is not None else 304, mimetype=mimetype)
+    if budget.fallbacks:
+        response.headers["X-Banner-Fallback"] = ",".join(budget.fallbacks)
+        response.cache_control.no_store = True
+        return response
+    response.set_etag(digest)
+    response.cache_control.private = True
+    response.cache_control.max_age = BANNER_MAX_AGE
+    return response
+
+
+def _lookup(current: Services, user_key: Optional[str], user: User) -> List[ProductMatch]:
+    if user_key is not None:
+        return current.recommendations.get(user_key, user, 1)
+    return current.product_store.find_similar_from_embedding(user.embedding, 1, "embedding")
+
+
+def _banner_user(body: Optional[dict], user_key: Optional[str]) -> User:
+    """User from the user query parameter, or the legacy JSON body with keywords and embedding"""
+    if user_key is not None:
+        user = services().user_store.get_user(user_key)
+        if user is None:
+            abort(404, description="No such user")
+        if user.embedding is None:
+            abort(409, description="User embedding is not computed yet")
+        return user
+    if body is None:
+        abort(400, description="Either user parameter or JSON body is required")
+    try:
+        user = User.from_json(body, services().product_store.dim)
+    except jsonschema.ValidationError as e:
+        abort(400, description=f"Bad JSON input: {e.message}")
+    except ValueError as e:
+        abort(400, description=f"Bad JSON input: {e}")
+    if user.embedding is None:
+        abort(400, description="JSON body requires an embedding")
+    return user
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text format metrics of this worker process"""
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/get_banner', methods=['GET'])
+async def get_banner():
+    """
+    GET /get_banner?width=728&height=90&user=user:1[&format=png|jpeg|webp]
+    Stages run as soon as their inputs are known: user and KNN lookup first, then image fetch and decode
+    concurrently with the slogan, then composing in the process pool and encoding on a thread.
+    Once the slogan is known the banner digest answers If-None-Match and banner cache lookups.
+    Concurrent identical image, slogan, render and encode jobs are coalesced.
+    Every stage gets a share of the BANNER_BUDGET_MS latency budget, a stage running out of it is replaced by
+    the last recommendation served to the user, a generic slogan, a banner cache miss or the default creative
+    """
+    try:
+        width = int(request.args["width"])
+        height = int(request.args["height"])
+    except (KeyError, ValueError):
+        abort(400, description="width and height are required")
+    if width <= 0 or height <= 0:
+        abort(400, description="width and height must be positive")
+    image_format, mimetype = BANNER_FORMATS.get(request.args.get("format", "png"), BANNER_FORMATS["png"])
+
+    trace = Trace("get_banner", width=width, height=height, user=request.args.get("user"))
+    try:
+        with trace.span("request"):
+            return await _serve_banner(trace, width, height, image_format, mimetype)
+    finally:
+        if trace_exporter is not None:
+            trace_exporter.export(trace)
+
+
+async def _serve_banner(trace: Trace, width: int, height: int, image_format: str, mimetype: str) -> Response:
+    loop = asyncio.get_running_loop()
+    current = services()
+    budget = LatencyBudget(BANNER_BUDGET, trace=trace)
+    user_key = request.args.get("user")
+    user = await budget.run("user", loop.run_in_executor(None, _banner_user, request.get_json(silent=True), user_key),
+                            "default_creative", lambda: None,
+                            fallback_on=(redis.RedisError,))
+    if user is None:
+        return banner_response(default_creative(width, height, image_format), None, mimetype, budget)
+
+    matches = await budget.run("lookup", loop.run_in_executor(None, _lookup, current, user_key, user),
+                               "last_recommendation",
+                               lambda: current.recommendations.last_known(user_key) if user_key is not None else None,
+                               fallback_on=(RuntimeError, redis.RedisError))
+    if not matches:
+        budget.record_fallback("default_creative")
+        return banner_response(default_creative(width, height, image_format), None, mimetype, budget)
+    match: ProductMatch = matches[0]
+    product = match.to_product()
+
+    # shared with concurrent requests for the same image, so it is never cancelled, requests just stop waiting
+    image_future = image_flights.submit(f"image:{match.image_link}:{width}x{height}", load_image, match.image_link, width, height)
+    slogan_future = flights.submit(f"slogan:{match.key}:{segment_of(user.keywords)}",
+                                   slogan_job, current.slogan_store, current.aibox, match.key, product, user.keywords,
+                                   shared=True)
+    slogan = (await budget.run("slogan", asyncio.wrap_future(slogan_future),
+                               "generic_slogan", lambda: GENERIC_SLOGAN.format(name=product.name).encode("utf-8"),
+                               fallback_on=(Exception,))).decode("utf-8")
+
+    # the banner is fully determined at this point, repeated impressions end here
+    icon_path = current.icons.icon_for(user.embedding, width, height)
+    digest = banner_digest("basicxmltemplate", match.key, product.name, match.image_link, slogan, (width, height), image_format,
+                           icon_path)
+    not_modified = request.if_none_match.contains(digest)
+    record_cache("http_conditional", not_modified)
+    if not_modified:
+        return banner_response(None, digest, mimetype, budget)
+    # a slow shared tier is treated as a miss
+    banner = await budget.run("banner_cache", loop.run_in_executor(None, banner_cache.get, digest),
+                              "banner_cache_miss", lambda: None,
+                              fallback_on=(redis.RedisError, OSError))
+    if banner is not None:
+        return banner_response(banner, digest, mimetype, budget)
+
+    # concurrent requests for the same banner wait for the first one, which uses its own image prefetch
+    render_future = flights.submit(f"render:{digest}", render_job, product, image_future,
+                                   (width, height), slogan, icon_path, budget.timeout_for("render"), shared=True)
+    # an overloaded pool, a missing or broken product image and any other render failure all serve the default creative
+    pixels = await budget.run("render", asyncio.wrap_future(render_future),
+                              "default_creative", lambda: None,
+                              fallback_on=(RenderOverloaded, RenderDeadlineExceeded, OSError, Exception))
+    if pixels is None:
+        return banner_response(default_creative(width, height, image_format), None, mimetype, budget)
+    encode_future = encode_flights.submit(f"encode:{digest}", encode_job, digest, pixels, (width, height), image_format,
+                                          shared=True)
+    banner = await budget.run("encode", asyncio.wrap_future(encode_future), "default_creative", lambda: None,
+                              fallback_on=(Exception,))
+    if banner is None:
+        return banner_response(default_creative(width, height, image_format), None, mimetype, budget)
+    return banner_response(banner, digest, mimetype, budget)
 
 
 # # this one returns page
@@ -30,7 +341,8 @@ redis_client = redis.Redis(host="localhost", port=6379, decode_responses=True)
 if __name__ == "__main__":
     load_dotenv()
     
-    aibox = OpenAIBox(openai_key=os.getenv("OPENAI_KEY"))
+    aibox = OpenAIBox(openai_key=os.getenv("OPENAI_KEY"),
+                      dimensions=int(os.getenv("EMBEDDING_DIM", DEFAULT_EMBEDDING_DIM)))
     
     product_json = {
         "name": "Yorkshire Tea",
@@ -48,7 +360,7 @@ if __name__ == "__main__":
     slogan = aibox.ad_text(product.name,
                            product.description,
                            user.keywords,
-                           "Generate a short slogan for the product ad. Slogan should reference both product and user preferences where appropriate. Slogan should be catchy and memorable. Slogan should be less that 10 words in length. Output just slogan and nothing else. Do NOT wrap the slogan into quotation marks.")
+                           DEFAULT_SLOGAN_INSTRUCTIONS)
     # template = BasicXMLTemplate(product,
     #                      (800, 200),
     #                      slogan,
@@ -0,0 +1,124 @@
+"""
+Migrates product:* and user:* keys from JSON documents with float arrays to HASHes with
+packed float32 embeddings (RedisProductStore/RedisUserStore storage="hash").
+
+The migration is safe to run on a live database and to re-run after an interruption:
+    1. a HASH index <index>_hash is created next to the existing JSON index, with the same vector algorithm
+       (an HNSW index built by rebuild_index.py stays HNSW with its parameters), and its initial scan
+       finishes before any key is converted, so converted keys are indexed as they are written,
+    2. JSON keys are converted in batches, each batch in a MULTI/EXEC transaction,
+       keys that are already HASHes are skipped,
+    3. once the HASH index has caught up, <index> becomes an alias of the HASH index, so queries against
+       "productIdx" keep working, and the JSON index it pointed to is dropped (documents are kept).
+
+Usage: python migrate_vectors.py [--host localhost] [--port 6379] [--dim 1536] [--batch 500] [--dry-run]
+"""
+import argparse
+from typing import Iterator, List, Optional
+
+import redis
+from redis import Redis
+
+from aibox import DEFAULT_EMBEDDING_DIM
+from dbcontrol import HNSWParams, Product, User, _create_redis_index, index_hnsw_params, swap_index_alias, wait_for_indexing
+
+
+def _scan_json_keys(redis_client: Redis, pattern: str, batch: int) -> Iterator[List[bytes]]:
+    keys = []
+    for key in redis_client.scan_iter(match=pattern, count=batch, _type="ReJSON-RL"):
+        keys.append(key)
+        if len(keys) >= batch:
+            yield keys
+            keys = []
+    if keys:
+        yield keys
+
+
+def _product_hash(data: dict) -> dict:
+    """HASH fields of a stored JSON product, every attribute Product knows is carried over"""
+    return Product.from_storage_dict(data).to_hash()
+
+
+def _user_hash(data: dict) -> dict:
+    """HASH fields of a stored JSON user, keyword weights and embedding bookkeeping included"""
+    return User.from_storage_dict(data).to_hash()
+
+
+def migrate_keys(redis_client: Redis, pattern: str, converter, batch: int, dry_run: bool) -> int:
+    """Converts JSON keys matching pattern to HASHes, returns number of converted keys"""
+    converted = 0
+    for keys in _scan_json_keys(redis_client, pattern, batch):
+        documents = redis_client.json().mget(keys, "$")
+        pipe = redis_client.pipeline(transaction=True)
+        for key, document in zip(keys, documents):
+            if not document:
+                continue
+            try:
+                fields = converter(document[0])
+            except (KeyError, ValueError) as e:
+                print(f"skipping {key!r}: {e}")
+                continue
+            pipe.delete(key)
+            pipe.hset(key, mapping=fields)
+            converted += 1
+        if not dry_run:
+            pipe.execute()
+        print(f"{pattern}: {converted} keys converted")
+    return converted
+
+
+def current_hnsw_params(redis_client: Redis, index_name: str) -> Optional[HNSWParams]:
+    """HNSW parameters of the index serving index_name, None if it is FLAT or does not exist"""
+    try:
+        return index_hnsw_params(redis_client, index_name)
+    except redis.exceptions.ResponseError:
+        return None
+
+
+def create_hash_index(redis_client: Redis, index_name: str, dim: int, dry_run: bool,
+                      hnsw: Optional[HNSWParams] = None) -> None:
+    """
+    Creates the HASH index next to the JSON one and waits for its scan of existing HASH keys
+    :param hnsw: parameters of the JSON index if it is HNSW, see current_hnsw_params
+    """
+    hash_index_name = index_name + "_hash"
+    print(f"Index '{hash_index_name}': {hnsw if hnsw is not None else 'FLAT'}")
+    if dry_run:
+        return
+    try:
+        _create_redis_index(redis_client, hash_index_name, storage="hash", dim=dim, hnsw=hnsw)
+    except RuntimeError:
+        print(f"Index '{hash_index_name}' already exists, reusing it")
+    wait_for_indexing(redis_client, hash_index_name)
+
+
+def swap_index(redis_client: Redis, index_name: str, dry_run: bool) -> None:
+    """Points index_name alias at the HASH index once it indexed all converted keys and drops the JSON index"""
+    hash_index_name = index_name + "_hash"
+    if dry_run:
+        return
+    wait_for_indexing(redis_client, hash_index_name)
+    previous = swap_index_alias(redis_client, index_name, hash_index_name)
+    # an index named like the alias has already been dropped by swap_index_alias
+    if previous is not None and previous not in (index_name, hash_index_name):
+        redis_client.ft(previous).dropindex(delete_documents=False)
+        print(f"Dropped index '{previous}'")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate JSON vectors to packed float32 HASH storage")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--index", default="productIdx")
+    parser.add_argument("--dim", type=int, default=DEFAULT_EMBEDDING_DIM)
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    # packed vectors are binary, so keys are converted by a client that does not decode responses
+    binary_client = Redis(host=args.host, port=args.port, decode_responses=False)
+    redis_client = Redis(host=args.host, port=args.port, decode_responses=True)
+    create_hash_index(redis_client, args.index, args.dim, args.dry_run, current_hnsw_params(redis_client, args.index))
+    migrate_keys(binary_client, "product:*", _product_hash, args.batch, args.dry_run)
+    migrate_keys(binary_client, "user:*", _user_hash, args.batch, args.dry_run)
+    swap_index(redis_client, args.index, args.dry_run)
@@ -0,0 +1,128 @@
+"""
+Token counts of slogan prompts built from full product descriptions and from ingest-time summaries.
+
+Products are read from an ingest file (JSONL or CSV, products without a summary are summarized with
+the AIBox like ingest.py does) or sampled from the product store with --redis. Both prompts are built
+exactly as OpenAIBox.ad_text sends them, system instructions included. Token counts use tiktoken when
+it is installed and a rough word and punctuation count otherwise.
+
+Usage: python prompt_report.py products.jsonl [--local-aibox] [--limit 200] [--keywords "tea,TV shows,cacti"]
+       python prompt_report.py --redis [--shards host:port,...] [--storage json|hash] [--limit 200] [--report report.json]
+"""
+import argparse
+import json
+import os
+import re
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from aibox import AIBox, LocalAIBox, OpenAIBox, DEFAULT_EMBEDDING_DIM, ad_text_prompt
+from datalayer import RedisDataLayer
+from dbcontrol import Product, RedisProductStore
+from slogans import DEFAULT_SLOGAN_INSTRUCTIONS
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+def token_counter(model: str) -> Callable[[str], int]:
+    if tiktoken is None:
+        print("tiktoken is not installed, token counts are approximate")
+        return lambda text: len(re.findall(r"\w+|[^\w\s]", text))
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("o200k_base")
+    return lambda text: len(encoding.encode(text))
+
+
+def products_from_file(path: str, aibox: AIBox, limit: int) -> List[Product]:
+    from ingest import read_records
+    file_format = "csv" if path.endswith(".csv") else "jsonl"
+    products = []
+    for record in read_records(path, file_format):
+        product = Product.from_json(record)
+        if product.summary is None:
+            product.summarize(aibox)
+        products.append(product)
+        if len(products) >= limit:
+            break
+    return products
+
+
+def products_from_store(product_store: RedisProductStore, limit: int) -> List[Product]:
+    keys = product_store.scan_product_keys(limit)
+    return [product for product in product_store.get_products(keys) if product is not None]
+
+
+def prompt_report(products: List[Product],
+                  count_tokens: Callable[[str], int],
+                  user_keywords: List[str],
+                  instructions: str = DEFAULT_SLOGAN_INSTRUCTIONS) -> Dict[str, object]:
+    """Compares prompts with full descriptions to prompts with Product.prompt_description"""
+    instruction_tokens = count_tokens(instructions)
+    full = np.array([count_tokens(ad_text_prompt(p.name, p.description, user_keywords)) for p in products]) + instruction_tokens
+    compact = np.array([count_tokens(ad_text_prompt(p.name, p.prompt_description(), user_keywords)) for p in products]) + instruction_tokens
+
+    def stats(values: np.ndarray) -> Dict[str, float]:
+        return {"mean": float(values.mean()), "p50": float(np.percentile(values, 50)),
+                "p95": float(np.percentile(values, 95)), "max": float(values.max()), "total": int(values.sum())}
+
+    return {
+        "products": len(products),
+        "summarized": sum(1 for p in products if p.summary),
+        "instruction_tokens": instruction_tokens,
+        "full_description": stats(full),
+        "summary": stats(compact),
+        "reduction": float(1 - compact.sum() / full.sum()),
+    }
+
+
+def print_report(report: Dict[str, object]) -> None:
+    print(f"{report['products']} products, {report['summarized']} with summaries, "
+          f"system instructions {report['instruction_tokens']} tokens")
+    print(f"{'prompt tokens':<18}{'mean':>8}{'p50':>8}{'p95':>8}{'max':>8}{'total':>10}")
+    for name in ("full_description", "summary"):
+        row = report[name]
+        print(f"{name:<18}{row['mean']:>8.1f}{row['p50']:>8.0f}{row['p95']:>8.0f}{row['max']:>8.0f}{row['total']:>10}")
+    print(f"prompt tokens reduced by {report['reduction']:.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Token counts of slogan prompts with and without summaries")
+    parser.add_argument("input", nargs="?", default=None, help="ingest file, products are read from Redis with --redis")
+    parser.add_argument("--redis", action="store_true")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--shards", default=None, help="host:port[/db],... of product shards, PRODUCT_SHARDS by default")
+    parser.add_argument("--storage", choices=["json", "hash"], default="json")
+    parser.add_argument("--dim", type=int, default=DEFAULT_EMBEDDING_DIM)
+    parser.add_argument("--local-aibox", action="store_true", help="summarize with network-free LocalAIBox")
+    parser.add_argument("--limit", type=int, default=200)
+    parser.add_argument("--keywords", default="tea,TV shows,royal family", help="user keywords of the prompts")
+    parser.add_argument("--model", default="gpt-4o-mini", help="model whose tokenizer is used")
+    parser.add_argument("--report", default=None, help="write the report as JSON")
+    args = parser.parse_args()
+    if args.redis == (args.input is not None):
+        parser.error("give either an input file or --redis")
+
+    load_dotenv()
+    if args.redis:
+        data_layer = RedisDataLayer(host=args.host, port=args.port, product_shards=args.shards or os.getenv("PRODUCT_SHARDS"))
+        store = data_layer.product_store(storage=args.storage, dim=args.dim)
+        products = products_from_store(store, args.limit)
+    else:
+        aibox = LocalAIBox(dimensions=args.dim) if args.local_aibox else OpenAIBox(os.getenv("OPENAI_KEY"), dimensions=args.dim)
+        products = products_from_file(args.input, aibox, args.limit)
+    if not products:
+        parser.error("no products found")
+
+    report = prompt_report(products, token_counter(args.model), args.keywords.split(","))
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as file:
+            json.dump(report, file, indent=2)
@@ -0,0 +1,63 @@
+"""
+Online rebuild of the product vector index, e.g. converting the FLAT productIdx to HNSW.
+
+A new index is built next to the live one over the same product: keys, and once the background
+scan has finished the productIdx alias is atomically switched to it. Queries keep being served by
+the old index for the whole rebuild. The old index is kept unless --drop-old is given
+(documents are never deleted). With --shards (or PRODUCT_SHARDS) the index of every product shard is rebuilt
+one after another.
+
+Usage: python rebuild_index.py --algorithm HNSW [--m 16] [--ef-construction 200] [--ef-runtime 10]
+                               [--storage json|hash] [--dim 1536] [--alias productIdx] [--drop-old] [--shards host:port,...]
+"""
+import argparse
+import os
+import time
+
+from redis import Redis
+
+from aibox import DEFAULT_EMBEDDING_DIM
+from dbcontrol import HNSWParams, _create_redis_index, swap_index_alias, wait_for_indexing
+from shardedstore import parse_shards
+
+
+def rebuild_index(redis_client: Redis,
+                  alias: str,
+                  storage: str,
+                  dim: int,
+                  hnsw: HNSWParams = None,
+                  drop_old: bool = False) -> str:
+    """Builds a new index, swaps alias to it and returns the new index name"""
+    algorithm = "hnsw" if hnsw is not None else "flat"
+    new_index = f"{alias}_{algorithm}_{int(time.time())}"
+    _create_redis_index(redis_client, new_index, storage, dim, hnsw)
+    wait_for_indexing(redis_client, new_index)
+    previous = swap_index_alias(redis_client, alias, new_index)
+    print(f"'{alias}' now points to '{new_index}' (was '{previous}')")
+    # an index named like the alias has already been dropped by swap_index_alias
+    if drop_old and previous is not None and previous not in (alias, new_index):
+        redis_client.ft(previous).dropindex(delete_documents=False)
+        print(f"Dropped index '{previous}'")
+    return new_index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild product vector index and swap productIdx alias to it")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--shards", default=None, help="host:port[/db],... of product shards, PRODUCT_SHARDS by default")
+    parser.add_argument("--alias", default="productIdx")
+    parser.add_argument("--storage", choices=["json", "hash"], default="json")
+    parser.add_argument("--dim", type=int, default=DEFAULT_EMBEDDING_DIM)
+    parser.add_argument("--algorithm", choices=["FLAT", "HNSW"], default="HNSW")
+    parser.add_argument("--m", type=int, default=HNSWParams.m)
+    parser.add_argument("--ef-construction", type=int, default=HNSWParams.ef_construction)
+    parser.add_argument("--ef-runtime", type=int, default=HNSWParams.ef_runtime)
+    parser.add_argument("--drop-old", action="store_true")
+    args = parser.parse_args()
+
+    hnsw = HNSWParams(args.m, args.ef_construction, args.ef_runtime) if args.algorithm == "HNSW" else None
+    shards = args.shards or os.getenv("PRODUCT_SHARDS")
+    for host, port, db in parse_shards(shards) if shards else [(args.host, args.port, 0)]:
+        redis_client = Redis(host=host, port=port, db=db, decode_responses=True)
+        rebuild_index(redis_client, args.alias, args.storage, args.dim, hnsw, args.drop_old)
@@ -0,0 +1,202 @@
+"""
+Per-user cache of top-k product matches.
+
+KNN results only change when the user embedding or the catalog changes, so they are cached per user
+together with the user's embedding_version and the catalog_version counter maintained by RedisProductStore:
+    recs:<user key>:<filter digest>   HASH  matches (JSON), k, filters (JSON), embedding_version, catalog_version, computed_at
+    recs:stale                        SET   "<user key>|<filter digest>" entries waiting for a background refresh
+A new user embedding always means a synchronous query. An entry outdated only by catalog changes is
+served as is and refreshed in the background, unless it is more than max_stale_versions behind.
+The catalog version is read from Redis at most once per catalog_version_ttl seconds per process.
+"""
+import collections
+import dataclasses
+import datetime
+import hashlib
+import json
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from redis import Redis
+
+from dbcontrol import ProductFilter, ProductMatch, RedisProductStore, RedisUserStore, User
+from metrics import record_cache
+
+
+def filter_digest(filters: Optional[ProductFilter]) -> str:
+    if filters is None or filters.is_empty():
+        return "all"
+    return hashlib.sha1(filters.to_query().encode("utf-8")).hexdigest()[:16]
+
+
+class RecommendationCache:
+    def __init__(self,
+                 redis_client: Redis,
+                 product_store: RedisProductStore,
+                 vector_field: str = "embedding",
+                 ttl: datetime.timedelta = datetime.timedelta(hours=6),
+                 max_stale_versions: Optional[int] = 100,
+                 max_local_entries: int = 100000,
+                 catalog_version_ttl: float = 1.0) -> None:
+        """
+        :param ttl: entries expire from Redis after this time without being refreshed
+        :param max_stale_versions: catalog changes after which an entry is recomputed on the request path
+                                   instead of being served and refreshed in the background. None never blocks
+        :param max_local_entries: size of the in-process LRU of last served matches, see last_known
+        :param catalog_version_ttl: seconds a catalog version read from Redis is reused by get, 0 reads it on every request
+        """
+        self.redis_client = redis_client
+        self.product_store = product_store
+        self.vector_field = vector_field
+        self.ttl = ttl
+        self.max_stale_versions = max_stale_versions
+        self.max_local_entries = max_local_entries
+        self._last_served = collections.OrderedDict()
+        self.catalog_version_ttl = catalog_version_ttl
+        self._catalog_version: Optional[Tuple[float, int]] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(user_key: str, digest: str) -> str:
+        return f"recs:{user_key}:{digest}"
+
+    def _compute(self, user: User, k: int, filters: Optional[ProductFilter]) -> List[ProductMatch]:
+        return self.product_store.find_similar_from_embedding(user.embedding, k, self.vector_field, filters=filters)
+
+    def put(self, user_key: str, user: User, k: int, filters: Optional[ProductFilter],
+            matches: List[ProductMatch], catalog_version: int) -> None:
+        key = self._key(user_key, filter_digest(filters))
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.hset(key, mapping={
+            "matches": json.dumps([dataclasses.asdict(match) for match in matches]),
+            "k": k,
+            # kept for background refreshes
+            "filters": json.dumps(dataclasses.asdict(filters)) if filters is not None and not filters.is_empty() else "",
+            "embedding_version": user.embedding_version,
+            "catalog_version": catalog_version,
+            "computed_at": datetime.datetime.now().isoformat(),
+        })
+        pipe.expire(key, int(self.ttl.total_seconds()))
+        pipe.execute()
+
+    def _cached_catalog_version(self) -> int:
+        # a version older than the real one is safe: entries computed with it are refreshed once served
+        now = time.monotonic()
+        with self._lock:
+            cached = self._catalog_version
+        if cached is not None and now - cached[0] < self.catalog_version_ttl:
+            return cached[1]
+        catalog_version = self.product_store.catalog_version()
+        with self._lock:
+            self._catalog_version = (now, catalog_version)
+        return catalog_version
+
+    def _remember(self, user_key: str, digest: str, matches: List[ProductMatch]) -> None:
+        with self._lock:
+            self._last_served[(user_key, digest)] = matches
+            self._last_served.move_to_end((user_key, digest))
+            while len(self._last_served) > self.max_local_entries:
+                self._last_served.popitem(last=False)
+
+    def last_known(self, user_key: str, filters: Optional[ProductFilter] = None) -> Optional[List[ProductMatch]]:
+        """
+        Matches last served to the user by this process, regardless of versions and without touching Redis.
+        For degraded serving when a fresh lookup cannot be afforded
+        """
+        with self._lock:
+            return self._last_served.get((user_key, filter_digest(filters)))
+
+    def get(self, user_key: str, user: User, k: int, filters: Optional[ProductFilter] = None) -> List[ProductMatch]:
+        """
+        Returns top-k matches for the user, from cache when the entry still answers the request
+        """
+        digest = filter_digest(filters)
+        # the product store knows where its version lives, e.g. summed over the shards of ShardedProductStore
+        catalog_version = self._cached_catalog_version()
+        entry = self.redis_client.hgetall(self._key(user_key, digest))
+
+        if (entry
+                and int(entry["embedding_version"]) == user.embedding_version
+                and int(entry["k"]) >= k):
+            behind = catalog_version - int(entry["catalog_version"])
+            if behind <= 0 or self.max_stale_versions is None or behind <= self.max_stale_versions:
+                if behind > 0:
+                    self.redis_client.sadd("recs:stale", f"{user_key}|{digest}")
+                matches = [ProductMatch(**match) for match in json.loads(entry["matches"])[:k]]
+                self._remember(user_key, digest, matches)
+                record_cache("recommendations", True)
+                return matches
+
+        record_cache("recommendations", False)
+        # version is read before the query, so a concurrent catalog change leaves the entry outdated rather than hiding it
+        matches = self._compute(user, k, filters)
+        self.put(user_key, user, k, filters, matches, catalog_version)
+        self._remember(user_key, digest, matches)
+        return matches
+
+    def invalidate(self, user_key: str) -> None:
+        """Drops all entries of the user, e.g. after the user was deleted"""
+        keys = list(self.redis_client.scan_iter(match=f"recs:{user_key}:*"))
+        if keys:
+            self.redis_client.delete(*keys)
+
+    def pop_stale(self, count: int) -> List[Tuple[str, str]]:
+        members = self.redis_client.spop("recs:stale", count) or []
+        return [tuple(member.split("|", 1)) for member in members]
+
+    def refresh_entry(self, user_key: str, digest: str, user: User) -> bool:
+        """
+        Recomputes an entry outdated by catalog changes, keeps its k and filters.
+        Returns False if the entry is gone or the user embedding changed since
+        """
+        entry = self.redis_client.hgetall(self._key(user_key, digest))
+        if not entry or int(entry["embedding_version"]) != user.embedding_version:
+            return False
+        filters = ProductFilter(**json.loads(entry["filters"])) if entry.get("filters") else None
+        catalog_version = self.product_store.catalog_version()
+        k = int(entry["k"])
+        self.put(user_key, user, k, filters, self._compute(user, k, filters), catalog_version)
+        return True
+
+
+class RecommendationRefresher(threading.Thread):
+    """
+    Background worker recomputing cache entries served while outdated by catalog changes
+    """
+    def __init__(self,
+                 cache: RecommendationCache,
+                 user_store: RedisUserStore,
+                 batch_size: int = 100,
+                 interval: float = 1.0) -> None:
+        super().__init__(daemon=True, name="RecommendationRefresher")
+        self.cache = cache
+        self.user_store = user_store
+        self.batch_size = batch_size
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            refreshed = 0
+            try:
+                refreshed = self.run_once()
+            except Exception as e:
+                print(f"RecommendationRefresher: {e}")
+            if refreshed < self.batch_size:
+                self._stop_event.wait(self.interval)
+
+    def run_once(self) -> int:
+        """Refreshes one batch of outdated entries, returns number of refreshed entries"""
+        entries = self.cache.pop_stale(self.batch_size)
+        if not entries:
+            return 0
+        users = self.user_store.get_users([user_key for user_key, _ in entries])
+        refreshed = 0
+        for (user_key, digest), user in zip(entries, users):
+            if user is not None and user.embedding is not None and self.cache.refresh_entry(user_key, digest, user):
+                refreshed += 1
+        return refreshed
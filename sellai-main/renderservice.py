@@ -0,0 +1,239 @@
+"""
+Render service: a pool of pre-warmed worker processes composing banners off the web worker's threads.
+
+Workers import the templates, compile them and load all fonts once at start. The service admits at most
+max_queue jobs (queued and running), and rejects the rest immediately with RenderOverloaded. Every job
+has a deadline: jobs still queued when it passes are cancelled or skipped by the worker, and waiting
+callers get RenderDeadlineExceeded. The web tier answers both with the default creative, marked as
+the default_creative fallback in X-Banner-Fallback, rather than with an error.
+"""
+import collections
+import concurrent.futures
+import io
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from PIL import Image
+
+from dbcontrol import Product
+from metrics import STAGE_SECONDS
+
+
+TEMPLATES = ("basicxmltemplate",)
+
+
+class RenderOverloaded(RuntimeError):
+    """The job queue is full, the caller should shed load"""
+
+
+class RenderDeadlineExceeded(RuntimeError):
+    """The job did not finish before its deadline"""
+
+
+def warm_up(font_dir: str, max_font_size: int) -> None:
+    """Worker initializer, loads templates and fonts before the first job arrives"""
+    import templates.basicxmltemplate.basicxmltemplate as basicxmltemplate
+    from visualnode import load_font
+    template_path = os.path.join(os.path.dirname(os.path.abspath(basicxmltemplate.__file__)), "basicxmltemplate.xml.j2")
+    basicxmltemplate._environment.get_template(template_path)
+    if os.path.isdir(font_dir):
+        for name in os.listdir(font_dir):
+            if name.endswith((".ttf", ".otf")):
+                for size in range(1, max_font_size + 1):
+                    load_font(os.path.join(font_dir, name), size)
+
+
+def compose_banner(template: str,
+                   product: Product,
+                   dimensions: Tuple[int, int],
+                   slogan: str,
+                   main_color: Tuple[int, int, int, int],
+                   image_sources: Dict[str, bytes],
+                   icon_path: Optional[str] = None) -> Tuple[Image.Image, Dict[str, float]]:
+    """
+    Composes one banner in the calling process, returns the RGBA image of the given dimensions
+    with durations of template and layout stages
+    :param icon_path: icon raster, its contents may be given in image_sources too
+    """
+    if template not in TEMPLATES:
+        raise ValueError(f"Unknown template: {template}")
+    from templates.basicxmltemplate.basicxmltemplate import BasicXMLTemplate
+    timings = {}
+    checkpoint = time.perf_counter()
+    root = BasicXMLTemplate(product, dimensions, slogan, main_color, icon_path).build_tree(image_sources)
+    timings["template"], checkpoint = time.perf_counter() - checkpoint, time.perf_counter()
+    banner = root.compose()
+    timings["layout"] = time.perf_counter() - checkpoint
+    return banner, timings
+
+
+def encode_banner(banner: Image.Image, image_format: str) -> bytes:
+    """Pillow encoders release the GIL, so encoding may run on threads of the web worker"""
+    if image_format == "JPEG":
+        banner = banner.convert("RGB")
+    output = io.BytesIO()
+    banner.save(output, image_format)
+    return output.getvalue()
+
+
+def render_banner(template: str,
+                  product: Product,
+                  dimensions: Tuple[int, int],
+                  slogan: str,
+                  main_color: Tuple[int, int, int, int],
+                  image_sources: Dict[str, bytes],
+                  image_format: Optional[str],
+                  icon_path: Optional[str] = None) -> Tuple[bytes, Dict[str, float]]:
+    """
+    Composes and encodes one banner in the calling process,
+    returns it with durations of template, layout and encode stages
+    :param image_format: None returns raw RGBA pixels (Image.frombytes("RGBA", dimensions, ...)) left to encode
+                         by the caller, and no encode duration
+    :param icon_path: icon raster, its contents may be given in image_sources too
+    """
+    banner, timings = compose_banner(template, product, dimensions, slogan, main_color, image_sources, icon_path)
+    if image_format is None:
+        return banner.convert("RGBA").tobytes(), timings
+    checkpoint = time.perf_counter()
+    encoded = encode_banner(banner, image_format)
+    timings["encode"] = time.perf_counter() - checkpoint
+    return encoded, timings
+
+
+def _render(template: str,
+            product: Product,
+            dimensions: Tuple[int, int],
+            slogan: str,
+            main_color: Tuple[int, int, int, int],
+            image_sources: Dict[str, bytes],
+            image_format: Optional[str],
+            icon_path: Optional[str],
+            deadline: float) -> Tuple[bytes, float, Dict[str, float]]:
+    """
+    Runs in a worker process, returns the banner encoded as render_banner does, the time the job started
+    and the durations of its stages
+    """
+    started = time.time()
+    if started > deadline:
+        raise RenderDeadlineExceeded("Deadline passed while the job was queued")
+    banner, timings = render_banner(template, product, dimensions, slogan, main_color, image_sources, image_format, icon_path)
+    return banner, started, timings
+
+
+class RenderService:
+    def __init__(self,
+                 workers: Optional[int] = None,
+                 max_queue: Optional[int] = None,
+                 default_deadline: float = 2.0,
+                 font_dir: str = "fonts",
+                 max_font_size: int = 120) -> None:
+        """
+        :param workers: number of worker processes, one per CPU by default
+        :param max_queue: maximal number of admitted jobs (queued and running), 4 per worker by default
+        :param default_deadline: seconds a job may take from submission to result
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue or 4 * self.workers
+        self.default_deadline = default_deadline
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                           initializer=warm_up,
+                                                           initargs=(font_dir, max_font_size))
+        self._slots = threading.BoundedSemaphore(self.max_queue)
+        self._lock = threading.Lock()
+        self._depth = 0
+        self._counters = collections.Counter()
+        self._queue_times = collections.deque(maxlen=1000)
+        # starts the workers now rather than on the first request
+        self.pool.submit(time.time).result()
+
+    def queue_depth(self) -> int:
+        """Number of admitted jobs, queued or running"""
+        with self._lock:
+            return self._depth
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            queue_times = np.array(self._queue_times) if self._queue_times else np.zeros(1)
+            return {
+                "queue_depth": self._depth,
+                "max_queue": self.max_queue,
+                "submitted": self._counters["submitted"],
+                "completed": self._counters["completed"],
+                "rejected": self._counters["rejected"],
+                "expired": self._counters["expired"],
+                "failed": self._counters["failed"],
+                "queue_time_p50": float(np.percentile(queue_times, 50)),
+                "queue_time_p95": float(np.percentile(queue_times, 95)),
+            }
+
+    def _release(self, submitted: float, future: concurrent.futures.Future) -> None:
+        with self._lock:
+            self._depth -= 1
+            if future.cancelled():
+                self._counters["expired"] += 1
+            elif isinstance(future.exception(), RenderDeadlineExceeded):
+                self._counters["expired"] += 1
+            elif future.exception() is not None:
+                self._counters["failed"] += 1
+            else:
+                self._counters["completed"] += 1
+                _, started, timings = future.result()
+                self._queue_times.append(started - submitted)
+                STAGE_SECONDS.observe(started - submitted, stage="render_queue")
+                for stage, duration in timings.items():
+                    STAGE_SECONDS.observe(duration, stage=stage)
+        self._slots.release()
+
+    def submit(self,
+               product: Product,
+               dimensions: Tuple[int, int],
+               slogan: str,
+               main_color: Tuple[int, int, int, int],
+               image_sources: Dict[str, bytes],
+               image_format: Optional[str] = "PNG",
+               template: str = "basicxmltemplate",
+               deadline: Optional[float] = None,
+               icon_path: Optional[str] = None) -> Tuple[concurrent.futures.Future, float]:
+        """
+        Admits a job, returns its future and the absolute deadline (time.time()).
+        Throws RenderOverloaded without waiting when the queue is full
+        :param image_format: None leaves encoding to the caller, see render_banner
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._counters["rejected"] += 1
+            raise RenderOverloaded(f"Render queue is full ({self.max_queue} jobs)")
+        submitted = time.time()
+        deadline_at = submitted + (deadline if deadline is not None else self.default_deadline)
+        with self._lock:
+            self._depth += 1
+            self._counters["submitted"] += 1
+        try:
+            future = self.pool.submit(_render, template, product, dimensions, slogan, main_color,
+                                      image_sources, image_format, icon_path, deadline_at)
+        except Exception:
+            with self._lock:
+                self._depth -= 1
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._release(submitted, f))
+        return future, deadline_at
+
+    def render(self, *args, **kwargs) -> bytes:
+        """
+        Blocking submit and wait, throws RenderOverloaded or RenderDeadlineExceeded
+        """
+        future, deadline_at = self.submit(*args, **kwargs)
+        try:
+            return future.result(timeout=max(0.0, deadline_at - time.time()))[0]
+        except concurrent.futures.TimeoutError:
+            # succeeds only if the job has not started yet, a running job finishes but its result is dropped
+            future.cancel()
+            raise RenderDeadlineExceeded("Render did not finish before its deadline")
+
+    def close(self) -> None:
+        self.pool.shutdown(cancel_futures=True)
@@ -0,0 +1,232 @@
+"""
+Product store sharded across several Redis instances.
+
+Every shard is a RedisProductStore with its own productIdx. Products are placed on shards by
+rendezvous hashing of their key, so adding or removing a shard only moves the products owned by it.
+Product keys are allocated from product_counter on the first shard, the coordinator. KNN queries
+are sent to all shards in parallel and their top-k lists are merged by cosine distance, unless a local
+vectorindex.MmapVectorIndex covering all shards answers them.
+Shard membership is a comma separated list of host:port[/db]. With the PRODUCT_SHARDS environment variable
+datalayer.RedisDataLayer.product_store returns a sharded store, so the service, ingest.py, vectorindex.py
+and the other tools building their store from the data layer use the shards.
+
+The self-check fills the shards with synthetic products and compares sharded KNN with exact search.
+WARNING: it writes product:* keys, run it against scratch instances, e.g.
+    redis-stack-server --port 6381 & redis-stack-server --port 6382 &
+
+Usage: python shardedstore.py --shards localhost:6381,localhost:6382 [--products 2000] [--dim 64] [--k 10] [--queries 20]
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import heapq
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from aibox import AIBox, DEFAULT_EMBEDDING_DIM
+from datalayer import RedisDataLayer
+from dbcontrol import HNSWParams, Product, ProductFilter, ProductMatch, RedisProductStore, wait_for_indexing
+from metrics import timed
+
+
+def parse_shards(spec: str) -> List[Tuple[str, int, int]]:
+    """Parses "host:port[/db],..." into (host, port, db) tuples"""
+    shards = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        address, _, db = item.partition("/")
+        host, _, port = address.rpartition(":")
+        if not host or not port:
+            raise ValueError(f"Invalid shard address: {item}, expected host:port[/db]")
+        shards.append((host, int(port), int(db or 0)))
+    if not shards:
+        raise ValueError("No shards configured")
+    return shards
+
+
+class ShardedProductStore:
+    def __init__(self,
+                 shards: Dict[str, RedisProductStore],
+                 max_workers: Optional[int] = None,
+                 allow_partial: bool = False,
+                 local_index = None) -> None:
+        """
+        :param shards: shard name (e.g. "host:port/db") -> store of the shard. The first shard allocates keys
+        :param max_workers: threads querying shards in parallel, one per shard by default
+        :param allow_partial: answer KNN queries from the remaining shards when some of them fail
+        :param local_index: optional vectorindex.MmapVectorIndex of all shards, see RedisProductStore
+        """
+        if not shards:
+            raise ValueError("No shards configured")
+        self.shards = shards
+        self.names = list(shards)
+        self.coordinator = shards[self.names[0]]
+        self.allow_partial = allow_partial
+        self.local_index = local_index
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(shards),
+                                                          thread_name_prefix="shard")
+
+    @classmethod
+    def from_spec(cls, spec: str, storage: str = "json", dim: int = DEFAULT_EMBEDDING_DIM,
+                  hnsw: Optional[HNSWParams] = None) -> "ShardedProductStore":
+        """Store over the shards of spec with default pool settings, the service configures them with datalayer"""
+        return RedisDataLayer(product_shards=spec).product_store(storage=storage, dim=dim, hnsw=hnsw)
+
+    @property
+    def dim(self) -> int:
+        return self.coordinator.dim
+
+    @property
+    def storage(self) -> str:
+        return self.coordinator.storage
+
+    def shard_name_for(self, key: str) -> str:
+        """Rendezvous hashing: the shard with the highest hash of (shard, key) owns the key"""
+        return max(self.names, key=lambda name: hashlib.md5(f"{name}|{key}".encode("utf-8")).digest())
+
+    def shard_for(self, key: str) -> RedisProductStore:
+        return self.shards[self.shard_name_for(key)]
+
+    def group_keys(self, keys: List[str]) -> Dict[str, List[int]]:
+        """Shard name -> positions of its keys"""
+        groups: Dict[str, List[int]] = {}
+        for position, key in enumerate(keys):
+            groups.setdefault(self.shard_name_for(key), []).append(position)
+        return groups
+
+    def allocate_product_keys(self, count: int) -> List[str]:
+        return self.coordinator.allocate_product_keys(count)
+
+    def save_product(self, product: Product, aibox: AIBox, summarize: bool = False) -> str:
+        key = self.allocate_product_keys(1)[0]
+        return self.shard_for(key).save_product(product, aibox, key=key, summarize=summarize)
+
+    def write_products(self, keys: List[str], products: List[Product]) -> None:
+        futures = [self.pool.submit(self.shards[name].write_products,
+                                    [keys[i] for i in positions], [products[i] for i in positions])
+                   for name, positions in self.group_keys(keys).items()]
+        for future in futures:
+            future.result()
+
+    def delete_product(self, key: str) -> bool:
+        return self.shard_for(key).delete_product(key)
+
+    def catalog_version(self) -> int:
+        # every shard counter only grows, so their sum changes whenever any shard changes
+        return sum(store.catalog_version() for store in self.shards.values())
+
+    def scan_product_keys(self, count: int) -> List[str]:
+        keys = []
+        for store in self.shards.values():
+            keys += store.scan_product_keys(count - len(keys))
+            if len(keys) >= count:
+                break
+        return keys
+
+    def get_product(self, key: str) -> Optional[Product]:
+        return self.shard_for(key).get_product(key)
+
+    def get_products(self, keys: List[str]) -> List[Optional[Product]]:
+        results: List[Optional[Product]] = [None] * len(keys)
+        groups = self.group_keys(keys)
+        futures = {name: self.pool.submit(self.shards[name].get_products, [keys[i] for i in positions])
+                   for name, positions in groups.items()}
+        for name, future in futures.items():
+            for position, product in zip(groups[name], future.result()):
+                results[position] = product
+        return results
+
+    def _find_similar_locally(self, embedding: np.ndarray, k: int) -> Optional[List[ProductMatch]]:
+        """Answers the query from the local index, fetching the matches from their shards. None if it cannot"""
+        try:
+            with timed("knn_local"):
+                scored_keys = self.local_index.search(embedding, k)[0]
+                groups = self.group_keys([key for key, _ in scored_keys])
+                futures = [self.pool.submit(self.shards[name]._fetch_matches, [scored_keys[i] for i in positions])
+                           for name, positions in groups.items()]
+                matches = sorted((match for future in futures for match in future.result()), key=lambda match: match.score)
+            if matches:
+                return matches
+        except Exception as e:
+            print(f"ShardedProductStore: local index failed, falling back to the shards: {e}")
+        return None
+
+    @staticmethod
+    def _query_shard(store: RedisProductStore, embedding: np.ndarray, k: int, vector_field: str,
+                     ef_runtime: Optional[int], filters: Optional[ProductFilter]) -> List[ProductMatch]:
+        try:
+            return store.find_similar_from_embedding(embedding, k, vector_field, ef_runtime=ef_runtime, filters=filters)
+        except RuntimeError:
+            # empty shard or nothing passing the filters
+            return []
+
+    def find_similar_from_embedding(self,
+                                    embedding: np.ndarray,
+                                    k: int,
+                                    vector_field: str,
+                                    ef_runtime: Optional[int] = None,
+                                    filters: Optional[ProductFilter] = None) -> List[ProductMatch]:
+        """
+        Queries top-k of every shard in parallel and returns the overall top-k by cosine distance.
+        Unfiltered queries are answered from the local index when there is one, see RedisProductStore
+        """
+        if self.local_index is not None and ef_runtime is None and (filters is None or filters.is_empty()):
+            local_result = self._find_similar_locally(embedding, k)
+            if local_result is not None:
+                return local_result
+
+        futures = {name: self.pool.submit(self._query_shard, store, embedding, k, vector_field, ef_runtime, filters)
+                   for name, store in self.shards.items()}
+        partial_results, failed = [], []
+        for name, future in futures.items():
+            try:
+                partial_results.append(future.result())
+            except Exception as e:
+                if not self.allow_partial:
+                    raise
+                print(f"ShardedProductStore: shard {name} failed: {e}")
+                failed.append(name)
+        if len(failed) == len(self.shards):
+            raise RuntimeError("All product shards failed")
+        matches = heapq.nsmallest(k, (match for result in partial_results for match in result), key=lambda match: match.score)
+        if not matches:
+            raise RuntimeError("Failed to retrieve any matching documents from Redis index")
+        return matches
+
+    def close(self) -> None:
+        self.pool.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded KNN self-check on scratch Redis instances")
+    parser.add_argument("--shards", required=True, help="host:port[/db],...")
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--dim", type=int, default=64)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    store = ShardedProductStore.from_spec(args.shards, storage="hash", dim=args.dim)
+    rng = np.random.default_rng(args.seed)
+    vectors = rng.normal(size=(args.products, args.dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    keys = store.allocate_product_keys(args.products)
+    store.write_products(keys, [Product(key, "synthetic product", "img/tea.png", embedding=vector)
+                                for key, vector in zip(keys, vectors)])
+    for name in store.names:
+        wait_for_indexing(store.shards[name].redis_client, store.shards[name].index_name)
+        owned = sum(1 for key in keys if store.shard_name_for(key) == name)
+        print(f"{name}: {owned} products")
+
+    queries = rng.normal(size=(args.queries, args.dim)).astype(np.float32)
+    found = 0
+    for query in queries:
+        exact = np.argsort(-(vectors @ (query / np.linalg.norm(query))))[:args.k]
+        matches = store.find_similar_from_embedding(query, args.k, "embedding")
+        found += len({keys[i] for i in exact} & {match.key for match in matches})
+    print(f"recall@{args.k} against exact search: {found / (args.k * args.queries):.4f}")
+    store.close()
@@ -0,0 +1,105 @@
+"""
+Coalescing of identical concurrent jobs.
+
+Within a process, callers submitting a key that is already in flight get the future of the running job
+instead of starting another one. With a Redis client, the job leader of every process first takes
+a short lock <prefix>:lock:<key>; the worker holding it computes and publishes the result under
+<prefix>:result:<key> for a few seconds, the others poll for it. Shared jobs have to return bytes.
+"""
+import concurrent.futures
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+from redis import Redis
+
+from metrics import record_cache
+
+
+# deletes the lock only if it is still held by the caller, it may have expired and been taken over
+_RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    def __init__(self,
+                 executor: Optional[concurrent.futures.Executor] = None,
+                 redis_client: Optional[Redis] = None,
+                 lock_ttl: float = 30.0,
+                 result_ttl: float = 10.0,
+                 poll_interval: float = 0.05,
+                 prefix: str = "singleflight") -> None:
+        """
+        :param executor: runs the jobs, a dedicated thread pool if None
+        :param redis_client: client without response decoding enabling coalescing across workers
+        :param lock_ttl: seconds after which a lock of a crashed worker expires,
+                         waiters stop polling and compute the result themselves after this time
+        :param result_ttl: seconds a published result stays available to late waiters
+        """
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix="singleflight")
+        self.redis_client = redis_client
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.prefix = prefix
+        self._flights: Dict[str, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._flights)
+
+    def submit(self, key: str, fn: Callable[..., Any], *args, shared: bool = False) -> concurrent.futures.Future:
+        """
+        Starts fn(*args) unless a job with the same key is running in this process, returns its future.
+        Await it from async code with asyncio.wrap_future
+        :param shared: coalesce across workers too, fn has to return bytes. Ignored without redis_client
+        """
+        with self._lock:
+            future = self._flights.get(key)
+            record_cache("singleflight", future is not None)
+            if future is not None:
+                return future
+            future = concurrent.futures.Future()
+            self._flights[key] = future
+        self.executor.submit(self._lead, key, future, fn, args, shared and self.redis_client is not None)
+        return future
+
+    def do(self, key: str, fn: Callable[..., Any], *args, shared: bool = False) -> Any:
+        """Blocking variant of submit"""
+        return self.submit(key, fn, *args, shared=shared).result()
+
+    def _lead(self, key: str, future: concurrent.futures.Future, fn: Callable[..., Any], args: tuple, shared: bool) -> None:
+        try:
+            future.set_result(self._run_shared(key, fn, args) if shared else fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+
+    def _run_shared(self, key: str, fn: Callable[..., Any], args: tuple) -> bytes:
+        result_key = f"{self.prefix}:result:{key}"
+        lock_key = f"{self.prefix}:lock:{key}"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.lock_ttl
+        while True:
+            result = self.redis_client.get(result_key)
+            if result is not None:
+                return result
+            if self.redis_client.set(lock_key, token, nx=True, px=int(self.lock_ttl * 1000)):
+                try:
+                    result = fn(*args)
+                    self.redis_client.set(result_key, result, px=int(self.result_ttl * 1000))
+                    return result
+                finally:
+                    self.redis_client.eval(_RELEASE_SCRIPT, 1, lock_key, token)
+            if time.monotonic() > deadline:
+                # the worker holding the lock is stuck, do not wait for it any longer
+                return fn(*args)
+            time.sleep(self.poll_interval)
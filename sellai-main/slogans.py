@@ -0,0 +1,313 @@
+"""
+Slogan store and background pre-generation of slogans for the hottest (product, segment) pairs.
+
+The request path counts impressions per pair in hourly statistics, the pre-generator reads them and
+keeps slogans of the top pairs fresh within an hourly LLM budget. Run one pre-generator per deployment
+next to the web tier, the hit rate it achieves is printed on every pass.
+
+Usage: python slogans.py [--top-n 1000] [--llm-calls-per-hour 5000] [--interval 30] [--variants 1]
+                         [--storage json|hash] [--dim 1536] [--local-aibox]
+"""
+import argparse
+import collections
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from redis import Redis
+
+from aibox import AIBox, LocalAIBox, OpenAIBox, DEFAULT_EMBEDDING_DIM
+from dbcontrol import Product, RedisProductStore
+from metrics import record_cache, timed
+
+
+DEFAULT_SLOGAN_INSTRUCTIONS = "Generate a short slogan for the product ad. Slogan should reference both product and user preferences where appropriate. Slogan should be catchy and memorable. Slogan should be less that 10 words in length. Output just slogan and nothing else. Do NOT wrap the slogan into quotation marks."
+
+
+def segment_of(keywords: List[str], segment_size: int = 3) -> str:
+    """
+    Maps user keywords to an interest segment id.
+    Users sharing their leading keywords (case and order insensitive) land in the same segment,
+    so one slogan can be reused for all of them.
+    """
+    top = sorted({k.strip().lower() for k in keywords[:segment_size] if k.strip()})
+    return hashlib.sha1("|".join(top).encode("utf-8")).hexdigest()[:16]
+
+
+class RedisSloganStore:
+    """
+    Stores generated slogans per (product key, segment) pair together with generation time,
+    and collects per-hour request statistics used by the SloganPregenerator.
+    Key layout:
+        slogan:<product key>:<segment>  HASH  slogan, generated_at, variants (optional JSON list, best first)
+        segment:<segment>               STRING  JSON list of keywords representing the segment,
+                                                expires segment_ttl after the last lookup of the segment
+        slogan_stats:<hour>             ZSET  "<product key>|<segment>" -> number of requests
+        slogan_counters                 HASH  lookups, misses
+    """
+    def __init__(self,
+                 redis_client: Redis,
+                 max_age: datetime.timedelta = datetime.timedelta(days=1),
+                 segment_ttl: datetime.timedelta = datetime.timedelta(days=7)) -> None:
+        """
+        :param max_age: slogans older than this are considered stale
+        :param segment_ttl: keywords of a segment are kept this long after its last lookup,
+                            longer than the two hours of statistics the pre-generator reads
+        """
+        self.redis_client = redis_client
+        self.max_age = max_age
+        self.segment_ttl = segment_ttl
+
+    @staticmethod
+    def _stats_key(hour: int) -> str:
+        return f"slogan_stats:{hour}"
+
+    @staticmethod
+    def _current_hour() -> int:
+        return int(time.time() // 3600)
+
+    @staticmethod
+    def _stored(data: Dict[str, str]) -> Optional[Tuple[str, datetime.datetime]]:
+        if not data:
+            return None
+        return data["slogan"], datetime.datetime.fromisoformat(data["generated_at"])
+
+    def get(self, product_key: str, segment: str) -> Optional[Tuple[str, datetime.datetime]]:
+        """Returns (slogan, generated_at) or None if the pair has no slogan yet"""
+        return self._stored(self.redis_client.hgetall(f"slogan:{product_key}:{segment}"))
+
+    def lookup(self, product_key: str, keywords: List[str], segment: str) -> Optional[Tuple[str, datetime.datetime]]:
+        """
+        Request path read: counts one impression of the (product, segment) pair in the current hour bucket
+        and returns the stored slogan like get(), all in one round trip
+        """
+        hour_key = self._stats_key(self._current_hour())
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.zincrby(hour_key, 1, f"{product_key}|{segment}")
+        pipe.expire(hour_key, 2 * 3600)
+        # the first keywords seen stay representative of the segment, every lookup extends their lifetime
+        segment_ttl = int(self.segment_ttl.total_seconds())
+        pipe.set(f"segment:{segment}", json.dumps(keywords, ensure_ascii=False), nx=True, ex=segment_ttl)
+        pipe.expire(f"segment:{segment}", segment_ttl)
+        pipe.hincrby("slogan_counters", "lookups", 1)
+        pipe.hgetall(f"slogan:{product_key}:{segment}")
+        return self._stored(pipe.execute()[-1])
+
+    def put(self, product_key: str, segment: str, slogan: str, variants: Optional[List[str]] = None, miss: bool = False) -> None:
+        """
+        :param variants: alternative slogans for experiments, e.g. from AIBox.ad_text_variants
+        :param miss: the slogan was generated on the request path after lookup() found none
+        """
+        mapping = {
+            "slogan": slogan,
+            "generated_at": datetime.datetime.now().isoformat(),
+        }
+        pipe = self.redis_client.pipeline(transaction=True)
+        if variants:
+            mapping["variants"] = json.dumps(variants, ensure_ascii=False)
+        else:
+            # a regenerated slogan must not keep variants of the previous one
+            pipe.hdel(f"slogan:{product_key}:{segment}", "variants")
+        pipe.hset(f"slogan:{product_key}:{segment}", mapping=mapping)
+        if miss:
+            pipe.hincrby("slogan_counters", "misses", 1)
+        pipe.execute()
+
+    def variants(self, product_key: str, segment: str) -> List[str]:
+        """Stored slogan variants of the pair best first, just the slogan if it was generated alone"""
+        slogan, variants = self.redis_client.hmget(f"slogan:{product_key}:{segment}", ["slogan", "variants"])
+        if variants:
+            return json.loads(variants)
+        return [slogan] if slogan is not None else []
+
+    def is_fresh(self, generated_at: datetime.datetime) -> bool:
+        return datetime.datetime.now() - generated_at < self.max_age
+
+    def hit_rate(self) -> Optional[float]:
+        """Share of impressions served without an LLM call on the request path"""
+        counters = self.redis_client.hgetall("slogan_counters")
+        lookups = int(counters.get("lookups", 0))
+        misses = int(counters.get("misses", 0))
+        if lookups == 0:
+            return None
+        return max(lookups - misses, 0) / lookups
+
+    def segment_keywords(self, segment: str) -> List[str]:
+        value = self.redis_client.get(f"segment:{segment}")
+        if not value:
+            return []
+        try:
+            return json.loads(value)
+        except ValueError:
+            # comma joined by earlier versions without a TTL, the next lookup of the segment sets one
+            return value.split(",")
+
+    def top_pairs(self, n: int) -> List[Tuple[str, str]]:
+        """Returns top n (product key, segment) pairs over the current and the previous hour"""
+        hour = self._current_hour()
+        totals: Dict[str, float] = collections.defaultdict(float)
+        for key in (self._stats_key(hour), self._stats_key(hour - 1)):
+            for member, score in self.redis_client.zrevrange(key, 0, 4 * n, withscores=True):
+                totals[member] += score
+        ranked = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:n]
+        return [tuple(member.split("|", 1)) for member, _ in ranked]
+
+
+class HourlyBudget:
+    """Sliding one-hour window limiting the number of LLM calls"""
+    def __init__(self, calls_per_hour: int) -> None:
+        self.calls_per_hour = calls_per_hour
+        self._calls = collections.deque()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            while self._calls and now - self._calls[0] >= 3600:
+                self._calls.popleft()
+            if len(self._calls) >= self.calls_per_hour:
+                return False
+            self._calls.append(now)
+            return True
+
+    def remaining(self) -> int:
+        with self._lock:
+            now = time.monotonic()
+            return self.calls_per_hour - sum(1 for t in self._calls if now - t < 3600)
+
+
+class SloganPregenerator(threading.Thread):
+    """
+    Background worker that keeps slogans for the hottest (product, segment) pairs fresh,
+    so that the request path can serve them from the slogan store.
+    Pairs without a slogan are generated first, then the stalest ones, until the hourly LLM budget runs out.
+    """
+    def __init__(self,
+                 slogan_store: RedisSloganStore,
+                 product_store: RedisProductStore,
+                 aibox: AIBox,
+                 top_n: int = 1000,
+                 llm_calls_per_hour: int = 5000,
+                 interval: float = 30.0,
+                 instructions: str = DEFAULT_SLOGAN_INSTRUCTIONS,
+                 variants: int = 1) -> None:
+        """
+        :param top_n: number of hottest pairs to keep fresh
+        :param llm_calls_per_hour: LLM budget of the worker
+        :param interval: seconds between statistics scans
+        :param variants: slogans generated per pair in the same LLM call, the best one is served
+        """
+        super().__init__(daemon=True, name="SloganPregenerator")
+        self.slogan_store = slogan_store
+        self.product_store = product_store
+        self.aibox = aibox
+        self.top_n = top_n
+        self.budget = HourlyBudget(llm_calls_per_hour)
+        self.interval = interval
+        self.instructions = instructions
+        self.variants = variants
+        self._stop_event = threading.Event()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                generated = self.run_once()
+                hit_rate = self.slogan_store.hit_rate()
+                if generated or hit_rate is not None:
+                    print(f"SloganPregenerator: generated {generated} slogans, "
+                          f"hit rate {'n/a' if hit_rate is None else format(hit_rate, '.1%')}, "
+                          f"{self.budget.remaining()} LLM calls left this hour")
+            except Exception as e:
+                print(f"SloganPregenerator: {e}")
+            self._stop_event.wait(self.interval)
+
+    def run_once(self) -> int:
+        """Performs one scan, returns number of generated slogans"""
+        pending = []
+        for product_key, segment in self.slogan_store.top_pairs(self.top_n):
+            stored = self.slogan_store.get(product_key, segment)
+            if stored is None:
+                pending.append((datetime.datetime.min, product_key, segment))
+            elif not self.slogan_store.is_fresh(stored[1]):
+                pending.append((stored[1], product_key, segment))
+        pending.sort(key=lambda item: item[0])
+
+        generated = 0
+        for _, product_key, segment in pending:
+            if self._stop_event.is_set():
+                break
+            # deleted products must not spend the budget
+            product = self.product_store.get_product(product_key)
+            if product is None:
+                continue
+            if not self.budget.try_acquire():
+                break
+            keywords = self.slogan_store.segment_keywords(segment)
+            with timed("slogan_llm"):
+                if self.variants > 1:
+                    slogans = self.aibox.ad_text_variants(product.name, product.prompt_description(), keywords,
+                                                          self.instructions, self.variants)
+                else:
+                    slogans = [self.aibox.ad_text(product.name, product.prompt_description(), keywords, self.instructions)]
+            if not slogans:
+                continue
+            self.slogan_store.put(product_key, segment, slogans[0], slogans if len(slogans) > 1 else None)
+            generated += 1
+        return generated
+
+
+def get_slogan(slogan_store: RedisSloganStore,
+               aibox: AIBox,
+               product_key: str,
+               product: Product,
+               user_keywords: List[str],
+               instructions: str = DEFAULT_SLOGAN_INSTRUCTIONS,
+               record_stats: bool = True) -> str:
+    """
+    Request path slogan lookup. Serves pre-generated slogans (even stale ones, the background
+    worker refreshes them) and calls the LLM only when the pair has never been generated.
+    :param record_stats: count the lookup as an impression for the pre-generator and the hit rate,
+                         off for offline callers such as batchrender.py
+    """
+    segment = segment_of(user_keywords)
+    stored = slogan_store.lookup(product_key, user_keywords, segment) if record_stats else slogan_store.get(product_key, segment)
+    record_cache("slogans", stored is not None)
+    if stored is not None:
+        return stored[0]
+    with timed("slogan_llm"):
+        slogan = aibox.ad_text(product.name, product.prompt_description(), user_keywords, instructions)
+    slogan_store.put(product_key, segment, slogan, miss=record_stats)
+    return slogan
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-generate slogans of the hottest product and segment pairs")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--storage", choices=["json", "hash"], default="json")
+    parser.add_argument("--dim", type=int, default=DEFAULT_EMBEDDING_DIM)
+    parser.add_argument("--top-n", type=int, default=1000, help="number of hottest pairs kept fresh")
+    parser.add_argument("--llm-calls-per-hour", type=int, default=5000)
+    parser.add_argument("--interval", type=float, default=30.0, help="seconds between statistics scans")
+    parser.add_argument("--variants", type=int, default=1, help="slogans generated per pair in one call")
+    parser.add_argument("--max-age-hours", type=float, default=24.0, help="slogans older than this are regenerated")
+    parser.add_argument("--local-aibox", action="store_true", help="use network-free LocalAIBox")
+    args = parser.parse_args()
+
+    load_dotenv()
+    redis_client = Redis(host=args.host, port=args.port, decode_responses=True)
+    aibox = LocalAIBox(dimensions=args.dim) if args.local_aibox else OpenAIBox(os.getenv("OPENAI_KEY"), dimensions=args.dim)
+    slogan_store = RedisSloganStore(redis_client, max_age=datetime.timedelta(hours=args.max_age_hours))
+    pregenerator = SloganPregenerator(slogan_store, RedisProductStore(redis_client, storage=args.storage, dim=args.dim), aibox,
+                                      top_n=args.top_n, llm_calls_per_hour=args.llm_calls_per_hour,
+                                      interval=args.interval, variants=args.variants)
+    pregenerator.start()
+    pregenerator.join()
@@ -4,9 +4,16 @@ from PIL import Image
 import requests
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 import os
-from visualnode import vnode_tree_from_file, vnode_tree_from_string
+from typing import Dict, Optional
+from visualnode import VNode, vnode_tree_from_file, vnode_tree_from_string
 
 
+# shared by all instances, so the template is compiled once per process
+_environment = Environment(
+    loader=FileSystemLoader("/"),
+    autoescape=select_autoescape()
+)
+
 
 class BasicXMLTemplate(TemplateExecutor):
     """
@@ -19,27 +26,32 @@ class BasicXMLTemplate(TemplateExecutor):
                  dimensions: tuple[int, int], 
                  slogan: str,
                  main_color: tuple[int, int, int, int], 
-                 svgapi_key: str) -> None:
+                 icon_path: Optional[str] = None) -> None:
         """
         :param dimensions: The dimensions of requested image (width, height)
         :param slogan: The slogan for the product
         :param main_color: The main color of the template. See Canva for how it looks like
-        :param svgapi_key: The key for the SVG API.
+        :param icon_path: The icon next to the slogan, e.g. picked by IconLibrary. No icon if None
         """
         template_path = os.path.dirname(os.path.abspath(__file__)) + "/basicxmltemplate.xml.j2"
         super().__init__(template_path, product)
         self.dimensions = dimensions
         self.slogan = slogan
         self.main_color = main_color
-        self.svgapi_key = svgapi_key
-        self.env = Environment(
-            loader=FileSystemLoader("/"),
-            autoescape=select_autoescape()
-        )
+        self.icon_path = icon_path
+        self.env = _environment
         
-    def compose(self) -> Image:
+    def compose(self, image_sources: Optional[Dict[str, bytes]] = None) -> Image:
         """
         Composes the template and returns the composed image.
+        :param image_sources: image path -> file contents fetched in advance, e.g. the product image
+        """
+        return self.build_tree(image_sources).compose()
+
+    def build_tree(self, image_sources: Optional[Dict[str, bytes]] = None) -> VNode:
+        """
+        Renders the XML template and returns the root of the VNode tree, without laying it out.
+        :param image_sources: see compose
         """
         # width and height
         width = self.dimensions[0]
@@ -58,9 +70,8 @@ class BasicXMLTemplate(TemplateExecutor):
         # NOTE: implement the slogan generator
         slogan = self.slogan
         
-        # svg icon path
-        # NOTE: implement the icon fetching
-        svg_icon_path = "img/tv.png"
+        # icon path
+        icon_path = self.icon_path
         
         # product_img_path
         product_img_path = self.product.image_link
@@ -80,14 +91,12 @@ class BasicXMLTemplate(TemplateExecutor):
             main_table_direction=main_table_direction,
             main_color=main_color,
             slogan=slogan,
-            svg_icon_path=svg_icon_path,
+            icon_path=icon_path,
             product_img_path=product_img_path,
             product_name=product_name,
             slogan_font_path=slogan_font_path,
             product_name_font_path=product_name_font_path
         )
         
-        print(xml_template_rendered)
-        root_node = vnode_tree_from_string(xml_template_rendered)
-        return root_node.compose()
+        return vnode_tree_from_string(xml_template_rendered, image_sources)
         
\ No newline at end of file
@@ -0,0 +1,18 @@
+import os
+import sys
+import types
+
+# modules of the service are flat files next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import weasyprint  # noqa: F401
+except (ImportError, OSError):
+    # weasyprint needs pango and cairo system libraries. Only the HTML template renders with it,
+    # so a stand-in lets the service be imported and tested without them
+    def _unavailable(*args, **kwargs):
+        raise OSError("weasyprint is not available")
+
+    weasyprint = types.ModuleType("weasyprint")
+    weasyprint.HTML = weasyprint.CSS = _unavailable
+    sys.modules["weasyprint"] = weasyprint
@@ -0,0 +1,97 @@
+import concurrent.futures
+import json
+import os
+
+import fakeredis
+import pytest
+
+import batchrender
+from aibox import LocalAIBox
+from batchrender import BatchRenderer, Checkpoint
+from dbcontrol import Product, User
+from slogans import RedisSloganStore
+
+
+class ProductStore:
+    def __init__(self, fail_after=None):
+        self.calls = 0
+        self.fail_after = fail_after
+
+    def get_products(self, keys):
+        self.calls += 1
+        if self.fail_after is not None and self.calls > self.fail_after:
+            raise KeyboardInterrupt
+        return [Product("Tea", "Black tea", "img/tea.png") if key == "product:1" else None for key in keys]
+
+
+class UserStore:
+    def get_users(self, keys):
+        return [User(["tea", "tv shows"], None) if key == "user:1" else None for key in keys]
+
+
+@pytest.fixture
+def rendered(monkeypatch):
+    calls = []
+
+    def render(product, dimensions, slogan, image_format, icon_path):
+        calls.append(dimensions)
+        return f"{product.name} {dimensions} {image_format}".encode("utf-8")
+
+    monkeypatch.setattr(batchrender, "_render_creative", render)
+    return calls
+
+
+@pytest.fixture
+def items(tmp_path):
+    path = tmp_path / "items.jsonl"
+    lines = [
+        {"id": "a", "product": "product:1", "user": "user:1", "width": 300, "height": 250},
+        {"id": "b", "product": "product:1", "user": "user:1", "width": 300, "height": 250},
+        {"id": "c", "product": "product:404", "user": "user:1", "width": 300, "height": 250},
+        {"id": "d", "product": "product:1", "keywords": ["garden"], "width": 600, "height": 200, "format": "jpeg"},
+        {"id": "e", "product": "product:1", "user": "user:1", "width": "wide", "height": 250},
+    ]
+    path.write_text("".join(json.dumps(line) + "\n" for line in lines) + "not json\n")
+    return str(path)
+
+
+def renderer(product_store, output_dir, output="dir"):
+    batch_renderer = BatchRenderer(product_store, UserStore(), RedisSloganStore(fakeredis.FakeRedis(decode_responses=True)),
+                                   LocalAIBox(dimensions=8), output_dir, output=output, batch_size=2, workers=1)
+    # renders in threads, the patched renderer does not reach worker processes
+    batch_renderer.pool.shutdown()
+    batch_renderer.pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    return batch_renderer
+
+
+def manifest(output_dir):
+    with open(os.path.join(output_dir, "manifest.jsonl")) as file:
+        return [json.loads(line) for line in file]
+
+
+@pytest.mark.parametrize("output", ["dir", "tar"])
+def test_identical_creatives_are_rendered_once(tmp_path, items, rendered, output):
+    output_dir = str(tmp_path / "out")
+    totals = renderer(ProductStore(), output_dir, output).run(items)
+    assert totals == {"items": 6, "rendered": 2, "reused": 1, "failed": 3}
+    entries = manifest(output_dir)
+    assert [entry["id"] for entry in entries] == ["a", "b", "c", "d", "e", 5]
+    assert entries[0]["location"] == entries[1]["location"]
+    assert "No such product" in entries[2]["error"] and "Bad item" in entries[4]["error"]
+    if output == "dir":
+        with open(os.path.join(output_dir, entries[3]["location"]), "rb") as file:
+            assert file.read() == b"Tea (600, 200) JPEG"
+
+
+def test_interrupted_run_resumes_after_the_last_batch(tmp_path, items, rendered):
+    output_dir = str(tmp_path / "out")
+    with pytest.raises(KeyboardInterrupt):
+        renderer(ProductStore(fail_after=1), output_dir).run(items)
+    assert Checkpoint(os.path.join(output_dir, "checkpoint.json")).lines_done == 2
+    assert len(manifest(output_dir)) == 2
+
+    totals = renderer(ProductStore(), output_dir).run(items)
+    assert totals["items"] == 4
+    assert [entry["line"] for entry in manifest(output_dir)] == list(range(6))
+    # the creative of the first batch comes from the index, only the new size is rendered
+    assert rendered == [(300, 250), (600, 200)]
@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("asgiref", reason="async views need flask[async]")
+
+import main
+from aibox import LocalAIBox
+from iconlibrary import IconLibrary
+
+DIM = 8
+
+
+class RecordingProductStore:
+    """Product store without matches which keeps the embeddings it was queried with"""
+    dim = DIM
+
+    def __init__(self):
+        self.queries = []
+
+    def find_similar_from_embedding(self, embedding, k, vector_field):
+        self.queries.append(embedding)
+        return []
+
+
+@pytest.fixture
+def product_store(monkeypatch, tmp_path):
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(main.__file__)))
+    store = RecordingProductStore()
+    current = main.Services(aibox=LocalAIBox(dimensions=DIM), product_store=store, user_store=None,
+                            slogan_store=None, recommendations=None, icons=IconLibrary(str(tmp_path)))
+    monkeypatch.setattr(main, "services", lambda: current)
+    return store
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+def test_json_user_embedding_is_float32_array(client, product_store):
+    response = client.get("/get_banner?width=300&height=250",
+                          json={"keywords": ["tea"], "embedding": [0.5] * DIM})
+    assert response.status_code == 200
+    assert response.headers["X-Banner-Fallback"] == "default_creative"
+    embedding = product_store.queries[0]
+    assert isinstance(embedding, np.ndarray)
+    assert embedding.dtype == np.float32 and embedding.shape == (DIM,)
+
+
+@pytest.mark.parametrize("body", [
+    {"keywords": ["tea"]},
+    {"keywords": ["tea"], "embedding": [0.5] * (DIM - 1)},
+    {"embedding": [0.5] * DIM},
+])
+def test_bad_json_user_is_rejected(client, product_store, body):
+    response = client.get("/get_banner?width=300&height=250", json=body)
+    assert response.status_code == 400
+    assert not product_store.queries
@@ -0,0 +1,73 @@
+import json
+
+import fakeredis
+import pytest
+from PIL import Image
+
+from aibox import LocalAIBox
+from dbcontrol import RedisProductStore
+from ingest import BulkIngestor, Checkpoint, read_records
+
+DIM = 8
+
+
+class InterruptedStore:
+    """Product store failing the write of the given batch, like a worker killed mid-import"""
+    def __init__(self, store, fail_at):
+        self.store = store
+        self.fail_at = fail_at
+        self.writes = 0
+
+    def allocate_product_keys(self, count):
+        return self.store.allocate_product_keys(count)
+
+    def write_products(self, keys, products):
+        self.writes += 1
+        if self.writes == self.fail_at:
+            raise KeyboardInterrupt
+        self.store.write_products(keys, products)
+
+
+@pytest.fixture
+def product_store():
+    server = fakeredis.FakeServer()
+    return RedisProductStore(fakeredis.FakeRedis(server=server, decode_responses=True), storage="hash", dim=DIM,
+                             binary_client=fakeredis.FakeRedis(server=server))
+
+
+@pytest.fixture
+def records(tmp_path):
+    image = tmp_path / "tea.png"
+    Image.new("RGB", (4, 4), "green").save(image)
+    path = tmp_path / "products.jsonl"
+    with open(path, "w") as file:
+        for i in range(5):
+            file.write(json.dumps({"name": f"Tea {i}", "description": f"Black tea number {i}", "image_link": str(image)}) + "\n")
+        file.write(json.dumps({"name": "No description"}) + "\n")
+    return str(path)
+
+
+def ingestor(store, checkpoint_path, image_dir):
+    return BulkIngestor(store, LocalAIBox(dimensions=DIM), Checkpoint(checkpoint_path), batch_size=2, workers=1,
+                        image_dir=image_dir, summarize=False)
+
+
+def test_interrupted_import_resumes_without_duplicates(product_store, records, tmp_path):
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+    image_dir = tmp_path / "db-img"
+    image_dir.mkdir()
+    with pytest.raises(KeyboardInterrupt):
+        ingestor(InterruptedStore(product_store, fail_at=2), checkpoint_path, str(image_dir)).run(read_records(records, "jsonl"))
+    checkpoint = Checkpoint(checkpoint_path)
+    assert checkpoint.records_done == 2
+    assert checkpoint.pending_keys == ["product:3", "product:4"]
+
+    assert ingestor(product_store, checkpoint_path, str(image_dir)).run(read_records(records, "jsonl")) == 3
+    assert Checkpoint(checkpoint_path).records_done == 6
+    assert product_store.redis_client.get("product_counter") == "5"
+    names = [product.name for product in product_store.get_products([f"product:{i}" for i in range(1, 6)])]
+    assert names == [f"Tea {i}" for i in range(5)]
+
+    # a finished import has nothing left to do
+    assert ingestor(product_store, checkpoint_path, str(image_dir)).run(read_records(records, "jsonl")) == 0
+    assert product_store.redis_client.get("product_counter") == "5"
@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+from latencybudget import LatencyBudget
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def value_after(seconds, value):
+    await asyncio.sleep(seconds)
+    return value
+
+
+async def failing(exception):
+    raise exception
+
+
+def test_unused_time_carries_over_to_later_stages():
+    budget = LatencyBudget(1.0, shares={"lookup": 1, "render": 1})
+    assert budget.timeout_for("lookup") == pytest.approx(0.5, abs=0.01)
+    assert budget.timeout_for("render") == pytest.approx(1.0, abs=0.01)
+
+
+def test_slow_stage_is_replaced_by_its_fallback():
+    budget = LatencyBudget(0.1, shares={"slogan": 1})
+    result = run(budget.run("slogan", value_after(1.0, "generated"), "default_slogan", lambda: "default"))
+    assert result == "default"
+    assert budget.fallbacks == ["default_slogan"]
+    assert budget.stage_times["slogan"] < 0.5
+
+
+def test_stage_within_budget_keeps_its_result():
+    budget = LatencyBudget(1.0, shares={"slogan": 1})
+    assert run(budget.run("slogan", value_after(0, "generated"), "default_slogan", lambda: "default")) == "generated"
+    assert budget.fallbacks == []
+
+
+def test_listed_errors_fall_back_and_others_propagate():
+    budget = LatencyBudget(1.0, shares={"render": 1, "encode": 1})
+    assert run(budget.run("render", failing(OSError("font missing")), "default_creative", lambda: None,
+                          fallback_on=(OSError,))) is None
+    assert budget.fallbacks == ["default_creative"]
+    with pytest.raises(KeyError):
+        run(budget.run("encode", failing(KeyError("format")), "png", lambda: None, fallback_on=(OSError,)))
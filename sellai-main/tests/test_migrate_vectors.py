@@ -0,0 +1,64 @@
+import datetime
+
+import numpy as np
+
+from dbcontrol import Product, User
+from migrate_vectors import _product_hash, _user_hash
+
+
+def as_stored(fields):
+    """HASH fields as a client that does not decode responses reads them back"""
+    return {key.encode(): value if isinstance(value, bytes) else str(value).encode() for key, value in fields.items()}
+
+
+def test_product_round_trip():
+    product = Product("Yorkshire Tea", "Black tea blend from Harrogate", "img/tea.png",
+                      np.linspace(-1, 1, 8, dtype=np.float32),
+                      category="tea", advertiser="taylors", in_stock=False,
+                      summary="Popular British black tea", summary_keywords=["tea", "black tea", "british"])
+
+    migrated = Product.from_hash(as_stored(_product_hash(product.to_dict())))
+
+    assert vars(migrated).keys() == vars(product).keys()
+    for name, value in vars(product).items():
+        if name == "embedding":
+            np.testing.assert_array_equal(migrated.embedding, value)
+        else:
+            assert getattr(migrated, name) == value, name
+
+
+def test_product_without_summary_round_trip():
+    product = Product("Tea", "Tea", "img/tea.png", np.ones(4, dtype=np.float32))
+
+    migrated = Product.from_hash(as_stored(_product_hash(product.to_dict())))
+
+    assert migrated.summary is None and migrated.summary_keywords is None
+    assert migrated.category is None and migrated.in_stock
+
+
+def test_user_round_trip():
+    user = User([], np.linspace(0, 1, 8, dtype=np.float32),
+                last_refreshed=datetime.datetime(2024, 5, 1, 12, 0),
+                keyword_weights={"tea": 2.5, "tv shows": 0.75},
+                updated_at=datetime.datetime(2024, 5, 2, 8, 30),
+                embedding_norm=3.25,
+                embedding_version=7,
+                embedded_keywords_digest="abc123")
+
+    migrated = User.from_hash(as_stored(_user_hash(user.to_dict())))
+
+    assert vars(migrated).keys() == vars(user).keys()
+    for name, value in vars(user).items():
+        if name == "embedding":
+            np.testing.assert_array_equal(migrated.embedding, value)
+        else:
+            assert getattr(migrated, name) == value, name
+
+
+def test_user_without_embedding_round_trip():
+    user = User(["Tea", "cacti"], None, last_refreshed=None)
+
+    migrated = User.from_hash(as_stored(_user_hash(user.to_dict())))
+
+    assert migrated.embedding is None and migrated.last_refreshed is None
+    assert migrated.keyword_weights == {"tea": 1.0, "cacti": 1.0}
@@ -0,0 +1,98 @@
+import fakeredis
+import numpy as np
+import pytest
+
+from dbcontrol import ProductMatch, User
+from recommendations import RecommendationCache, RecommendationRefresher
+
+
+class CountingProductStore:
+    """Product store with a settable catalog version which counts its KNN queries"""
+    def __init__(self):
+        self.version = 0
+        self.queries = 0
+
+    def catalog_version(self):
+        return self.version
+
+    def find_similar_from_embedding(self, embedding, k, vector_field, filters=None):
+        self.queries += 1
+        return [ProductMatch(f"product:{i}", "Tea", "Black tea", "img/tea.png", 0.1 * i) for i in range(k)]
+
+
+class UserStore:
+    def __init__(self, users):
+        self.users = users
+
+    def get_users(self, keys):
+        return [self.users.get(key) for key in keys]
+
+
+@pytest.fixture
+def product_store():
+    return CountingProductStore()
+
+
+@pytest.fixture
+def user():
+    return User(["tea"], np.ones(4, dtype=np.float32))
+
+
+def make_cache(product_store, **kwargs):
+    return RecommendationCache(fakeredis.FakeRedis(decode_responses=True), product_store, catalog_version_ttl=0, **kwargs)
+
+
+def test_entry_is_reused_until_the_embedding_changes(product_store, user):
+    cache = make_cache(product_store)
+    first = cache.get("user:1", user, 3)
+    assert cache.get("user:1", user, 2) == first[:2]
+    assert product_store.queries == 1
+
+    user.embedding_version += 1
+    cache.get("user:1", user, 3)
+    assert product_store.queries == 2
+
+
+def test_catalog_changes_are_refreshed_in_the_background(product_store, user):
+    cache = make_cache(product_store, max_stale_versions=5)
+    cache.get("user:1", user, 3)
+    product_store.version += 1
+    cache.get("user:1", user, 3)
+    assert product_store.queries == 1
+    assert cache.pop_stale(10) == [("user:1", "all")]
+
+    cache.redis_client.sadd("recs:stale", "user:1|all")
+    assert RecommendationRefresher(cache, UserStore({"user:1": user})).run_once() == 1
+    assert product_store.queries == 2
+    cache.get("user:1", user, 3)
+    assert product_store.queries == 2 and cache.pop_stale(10) == []
+
+
+def test_entries_too_far_behind_are_recomputed(product_store, user):
+    cache = make_cache(product_store, max_stale_versions=5)
+    cache.get("user:1", user, 3)
+    product_store.version += 6
+    cache.get("user:1", user, 3)
+    assert product_store.queries == 2
+
+
+def test_invalidate_drops_all_entries_of_the_user(product_store, user):
+    cache = make_cache(product_store)
+    cache.get("user:1", user, 3)
+    cache.get("user:2", user, 3)
+    cache.invalidate("user:1")
+    assert cache.redis_client.keys("recs:user:1:*") == []
+    cache.get("user:1", user, 3)
+    cache.get("user:2", user, 3)
+    assert product_store.queries == 3
+    assert cache.last_known("user:1") is not None
+
+
+def test_catalog_version_is_read_once_per_ttl(user):
+    product_store = CountingProductStore()
+    reads = []
+    product_store.catalog_version = lambda: reads.append(1) or 0
+    cache = RecommendationCache(fakeredis.FakeRedis(decode_responses=True), product_store, catalog_version_ttl=60)
+    for _ in range(5):
+        cache.get("user:1", user, 3)
+    assert len(reads) == 1
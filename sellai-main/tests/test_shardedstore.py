@@ -0,0 +1,79 @@
+import fakeredis
+import numpy as np
+import pytest
+
+from dbcontrol import Product, RedisProductStore
+from shardedstore import ShardedProductStore, parse_shards
+from vectorindex import MmapVectorIndex, MmapVectorIndexWriter
+
+DIM = 4
+
+
+def shard_store(names):
+    shards = {}
+    for name in names:
+        server = fakeredis.FakeServer()
+        shards[name] = RedisProductStore(fakeredis.FakeRedis(server=server, decode_responses=True), storage="hash", dim=DIM,
+                                         binary_client=fakeredis.FakeRedis(server=server))
+    return ShardedProductStore(shards)
+
+
+def test_parse_shards():
+    assert parse_shards("a:6381, b:6382/2") == [("a", 6381, 0), ("b", 6382, 2)]
+    with pytest.raises(ValueError):
+        parse_shards("6381")
+    with pytest.raises(ValueError):
+        parse_shards(" , ")
+
+
+def test_adding_a_shard_only_moves_keys_to_it():
+    keys = [f"product:{i}" for i in range(2000)]
+    before = shard_store(["a:1", "b:2", "c:3"])
+    after = shard_store(["a:1", "b:2", "c:3", "d:4"])
+    moved = [key for key in keys if before.shard_name_for(key) != after.shard_name_for(key)]
+    assert all(after.shard_name_for(key) == "d:4" for key in moved)
+    assert 0.15 < len(moved) / len(keys) < 0.35
+    groups = after.group_keys(keys)
+    assert sorted(position for positions in groups.values() for position in positions) == list(range(len(keys)))
+
+
+def test_products_live_on_their_shards():
+    store = shard_store(["a:1", "b:2", "c:3"])
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(30, DIM)).astype(np.float32)
+    keys = store.allocate_product_keys(len(vectors))
+    store.write_products(keys, [Product(key, "synthetic product", "img/tea.png", embedding=vector)
+                                for key, vector in zip(keys, vectors)])
+
+    for name, shard in store.shards.items():
+        assert sorted(shard.scan_product_keys(100)) == sorted(key for key in keys if store.shard_name_for(key) == name)
+    assert sorted(store.scan_product_keys(100)) == sorted(keys)
+    products = store.get_products(keys + ["product:404"])
+    assert [product.name for product in products[:-1]] == keys and products[-1] is None
+    assert store.coordinator.redis_client.get("product_counter") == "30"
+
+    version = store.catalog_version()
+    assert store.delete_product(keys[0])
+    assert store.get_product(keys[0]) is None
+    assert store.catalog_version() > version
+
+
+def test_local_index_of_all_shards_answers_knn(tmp_path):
+    store = shard_store(["a:1", "b:2"])
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(20, DIM)).astype(np.float32)
+    keys = store.allocate_product_keys(len(vectors))
+    store.write_products(keys, [Product(key, "synthetic product", "img/tea.png", embedding=vector)
+                                for key, vector in zip(keys, vectors)])
+    writer = MmapVectorIndexWriter(str(tmp_path), store)
+    assert writer.refresh() == len(keys)
+    store.delete_product(keys[3])
+    assert writer.refresh() == 1
+
+    store.local_index = MmapVectorIndex(str(tmp_path), check_interval=0)
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    exact = [keys[i] for i in np.argsort(-(normalized @ normalized[5])) if i != 3][:3]
+    matches = store.find_similar_from_embedding(vectors[5], 3, "embedding")
+    assert [match.key for match in matches] == exact
+    assert all(match.name == match.key for match in matches)
+    assert [match.score for match in matches] == sorted(match.score for match in matches)
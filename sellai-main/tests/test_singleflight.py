@@ -0,0 +1,64 @@
+import threading
+
+import fakeredis
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_job():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def job(value):
+        calls.append(value)
+        release.wait(5)
+        return value * 2
+
+    futures = [flight.submit("key", job, 21) for _ in range(10)]
+    assert flight.in_flight() == 1
+    release.set()
+    assert [future.result(5) for future in futures] == [42] * 10
+    assert calls == [21]
+    assert flight.in_flight() == 0
+
+
+def test_finished_jobs_are_not_reused():
+    flight = SingleFlight()
+    calls = []
+    assert flight.do("key", lambda: calls.append(1) or len(calls)) == 1
+    assert flight.do("key", lambda: calls.append(1) or len(calls)) == 2
+
+
+def test_failures_reach_every_waiter():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def job():
+        release.wait(5)
+        raise ValueError("render failed")
+
+    futures = [flight.submit("key", job) for _ in range(3)]
+    release.set()
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result(5)
+    assert flight.in_flight() == 0
+
+
+def test_shared_results_are_reused_across_workers():
+    pytest.importorskip("lupa")
+    server = fakeredis.FakeServer()
+    first = SingleFlight(redis_client=fakeredis.FakeRedis(server=server))
+    second = SingleFlight(redis_client=fakeredis.FakeRedis(server=server))
+    calls = []
+
+    def job():
+        calls.append(1)
+        return b"banner"
+
+    assert first.do("key", job, shared=True) == b"banner"
+    assert second.do("key", job, shared=True) == b"banner"
+    assert calls == [1]
+    assert fakeredis.FakeRedis(server=server).get("singleflight:lock:key") is None
@@ -0,0 +1,68 @@
+import fakeredis
+import pytest
+
+from aibox import LocalAIBox
+from dbcontrol import Product
+from slogans import RedisSloganStore, SloganPregenerator, get_slogan, segment_of
+
+
+class ProductStore:
+    def __init__(self, products):
+        self.products = products
+        self.reads = []
+
+    def get_product(self, key):
+        self.reads.append(key)
+        return self.products.get(key)
+
+
+@pytest.fixture
+def slogan_store():
+    return RedisSloganStore(fakeredis.FakeRedis(decode_responses=True))
+
+
+def test_segment_keywords_keep_commas_and_expire(slogan_store):
+    keywords = ["tea, black", "TV shows", "garden"]
+    segment = segment_of(keywords)
+    slogan_store.lookup("product:1", keywords, segment)
+    slogan_store.lookup("product:1", ["tv shows", "garden", "tea, black"], segment)
+
+    assert slogan_store.segment_keywords(segment) == keywords
+    ttl = slogan_store.redis_client.ttl(f"segment:{segment}")
+    assert 0 < ttl <= slogan_store.segment_ttl.total_seconds()
+
+
+def test_segment_keywords_of_earlier_versions(slogan_store):
+    slogan_store.redis_client.set("segment:old", "tea,garden")
+    assert slogan_store.segment_keywords("old") == ["tea", "garden"]
+    slogan_store.lookup("product:1", ["tea", "garden"], "old")
+    assert slogan_store.redis_client.ttl("segment:old") > 0
+
+
+def test_get_slogan_counts_hits_and_misses(slogan_store):
+    aibox = LocalAIBox(dimensions=8)
+    product = Product("Tea", "Black tea from Yorkshire", "img/tea.png")
+    first = get_slogan(slogan_store, aibox, "product:1", product, ["tea", "garden"])
+    second = get_slogan(slogan_store, aibox, "product:1", product, ["garden", "TEA"])
+
+    assert first == second
+    assert slogan_store.hit_rate() == pytest.approx(0.5)
+    assert slogan_store.top_pairs(1) == [("product:1", segment_of(["tea", "garden"]))]
+
+
+def test_offline_lookups_stay_out_of_statistics(slogan_store):
+    product = Product("Tea", "Black tea", "img/tea.png")
+    get_slogan(slogan_store, LocalAIBox(dimensions=8), "product:1", product, ["tea"], record_stats=False)
+    assert slogan_store.hit_rate() is None
+    assert slogan_store.top_pairs(10) == []
+
+
+def test_pregenerator_skips_deleted_products_without_spending_budget(slogan_store):
+    for key in ("product:404", "product:404", "product:1"):
+        slogan_store.lookup(key, ["tea"], segment_of(["tea"]))
+    product_store = ProductStore({"product:1": Product("Tea", "Black tea", "img/tea.png")})
+    pregenerator = SloganPregenerator(slogan_store, product_store, LocalAIBox(dimensions=8), llm_calls_per_hour=1)
+
+    assert pregenerator.run_once() == 1
+    assert slogan_store.get("product:1", segment_of(["tea"])) is not None
+    assert pregenerator.budget.remaining() == 0
@@ -0,0 +1,87 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from dbcontrol import User
+
+
+class FakeKeywordEmbeddingCache:
+    """Deterministic keyword embeddings with the interface of RedisKeywordEmbeddingCache"""
+    def __init__(self, dim: int = 16) -> None:
+        self.dim = dim
+        self.vectors = {}
+        self.lookups = []
+
+    def get_many(self, keywords, aibox):
+        self.lookups.append(list(keywords))
+        for keyword in keywords:
+            if keyword not in self.vectors:
+                seed = sum(keyword.encode("utf-8")) + 31 * len(keyword)
+                self.vectors[keyword] = np.random.default_rng(seed).normal(size=self.dim)
+        return np.vstack([self.vectors[keyword] for keyword in keywords]).astype(np.float64)
+
+
+def rebuilt(user: User, cache: FakeKeywordEmbeddingCache) -> np.ndarray:
+    copy = User([], None, keyword_weights=dict(user.keyword_weights), updated_at=user.updated_at)
+    copy.refresh(None, cache)
+    return copy.embedding
+
+
+@pytest.fixture
+def start():
+    return datetime.datetime(2024, 1, 1)
+
+
+def test_incremental_push_matches_rebuild_with_decay(start):
+    cache = FakeKeywordEmbeddingCache()
+    user = User(["tea", "garden"], None, updated_at=start)
+    user.refresh(None, cache)
+    user.push_keywords(["cacti", "tea"], cache, now=start + datetime.timedelta(days=3))
+    user.push_keywords(["royal family"], cache, now=start + datetime.timedelta(days=10))
+
+    assert cache.lookups[-1] == ["royal family"]
+    assert user.keyword_weights["tea"] == pytest.approx(0.5 ** (10 / 7) + 0.5 ** (7 / 7))
+    np.testing.assert_allclose(user.embedding, rebuilt(user, cache), atol=1e-9)
+    weights = np.array(list(user.keyword_weights.values()))
+    weighted_sum = weights @ cache.get_many(list(user.keyword_weights), None)
+    assert user.embedding_norm == pytest.approx(float(np.linalg.norm(weighted_sum)))
+    assert not user.needs_refresh(datetime.timedelta(days=365), now=start)
+
+
+def test_incremental_push_matches_rebuild_with_eviction(start, monkeypatch):
+    monkeypatch.setattr(User, "MAX_KEYWORDS", 3)
+    cache = FakeKeywordEmbeddingCache()
+    user = User(["tea", "garden", "cacti"], None, updated_at=start)
+    user.refresh(None, cache)
+    user.push_keywords(["tea"], cache, now=start + datetime.timedelta(days=1))
+    user.push_keywords(["football"], cache, now=start + datetime.timedelta(days=2))
+
+    assert len(user.keyword_weights) == 3
+    assert "football" in user.keyword_weights and "tea" in user.keyword_weights
+    np.testing.assert_allclose(user.embedding, rebuilt(user, cache), atol=1e-9)
+
+
+def test_push_without_cache_forces_rebuild_on_next_cached_push(start):
+    cache = FakeKeywordEmbeddingCache()
+    user = User(["tea"], None, updated_at=start)
+    user.refresh(None, cache)
+    version = user.embedding_version
+
+    user.push_keywords(["garden"], None, now=start + datetime.timedelta(days=1))
+    assert user.embedding_norm is None
+    assert user.embedding_version == version
+    assert user.needs_refresh(datetime.timedelta(days=365), now=start)
+
+    user.push_keywords(["cacti"], cache, now=start + datetime.timedelta(days=2))
+    assert sorted(cache.lookups[-1]) == ["cacti", "garden", "tea"]
+    np.testing.assert_allclose(user.embedding, rebuilt(user, cache), atol=1e-9)
+
+
+def test_decay_without_new_keywords_keeps_norm_consistent(start):
+    cache = FakeKeywordEmbeddingCache()
+    user = User(["tea", "garden"], None, updated_at=start)
+    user.refresh(None, cache)
+    user.push_keywords([], cache, now=start + datetime.timedelta(days=7))
+    user.push_keywords(["cacti"], cache, now=start + datetime.timedelta(days=14))
+    np.testing.assert_allclose(user.embedding, rebuilt(user, cache), atol=1e-9)
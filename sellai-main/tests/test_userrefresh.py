@@ -0,0 +1,46 @@
+import datetime
+
+import fakeredis
+import pytest
+
+pytest.importorskip("lupa")
+
+from aibox import LocalAIBox
+from dbcontrol import RedisUserStore, User
+from userrefresh import UserRefreshScheduler
+
+DIM = 8
+
+
+@pytest.fixture
+def user_store():
+    server = fakeredis.FakeServer()
+    return RedisUserStore(fakeredis.FakeRedis(server=server, decode_responses=True), storage="hash", dim=DIM,
+                          binary_client=fakeredis.FakeRedis(server=server))
+
+
+def test_refresh_embeds_queued_users(user_store):
+    key = user_store.save_user(User(["tea", "garden"], None), refresh=False)
+    scheduler = UserRefreshScheduler(user_store, LocalAIBox(dimensions=DIM), batch_size=10)
+    assert scheduler.run_once() == 1
+
+    user = user_store.get_user(key)
+    assert user.embedding is not None and user.embedding_version == 1
+    assert not user.needs_refresh(scheduler.ttl)
+    assert user_store.pop_stale(10) == []
+
+
+def test_user_deleted_during_refresh_is_not_recreated(user_store):
+    kept = user_store.save_user(User(["tea"], None), refresh=False)
+    deleted = user_store.save_user(User(["cacti"], None), refresh=False)
+    users = user_store.get_users([kept, deleted])
+    for user in users:
+        user.set_text_embedding(LocalAIBox(dimensions=DIM).embedding_from_text(user.embedding_text()))
+    user_store.delete_user(deleted)
+    user_store.mark_stale([deleted])
+
+    assert user_store.write_user_embeddings([kept, deleted], users) == [deleted]
+    assert user_store.get_users([kept, deleted])[1] is None
+    assert user_store.get_user(kept).embedding is not None
+    assert user_store.expired_users(datetime.timedelta(0), 10) == [kept]
+    assert deleted not in user_store.pop_stale(10)
@@ -0,0 +1,97 @@
+import json
+import os
+
+import fakeredis
+import numpy as np
+import pytest
+
+from dbcontrol import Product, RedisProductStore
+from vectorindex import MmapVectorIndex, MmapVectorIndexWriter
+
+DIM = 4
+
+
+@pytest.fixture
+def product_store():
+    server = fakeredis.FakeServer()
+    return RedisProductStore(fakeredis.FakeRedis(server=server, decode_responses=True), storage="hash", dim=DIM,
+                             binary_client=fakeredis.FakeRedis(server=server))
+
+
+def write(store, keys, vectors):
+    store.write_products(keys, [Product(key, "synthetic product", "img/tea.png", embedding=np.asarray(vector, dtype=np.float32))
+                                for key, vector in zip(keys, vectors)])
+
+
+def meta(path):
+    with open(os.path.join(path, "current", "meta.json")) as file:
+        return json.load(file)
+
+
+@pytest.mark.parametrize("quantize", [False, True])
+def test_search_matches_exact_ranking(product_store, tmp_path, quantize):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(200, DIM)).astype(np.float32)
+    keys = product_store.allocate_product_keys(len(vectors))
+    write(product_store, keys, vectors)
+    assert MmapVectorIndexWriter(str(tmp_path), product_store, quantize=quantize).refresh() == len(keys)
+
+    index = MmapVectorIndex(str(tmp_path), check_interval=0)
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = rng.normal(size=(5, DIM)).astype(np.float32)
+    for query, result in zip(queries, index.search(queries, 5)):
+        similarities = normalized @ (query / np.linalg.norm(query))
+        exact = np.argsort(-similarities)[:5]
+        assert [key for key, _ in result] == [keys[i] for i in exact]
+        np.testing.assert_allclose([score for _, score in result], 1.0 - similarities[exact], atol=1e-5)
+
+
+def test_updates_and_deletes_are_followed(product_store, tmp_path):
+    keys = product_store.allocate_product_keys(4)
+    write(product_store, keys, np.eye(DIM))
+    writer = MmapVectorIndexWriter(str(tmp_path), product_store, compact_ratio=1.0)
+    writer.refresh()
+    index = MmapVectorIndex(str(tmp_path), check_interval=0)
+    assert index.search(np.array([1.0, 0, 0, 0]), 1)[0][0][0] == keys[0]
+
+    write(product_store, keys[:1], [[0, 0, 0, 1.0]])
+    product_store.delete_product(keys[1])
+    assert writer.refresh() == 2
+    assert writer.refresh() == 0
+    assert index.reload_if_changed()
+    assert len(index) == 3
+    assert keys[1] not in [key for key, _ in index.search(np.array([0, 1.0, 0, 0]), 3)[0]]
+    assert sorted(key for key, _ in index.search(np.array([0, 0, 0, 1.0]), 2)[0]) == sorted([keys[0], keys[3]])
+    # rows are appended to the same data files while dead rows stay below compact_ratio
+    assert meta(str(tmp_path))["keys"] == [None, None, keys[2], keys[3], keys[0]]
+
+
+def test_dead_rows_are_compacted(product_store, tmp_path):
+    keys = product_store.allocate_product_keys(4)
+    write(product_store, keys, np.eye(DIM))
+    writer = MmapVectorIndexWriter(str(tmp_path), product_store, quantize=True, compact_ratio=0.25)
+    writer.refresh()
+    data = meta(str(tmp_path))["data"]
+    product_store.delete_product(keys[0])
+    product_store.delete_product(keys[1])
+    writer.refresh()
+
+    current = meta(str(tmp_path))
+    assert current["data"] != data
+    assert current["keys"] == keys[2:]
+    assert os.path.getsize(os.path.join(str(tmp_path), current["data"], "vectors.f32")) == 2 * DIM * 4
+    index = MmapVectorIndex(str(tmp_path), check_interval=0)
+    assert sorted(key for key, _ in index.search(np.ones(DIM), 4)[0]) == keys[2:]
+
+
+def test_reserved_keys_are_indexed_once_written(product_store, tmp_path):
+    keys = product_store.allocate_product_keys(3)
+    write(product_store, keys[:1], np.eye(DIM)[:1])
+    writer = MmapVectorIndexWriter(str(tmp_path), product_store)
+    writer.refresh()
+    assert meta(str(tmp_path))["missing"] == keys[1:]
+
+    write(product_store, keys[1:], np.eye(DIM)[1:3])
+    writer.refresh()
+    assert meta(str(tmp_path))["missing"] == []
+    assert len(MmapVectorIndex(str(tmp_path), check_interval=0)) == 3
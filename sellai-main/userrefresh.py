@@ -0,0 +1,125 @@
+"""
+Background refresh of user embeddings.
+
+Users saved or updated without refreshing are queued in the users:stale SET, and users:refreshed ZSET
+orders all users by the time of their last refresh. The scheduler takes both queued users and users
+whose embedding is older than the TTL, and re-embeds only those whose keyword set changed or whose
+embedding expired, in one batched embedding request per pass. The request path then only reads
+precomputed embeddings.
+
+Usage: python userrefresh.py [--ttl-hours 24] [--batch 256] [--interval 5] [--storage json|hash] [--dim 1536]
+"""
+import argparse
+import datetime
+import os
+import threading
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from redis import Redis
+
+from aibox import AIBox, OpenAIBox, DEFAULT_EMBEDDING_DIM
+from dbcontrol import RedisKeywordEmbeddingCache, RedisUserStore, User
+from metrics import timed
+
+
+class UserRefreshScheduler(threading.Thread):
+    def __init__(self,
+                 user_store: RedisUserStore,
+                 aibox: AIBox,
+                 ttl: datetime.timedelta = datetime.timedelta(days=1),
+                 batch_size: int = 256,
+                 interval: float = 5.0,
+                 embedding_cache: Optional[RedisKeywordEmbeddingCache] = None) -> None:
+        """
+        :param ttl: embeddings older than this are recomputed even if keywords did not change
+        :param batch_size: maximal number of users re-embedded in one pass
+        :param interval: seconds between passes when there is nothing left to refresh
+        :param embedding_cache: rebuild embeddings from cached keyword embeddings instead of embedding keyword text
+        """
+        super().__init__(daemon=True, name="UserRefreshScheduler")
+        self.user_store = user_store
+        self.aibox = aibox
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.interval = interval
+        self.embedding_cache = embedding_cache
+        self._stop_event = threading.Event()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            refreshed = 0
+            try:
+                refreshed = self.run_once()
+            except Exception as e:
+                print(f"UserRefreshScheduler: {e}")
+            # keep draining while full batches come back
+            if refreshed < self.batch_size:
+                self._stop_event.wait(self.interval)
+
+    def _candidates(self) -> List[str]:
+        keys = self.user_store.pop_stale(self.batch_size)
+        if len(keys) < self.batch_size:
+            keys += self.user_store.expired_users(self.ttl, self.batch_size - len(keys))
+        return list(dict.fromkeys(keys))
+
+    def run_once(self) -> int:
+        """Performs one pass, returns number of refreshed users"""
+        keys = self._candidates()
+        if not keys:
+            return 0
+        try:
+            now = datetime.datetime.now()
+            stale_keys, stale_users, deleted = [], [], []
+            for key, user in zip(keys, self.user_store.get_users(keys)):
+                if user is None:
+                    deleted.append(key)
+                elif user.needs_refresh(self.ttl, now):
+                    stale_keys.append(key)
+                    stale_users.append(user)
+            # deleted users would otherwise stay the oldest entries and fill every batch
+            self.user_store.forget_users(deleted)
+            if not stale_users:
+                return 0
+            self._refresh(stale_users)
+            deleted = self.user_store.write_user_embeddings(stale_keys, stale_users)
+            return len(stale_users) - len(deleted)
+        except Exception:
+            # popped keys would be lost otherwise
+            self.user_store.mark_stale(keys)
+            raise
+
+    def _refresh(self, users: List[User]) -> None:
+        if self.embedding_cache is not None:
+            # one lookup for the keywords of the whole batch, per-user rebuilds are then served locally
+            self.embedding_cache.get_many(list({k for user in users for k in user.keyword_weights}), self.aibox)
+            for user in users:
+                user.refresh(self.aibox, self.embedding_cache)
+            return
+        with timed("embedding"):
+            embeddings = self.aibox.embeddings_from_texts([user.embedding_text() for user in users])
+        for user, embedding in zip(users, embeddings):
+            user.set_text_embedding(embedding)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh stale user embeddings in the background")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--storage", choices=["json", "hash"], default="json")
+    parser.add_argument("--dim", type=int, default=DEFAULT_EMBEDDING_DIM)
+    parser.add_argument("--ttl-hours", type=float, default=24.0)
+    parser.add_argument("--batch", type=int, default=256)
+    parser.add_argument("--interval", type=float, default=5.0)
+    args = parser.parse_args()
+
+    load_dotenv()
+    store = RedisUserStore(Redis(host=args.host, port=args.port, decode_responses=True), storage=args.storage, dim=args.dim)
+    scheduler = UserRefreshScheduler(store, OpenAIBox(os.getenv("OPENAI_KEY"), dimensions=args.dim),
+                                     ttl=datetime.timedelta(hours=args.ttl_hours),
+                                     batch_size=args.batch, interval=args.interval)
+    scheduler.start()
+    scheduler.join()
@@ -0,0 +1,401 @@
+"""
+In-process product vector index backed by memory-mapped files.
+
+The writer (run as a sidecar: python vectorindex.py --path index-data) pulls new products from Redis
+by the product_counter sequence number, and updated and deleted products from the product_changes
+stream written by RedisProductStore, or from those of every shard of shardedstore.ShardedProductStore.
+It publishes immutable index versions:
+    <path>/v<generation>/meta.json     dim, rows, sequence, change log positions, row keys, keys still missing
+    <path>/d<generation>/vectors.f32   rows x dim float32 matrix of normalized embeddings
+    <path>/d<generation>/vectors.i8    rows x dim int8 quantized matrix (optional)
+    <path>/d<generation>/scales.f32    per-row dequantization scales (optional)
+    <path>/current                   symlink to the latest version, replaced atomically
+Data files are append-only and shared by consecutive versions: a new or updated product appends
+a row, an updated or deleted product leaves a dead row (null key) behind. Every version maps only
+the rows it knows of, so appending never disturbs readers. Once dead rows exceed a share of the
+matrix, the live rows are compacted into a new data directory.
+Readers map the files read-only, so all worker processes on a host share the same page cache,
+and switch to a new version when the symlink changes. Redis stays the source of truth,
+RedisProductStore falls back to it whenever the local index cannot answer.
+
+Usage: python vectorindex.py [--path index-data] [--shards host:port,...] [--storage json|hash] [--dim 1536] [--quantize] [--interval 30]
+"""
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from datalayer import RedisDataLayer
+from dbcontrol import PRODUCT_CHANGES, RedisProductStore, unpack_vector
+from shardedstore import ShardedProductStore
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return (matrix / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+def _quantize(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-row int8 quantization, returns (int8 matrix, float32 scales)"""
+    scales = np.maximum(np.abs(matrix).max(axis=1), 1e-12) / 127.0
+    quantized = np.round(matrix / scales[:, None]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def _approximate_similarities(queries: np.ndarray, quantized: np.ndarray, scales: np.ndarray, block: int = 65536) -> np.ndarray:
+    """Similarities against int8 rows, dequantized block by block to keep memory bounded"""
+    similarities = np.empty((queries.shape[0], quantized.shape[0]), dtype=np.float32)
+    for start in range(0, quantized.shape[0], block):
+        stop = min(start + block, quantized.shape[0])
+        similarities[:, start:stop] = (queries @ quantized[start:stop].T.astype(np.float32)) * scales[start:stop]
+    return similarities
+
+
+class MmapVectorIndex:
+    """
+    Read-only view of the latest published index version. Thread-safe.
+    Scores are cosine distances (1 - cosine similarity), the same as RediSearch COSINE scores.
+    """
+    def __init__(self, path: str, rerank_factor: int = 4, check_interval: float = 1.0) -> None:
+        """
+        :param path: directory the writer publishes to
+        :param rerank_factor: with int8 vectors, k * rerank_factor candidates are re-ranked exactly
+        :param check_interval: minimal number of seconds between checks for a new version
+        """
+        self.path = path
+        self.rerank_factor = rerank_factor
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._version = None
+        self._last_check = 0.0
+        self.keys: List[Optional[str]] = []
+        self.alive = np.zeros(0, dtype=bool)
+        self.sequence = 0
+        self.vectors: Optional[np.ndarray] = None
+        self.quantized: Optional[np.ndarray] = None
+        self.scales: Optional[np.ndarray] = None
+        self.reload_if_changed(force=True)
+
+    def __len__(self) -> int:
+        return int(self.alive.sum())
+
+    def reload_if_changed(self, force: bool = False) -> bool:
+        """Maps the latest version if the writer has published a new one, returns True if it did"""
+        now = time.monotonic()
+        if not force and now - self._last_check < self.check_interval:
+            return False
+        self._last_check = now
+        current = os.path.join(self.path, "current")
+        try:
+            version = os.readlink(current)
+        except OSError:
+            return False
+        if version == self._version:
+            return False
+
+        with open(os.path.join(self.path, version, "meta.json")) as file:
+            meta = json.load(file)
+        data_dir = os.path.join(self.path, meta["data"])
+        shape = (meta["rows"], meta["dim"])
+        vectors = np.memmap(os.path.join(data_dir, "vectors.f32"), dtype=np.float32, mode="r", shape=shape) if meta["rows"] else np.empty(shape, np.float32)
+        quantized, scales = None, None
+        if meta["quantized"] and meta["rows"]:
+            quantized = np.memmap(os.path.join(data_dir, "vectors.i8"), dtype=np.int8, mode="r", shape=shape)
+            scales = np.memmap(os.path.join(data_dir, "scales.f32"), dtype=np.float32, mode="r", shape=(meta["rows"],))
+        alive = np.array([key is not None for key in meta["keys"]], dtype=bool)
+        with self._lock:
+            self.keys, self.alive, self.sequence = meta["keys"], alive, meta["sequence"]
+            self.vectors, self.quantized, self.scales = vectors, quantized, scales
+            self._version = version
+        return True
+
+    def search(self, queries: np.ndarray, k: int) -> List[List[Tuple[str, float]]]:
+        """
+        Top-k cosine search for one (dim,) or several (n, dim) queries.
+        Returns for every query a list of (product key, cosine distance) sorted by distance
+        """
+        self.reload_if_changed()
+        with self._lock:
+            keys, alive, vectors, quantized, scales = self.keys, self.alive, self.vectors, self.quantized, self.scales
+        queries = _normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        live = int(alive.sum())
+        if not live:
+            return [[] for _ in range(queries.shape[0])]
+        k = min(k, live)
+
+        if quantized is None:
+            similarities = queries @ vectors.T
+            # rows of updated and deleted products never make it into the top k
+            similarities[:, ~alive] = -np.inf
+            candidates = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        else:
+            # approximate scores on int8 vectors, then exact re-ranking of a few candidates per query
+            approximate = _approximate_similarities(queries, quantized, scales)
+            approximate[:, ~alive] = -np.inf
+            n_candidates = min(k * self.rerank_factor, len(keys))
+            candidates = np.argpartition(-approximate, n_candidates - 1, axis=1)[:, :n_candidates]
+            similarities = None
+
+        results = []
+        for row, row_candidates in enumerate(candidates):
+            if similarities is None:
+                row_candidates = np.sort(row_candidates)
+                row_scores = vectors[row_candidates] @ queries[row]
+            else:
+                row_scores = similarities[row, row_candidates]
+            order = [i for i in np.argsort(-row_scores) if keys[row_candidates[i]] is not None][:k]
+            results.append([(keys[row_candidates[i]], float(1.0 - row_scores[i])) for i in order])
+        return results
+
+
+def _stream_id(entry_id: str) -> Tuple[int, int]:
+    milliseconds, _, sequence = entry_id.partition("-")
+    return int(milliseconds), int(sequence or 0)
+
+
+class MmapVectorIndexWriter:
+    """
+    Pulls changed products from Redis and publishes index versions for MmapVectorIndex readers.
+    Products are keyed product:1 .. product:<product_counter>, so the counter serves as sequence number
+    and only products added since the last published version are fetched.
+    Keys are reserved before their documents are written (in blocks by bulk ingestion), so keys
+    below the counter that do not exist yet are retried on the following refreshes.
+    Rewritten and deleted products are read from the product_changes stream of every shard. If a stream
+    was trimmed past the last read entry, every indexed product is fetched again.
+    """
+    def __init__(self, path: str, product_store: RedisProductStore, quantize: bool = False,
+                 keep_versions: int = 2, batch: int = 1000, missing_attempts: int = 20,
+                 compact_ratio: float = 0.25) -> None:
+        """
+        :param quantize: also publish int8 vectors for 4x smaller scans with exact re-ranking
+        :param keep_versions: number of old versions left on disk for readers still mapping them
+        :param missing_attempts: number of refreshes a missing key is retried before it is considered failed
+        :param compact_ratio: share of dead rows above which live rows are rewritten into new data files
+        """
+        self.path = path
+        self.product_store = product_store
+        self.quantize = quantize
+        self.keep_versions = keep_versions
+        self.batch = batch
+        self.missing_attempts = missing_attempts
+        self.compact_ratio = compact_ratio
+        self._attempts = {}
+        os.makedirs(path, exist_ok=True)
+
+    def _current(self) -> dict:
+        meta = None
+        try:
+            version_dir = os.path.join(self.path, os.readlink(os.path.join(self.path, "current")))
+            with open(os.path.join(version_dir, "meta.json")) as file:
+                meta = json.load(file)
+        except OSError:
+            pass
+        if meta is None or "data" not in meta:
+            # nothing published yet, or published without change tracking and rebuilt from scratch
+            return {"dim": self.product_store.dim, "rows": 0, "keys": [], "sequence": 0, "changes": {},
+                    "generation": meta["generation"] if meta else 0, "data": None, "missing": [], "quantized": self.quantize}
+        if isinstance(meta["changes"], str):
+            # published by a single-store writer before shards were followed
+            meta["changes"] = {"": meta["changes"]}
+        return meta
+
+    def _stores(self) -> Dict[str, RedisProductStore]:
+        """Stores with a change log of their own by shard name, a single store has an unnamed one"""
+        if isinstance(self.product_store, ShardedProductStore):
+            return self.product_store.shards
+        return {"": self.product_store}
+
+    def _fetch(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        if not isinstance(self.product_store, ShardedProductStore):
+            return self._fetch_from(self.product_store, keys)
+        vectors: List[Optional[np.ndarray]] = [None] * len(keys)
+        for name, positions in self.product_store.group_keys(keys).items():
+            shard_vectors = self._fetch_from(self.product_store.shards[name], [keys[i] for i in positions])
+            for position, vector in zip(positions, shard_vectors):
+                vectors[position] = vector
+        return vectors
+
+    @staticmethod
+    def _fetch_from(store: RedisProductStore, keys: List[str]) -> List[Optional[np.ndarray]]:
+        if store.storage == "hash":
+            pipe = store.binary_client.pipeline(transaction=False)
+            for key in keys:
+                pipe.hget(key, "embedding")
+            return [unpack_vector(data) if data is not None else None for data in pipe.execute()]
+        pipe = store.redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.json().get(key, "$.embedding")
+        return [np.array(data[0], dtype=np.float32) if data and data[0] is not None else None for data in pipe.execute()]
+
+    def _changes(self, positions: Dict[str, str]) -> Tuple[List[str], Dict[str, str], bool]:
+        """
+        Returns (keys changed after positions, new positions, whether entries after a position were trimmed),
+        positions are stream ids by shard name
+        """
+        keys, new_positions, trimmed = [], {}, False
+        for name, store in self._stores().items():
+            shard_keys, new_positions[name], shard_trimmed = self._shard_changes(store, positions.get(name, "0-0"))
+            keys += shard_keys
+            trimmed = trimmed or shard_trimmed
+        return keys, new_positions, trimmed
+
+    def _shard_changes(self, store: RedisProductStore, position: str) -> Tuple[List[str], str, bool]:
+        redis_client = store.redis_client
+        first = redis_client.xrange(PRODUCT_CHANGES, count=1)
+        trimmed = bool(first) and _stream_id(first[0][0]) > _stream_id(position) and position != "0-0"
+        keys = []
+        while True:
+            entries = redis_client.xrange(PRODUCT_CHANGES, min="(" + position, count=self.batch)
+            for entry_id, fields in entries:
+                keys.append(fields["key"])
+                position = entry_id
+            if len(entries) < self.batch:
+                return keys, position, trimmed
+
+    def refresh(self) -> int:
+        """Publishes a new version if products were added, rewritten or deleted, returns number of changed rows"""
+        meta = self._current()
+        sequence, missing = meta["sequence"], meta.get("missing", [])
+        # keys of all shards are allocated from the counter of the coordinator
+        coordinator = self.product_store.coordinator if isinstance(self.product_store, ShardedProductStore) else self.product_store
+        latest = int(coordinator.redis_client.get("product_counter") or 0)
+        changed, position, trimmed = self._changes(meta["changes"])
+        keys: List[Optional[str]] = meta["keys"]
+        rows: Dict[str, int] = {key: row for row, key in enumerate(keys) if key is not None}
+        if trimmed:
+            print("MmapVectorIndexWriter: change log was trimmed, fetching all indexed products")
+            changed = list(rows) + changed
+        if latest <= sequence and not missing and not changed:
+            return 0
+
+        data_dir = os.path.join(self.path, meta["data"]) if meta["data"] else None
+        current = (np.memmap(os.path.join(data_dir, "vectors.f32"), dtype=np.float32, mode="r", shape=(meta["rows"], meta["dim"]))
+                   if meta["rows"] else np.empty((0, self.product_store.dim), dtype=np.float32))
+        new_range = [f"product:{i}" for i in range(sequence + 1, latest + 1)]
+        retried = set(missing) | set(new_range)
+        candidates = list(dict.fromkeys(missing + new_range + changed))
+        keys = list(keys)
+        new_keys, new_vectors, still_missing = [], [], []
+        removed = 0
+        for start in range(0, len(candidates), self.batch):
+            batch_keys = candidates[start:start + self.batch]
+            for key, vector in zip(batch_keys, self._fetch(batch_keys)):
+                row = rows.get(key)
+                if vector is not None and vector.shape == (self.product_store.dim,):
+                    self._attempts.pop(key, None)
+                    vector = _normalize(vector)
+                    if row is not None and np.array_equal(current[row], vector):
+                        continue
+                    new_keys.append(key)
+                    new_vectors.append(vector)
+                elif row is not None:
+                    # deleted, or rewritten with a wrong dimension
+                    removed += 1
+                elif vector is None and key in retried:
+                    # reserved but not written yet, or the save failed
+                    self._attempts[key] = self._attempts.get(key, 0) + 1
+                    if self._attempts[key] < self.missing_attempts:
+                        still_missing.append(key)
+                    else:
+                        del self._attempts[key]
+                if row is not None:
+                    keys[row] = None
+        if not new_keys and not removed and still_missing == missing and latest <= sequence and position == meta["changes"]:
+            return 0
+
+        appended = np.vstack(new_vectors) if new_vectors else np.empty((0, self.product_store.dim), dtype=np.float32)
+        generation = meta["generation"] + 1
+        dead = keys.count(None)
+        if data_dir is None or meta["quantized"] != self.quantize or dead > self.compact_ratio * (len(keys) + len(new_keys)):
+            live = [row for row, key in enumerate(keys) if key is not None]
+            data = f"d{generation}"
+            self._write_rows(os.path.join(self.path, data), 0, np.vstack([current[live], appended]))
+            keys = [keys[row] for row in live]
+        else:
+            data = meta["data"]
+            self._write_rows(data_dir, meta["rows"], appended)
+        keys += new_keys
+        self._publish({"dim": self.product_store.dim, "rows": len(keys), "keys": keys, "sequence": max(latest, sequence),
+                       "changes": position, "generation": generation, "data": data, "missing": still_missing,
+                       "quantized": self.quantize})
+        return len(new_keys) + removed
+
+    def _write_rows(self, data_dir: str, rows: int, vectors: np.ndarray) -> None:
+        """
+        Appends normalized vectors after the first rows rows of the data files. Rows beyond them
+        were written by an interrupted refresh and never published, they are cut off first
+        """
+        os.makedirs(data_dir, exist_ok=True)
+        arrays = [("vectors.f32", vectors.astype(np.float32), vectors.shape[1] * 4)]
+        if self.quantize:
+            quantized, scales = _quantize(vectors) if len(vectors) else (np.empty(vectors.shape, np.int8), np.empty(0, np.float32))
+            arrays += [("vectors.i8", quantized, vectors.shape[1]), ("scales.f32", scales, 4)]
+        for name, array, row_size in arrays:
+            file_path = os.path.join(data_dir, name)
+            if os.path.exists(file_path):
+                os.truncate(file_path, rows * row_size)
+            with open(file_path, "ab") as file:
+                array.tofile(file)
+
+    def _publish(self, meta: dict) -> None:
+        version = f"v{meta['generation']}"
+        version_dir = os.path.join(self.path, version)
+        tmp_dir = version_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as file:
+            json.dump(meta, file)
+        shutil.rmtree(version_dir, ignore_errors=True)
+        os.rename(tmp_dir, version_dir)
+
+        link_tmp = os.path.join(self.path, "current.tmp")
+        if os.path.lexists(link_tmp):
+            os.remove(link_tmp)
+        os.symlink(version, link_tmp)
+        os.replace(link_tmp, os.path.join(self.path, "current"))
+        self._cleanup(version)
+
+    def _cleanup(self, current: str) -> None:
+        versions = sorted((name for name in os.listdir(self.path) if name.startswith("v") and not name.endswith(".tmp")),
+                          key=lambda name: int(name[1:]))
+        for name in versions[:-self.keep_versions]:
+            if name != current:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+        # data directories are shared by consecutive versions, they go with the last version mapping them
+        referenced = set()
+        for name in versions[-self.keep_versions:] + [current]:
+            try:
+                with open(os.path.join(self.path, name, "meta.json")) as file:
+                    referenced.add(json.load(file)["data"])
+            except OSError:
+                continue
+        for name in os.listdir(self.path):
+            if name.startswith("d") and name not in referenced:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publish memory-mapped product vector index from Redis")
+    parser.add_argument("--path", default="index-data")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--shards", default=None, help="host:port[/db],... of product shards, PRODUCT_SHARDS by default")
+    parser.add_argument("--storage", choices=["json", "hash"], default="json")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--quantize", action="store_true")
+    parser.add_argument("--interval", type=float, default=30.0)
+    args = parser.parse_args()
+
+    data_layer = RedisDataLayer(host=args.host, port=args.port, product_shards=args.shards or os.getenv("PRODUCT_SHARDS"))
+    store = data_layer.product_store(storage=args.storage, dim=args.dim)
+    writer = MmapVectorIndexWriter(args.path, store, quantize=args.quantize)
+    while True:
+        changed = writer.refresh()
+        if changed:
+            print(f"Published {changed} changed products")
+        time.sleep(args.interval)
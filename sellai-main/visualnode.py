@@ -1,10 +1,18 @@
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
-from typing import List
+from typing import Dict, List, Optional
 import xml.etree.ElementTree as ET
 import io
 from ast import literal_eval
+import functools
+from imagestore import resolve_variant
  
 
+@functools.lru_cache(maxsize=4096)
+def load_font(font_path: str, font_size: int) -> ImageFont.FreeTypeFont:
+    "Fonts are loaded once per process, FitText tries many sizes for every text"
+    return ImageFont.FreeTypeFont(font_path, font_size)
+
+
 class VNode:
     def __init__(self, width: int, height: int, children: 'List[VNode]', bg_color: tuple[int, int, int, int], offsets = []):
         self.width = width
@@ -67,7 +75,7 @@ class FitText(VNode):
         while font_size > 0:
             lines = []
             line = ""
-            font = ImageFont.FreeTypeFont(self.font_path, font_size)
+            font = load_font(self.font_path, font_size)
             
             metrics = list(font.getmetrics())
             formal_line_height = (metrics[0] - metrics[1]) * self.line_spacing
@@ -259,7 +267,8 @@ class Picture(VNode):
     
     def compose(self):
         ret_img = Image.new("RGBA", (self.width, self.height), self.bg_color)
-        picture = Image.open(self.img_source)
+        # stored images come in pre-scaled variants, the smallest one covering the slot is enough
+        picture = Image.open(resolve_variant(self.img_source, self.width, self.height, self.mode))
         picture = picture.convert("RGBA")
         pic_width, pic_height = picture.size
         
@@ -287,7 +296,7 @@ vnode_types = {
 }
 
 
-def __visit_vertex(xml_element: ET.Element) -> VNode:
+def __visit_vertex(xml_element: ET.Element, image_sources: Optional[Dict[str, bytes]] = None) -> VNode:
     tag = xml_element.tag
     args = xml_element.attrib
     valued_args = args
@@ -299,10 +308,11 @@ def __visit_vertex(xml_element: ET.Element) -> VNode:
             valued_args[arg] = args[arg]
     # print(tag, valued_args)
     children = []
+    if image_sources and isinstance(valued_args.get("img_source"), str) and valued_args["img_source"] in image_sources:
+        valued_args["img_source"] = io.BytesIO(image_sources[valued_args["img_source"]])
     for child in xml_element:
-        children += [__visit_vertex(child)]
+        children += [__visit_vertex(child, image_sources)]
     valued_args["children"] = children
-    print(tag, valued_args)
     vnode = vnode_types[tag](**valued_args)
     return vnode
 
@@ -314,9 +324,12 @@ def vnode_tree_from_file(file_path) -> VNode:
     vnode_root = __visit_vertex(tree_root)
     return vnode_root
 
-def vnode_tree_from_string(string) -> VNode:
-    "Parses a string and returns the root node of the element tree"
+def vnode_tree_from_string(string, image_sources: Optional[Dict[str, bytes]] = None) -> VNode:
+    """
+    Parses a string and returns the root node of the element tree
+    :param image_sources: image path -> file contents fetched in advance, used instead of reading these paths
+    """
     tree = ET.ElementTree(ET.fromstring(string))
     tree_root = tree.getroot()
-    vnode_root = __visit_vertex(tree_root)
+    vnode_root = __visit_vertex(tree_root, image_sources)
     return vnode_root
\ No newline at end of file